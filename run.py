@@ -1,10 +1,48 @@
+import argparse
 import pygame as pg
 import traceback
 from src.game import Game
+from src.replay import Recorder, Replay
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--record', metavar='FILE', help='record the race to FILE')
+parser.add_argument('--replay', metavar='FILE', help='play back a recorded race')
+parser.add_argument('--mirror', action='store_true', help='show a rear-view mirror')
+parser.add_argument('--profile', metavar='FILE',
+                    help='time the stages of every frame and write them to a '
+                         '.csv or .json FILE on exit')
+parser.add_argument('--frame-budget', type=float, metavar='MS',
+                    help='scale the render resolution so that frames take '
+                         'about MS milliseconds (e.g. 16.6)')
+parser.add_argument('--indexed', action='store_true',
+                    help='render the map from 8 bit palette indices')
+parser.add_argument('--dirty-rects', action='store_true',
+                    help='only update the parts of the window that changed '
+                         'while the camera stands still')
+parser.add_argument('--texture-budget', type=float, metavar='MB',
+                    help='keep only MB megabytes of the map texture in memory')
+args = parser.parse_args()
+options = {'mirror': args.mirror, 'profile': args.profile,
+           'indexed': args.indexed, 'dirty_rects': args.dirty_rects}
+if args.texture_budget:
+    options['texture_budget'] = int(args.texture_budget * 2**20)
+if args.frame_budget:
+    options['frame_budget'] = args.frame_budget / 1000
 
 try:
-    g = Game()
+    if args.replay:
+        replay = Replay(args.replay)
+        g = Game(map_name=replay.map_name, seed=replay.seed, **options)
+        replay.seek(g, replay.start_tick)
+    else:
+        g = Game(**options)
+    g.laps.on_lap = lambda row, lap, seconds: row == g.player.row and \
+        print(f'lap {lap}: {seconds:.3f} s')
+    if args.record:
+        g.recorder = Recorder(args.record, g)
+    print(f'Mode7 backend: {g.map.backend}')
+    g.print_startup_report()
     g.run()
 except Exception:
     traceback.print_exc()
-    pg.quit()
\ No newline at end of file
+    pg.quit()
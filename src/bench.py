@@ -0,0 +1,896 @@
+"""
+Headless Mode7 benchmark
+
+Flies the camera along fixed, reproducible paths over the tracks and
+reports frame times without opening a window. Run from the repository root:
+
+    python -m src.bench
+    python -m src.bench --maps track2 grid --sizes 200x150 640x480 --json out.json
+"""
+import os
+# the dummy video driver has to be selected before pygame is initialized
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import contextlib
+import gc
+import heapq
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+from math import sin, cos, pi, atan2
+
+import numpy as np
+import pygame as pg
+
+from src.controls import Input
+from src.fleet import KartFleet, STEP_BACKENDS
+from src.game import Game, Viewport, quantize
+from src.laps import KINDS, FINISH, TriggerIndex
+from src.mapcache import MapCache
+from src.render import BACKENDS, select_backend, perspective_tables
+from src.surface import ROAD, BOOST
+
+
+# the kart starts at this position, so the paths stay close to it
+ORIGIN = (999.904, 1000.38)
+
+# bytes a steady full frame may allocate (and free again) for --allocations,
+# well below the smallest frame buffer (200 x 150 x 3 bytes)
+FRAME_ALLOCATION_BUDGET = 64 * 1024
+
+# --triggers only tests every gate for comparison up to this many
+# kart and gate pairs per step
+BRUTE_FORCE_PAIRS = 2**16
+
+
+def path_orbit(t):
+    # circle around the origin, looking along the tangent
+    a = t * 2 * pi
+    return (ORIGIN[0] + cos(a) * 0.3, ORIGIN[1] + sin(a) * 0.3, a + pi / 2)
+
+
+def path_straight(t):
+    # drive diagonally across the whole map once
+    return (ORIGIN[0] + t, ORIGIN[1] + t, pi / 4)
+
+
+def path_spin(t):
+    # turn on the spot
+    return (ORIGIN[0], ORIGIN[1], t * 2 * pi)
+
+
+PATHS = {
+    'orbit': path_orbit,
+    'straight': path_straight,
+    'spin': path_spin
+}
+
+
+def parse_size(text):
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+def summarize(times):
+    """
+    return fps and frame time percentiles (in milliseconds) for a list
+    of frame times in seconds
+    """
+    times = np.asarray(times)
+    return {
+        'frames': len(times),
+        'fps': len(times) / times.sum(),
+        'mean_ms': times.mean() * 1000,
+        'p50_ms': np.percentile(times, 50) * 1000,
+        'p99_ms': np.percentile(times, 99) * 1000
+    }
+
+
+def run_path(game, path, frames, full_frame=False):
+    """
+    move the camera along path for the given number of frames and return
+    the time each frame took
+    """
+    dt = 1 / 60
+    player = game.player
+    times = []
+    for i in range(frames):
+        x, y, angle = path(i / frames)
+        player.pos = (x, y)
+        player.angle = angle
+        start = time.perf_counter()
+        if full_frame:
+            game.step(dt)
+            game.update(dt)
+            game.draw()
+        else:
+            game.map.update(dt)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def add_billboards(game, count, seed=0):
+    """
+    scatter count extra bushes over the whole map, at reproducible positions
+    """
+    rng = np.random.default_rng(seed)
+    positions = rng.random((count, 2)) * game.map.size
+    game.billboards.add(positions, game.bush_image)
+
+
+def bench(maps, sizes, paths, frames, full_frame=False, backend='auto',
+          threads=None, packed=False, tiled=False, billboards=0,
+          preallocate=True, indexed=False, texture_budget=None):
+    results = []
+    # Game compiles the kernel (or loads it from the numba cache) while it
+    # starts, the time that took is reported separately from the frames
+    warmup = None
+    for map_name in maps:
+        for size in sizes:
+            game = Game(map_name=None if map_name == 'grid' else map_name,
+                        screen_size=size, backend=backend, threads=threads,
+                        packed=packed, tiled=tiled, preallocate=preallocate,
+                        indexed=indexed, texture_budget=texture_budget)
+            if billboards:
+                add_billboards(game, billboards)
+            if warmup is None:
+                kernel = game.map.backend.kernels[game.map.texture_kind]
+                warmup = {
+                    'backend': str(game.map.backend),
+                    'seconds': game.startup_times['jit'],
+                    'startup': game.startup_times,
+                    # only numba kernels have compilation stats
+                    'cache_hits': sum(kernel.stats.cache_hits.values())
+                                  if hasattr(kernel, 'stats') else None
+                }
+            for path_name in paths:
+                # one untimed frame so each run starts from the same state
+                run_path(game, PATHS[path_name], 1, full_frame)
+                cache = game.sprite_cache.stats()
+                times = run_path(game, PATHS[path_name], frames, full_frame)
+                result = {
+                    'map': map_name,
+                    'size': f'{size[0]}x{size[1]}',
+                    'path': path_name,
+                    'billboards': len(game.billboards)
+                }
+                result.update(summarize(times))
+                if full_frame:
+                    # the sprite cache lookups of this path
+                    after = game.sprite_cache.stats()
+                    result['sprite_cache'] = {
+                        name: after[name] - cache[name]
+                        for name in ('hits', 'misses', 'evictions')}
+                    result['sprite_cache']['size'] = after['size']
+                pager = game.map.pager
+                if pager is not None:
+                    # counted over all paths so far
+                    result.update({'page_loads': pager.loads,
+                                   'page_misses': pager.misses,
+                                   'page_pool_bytes': pager.nbytes})
+                results.append(result)
+            game.map.close()
+    pg.quit()
+    return warmup, results
+
+
+def check_backends(maps, sizes, paths, frames=20, packed=False, tiled=False,
+                   indexed=False, texture_budget=None):
+    """
+    render the same frames with every backend and return a list of
+    (map, size, backend, number of differing pixels)
+    """
+    mismatches = []
+    for map_name in maps:
+        for size in sizes:
+            game = Game(map_name=None if map_name == 'grid' else map_name,
+                        screen_size=size, backend='numpy', packed=packed,
+                        tiled=tiled, indexed=indexed,
+                        texture_budget=texture_budget)
+            if game.map.pager is not None:
+                # every backend has to see the same resident pages
+                game.map.pager.wait = True
+            backends = {name: select_backend(name) for name in BACKENDS}
+            player = game.player
+            reference = None
+            diffs = dict.fromkeys(backends, 0)
+            for path_name in paths:
+                for i in range(frames):
+                    x, y, angle = PATHS[path_name](i / frames)
+                    player.pos = (x, y)
+                    player.angle = angle
+                    for name, backend in backends.items():
+                        game.map.backend = backend
+                        game.game_screen.fill((255, 0, 255))
+                        game.map.update(0)
+                        frame = pg.surfarray.array3d(game.game_screen)
+                        if reference is None or name == BACKENDS[0]:
+                            reference = frame
+                        diffs[name] += np.any(frame != reference, axis=2).sum()
+            for name, count in diffs.items():
+                mismatches.append((map_name, f'{size[0]}x{size[1]}', name, count))
+            game.map.close()
+    pg.quit()
+    return mismatches
+
+
+def bench_load(maps, repeats=3, tiled=False, packed=False, indexed=False):
+    """
+    return the cold (empty cache) and warm map load times in seconds. A
+    temporary cache folder is used, so the real cache is left alone
+    """
+    results = []
+    for map_name in maps:
+        game = Game(map_name=None, packed=packed)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            game.map_cache = MapCache(game.map_cache.folder, cache_dir)
+            times = {'cold': [], 'warm': []}
+            for i in range(repeats):
+                for path_name in ('cold', 'warm'):
+                    if path_name == 'cold':
+                        for entry in os.listdir(cache_dir):
+                            shutil.rmtree(os.path.join(cache_dir, entry))
+                    game.bake_map(game.map_cache.folder, map_name, tiled, packed,
+                                  indexed)
+                    times[path_name].append(game.map_cache.load_time)
+        results.append((map_name, min(times['cold']), min(times['warm'])))
+    pg.quit()
+    return results
+
+
+def bench_quantize(sizes, seed=0):
+    """
+    quantize size x size textures with a photographic number of colors (a
+    gradient with noise) to 256 colors. Return (size, unique colors,
+    seconds, peak traced memory in bytes)
+    """
+    results = []
+    rng = np.random.default_rng(seed)
+    for size in sizes:
+        y, x = np.mgrid[:size, :size] * (255 / size)
+        texture = np.stack((x, y, (x + y) / 2), axis=-1)
+        texture = np.clip(texture + rng.normal(0, 12, texture.shape), 0, 255)
+        texture = texture.astype(np.uint8)
+        colors = len(np.unique(texture.reshape(-1, 3), axis=0))
+        tracemalloc.start()
+        start = time.perf_counter()
+        quantize(texture)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append((size, colors, seconds, peak))
+    return results
+
+
+def drive(game):
+    """
+    scripted inputs for bench_simulate: full throttle, steering in slow
+    alternating arcs
+    """
+    if (game.tick // 90) % 2:
+        return Input.ACCELERATE | Input.LEFT
+    return Input.ACCELERATE | Input.RIGHT
+
+
+def bench_simulate(maps, steps, seed=0):
+    """
+    return the headless simulation steps per second for each map and the
+    final kart position, which is the same for every run with the same seed
+    """
+    results = []
+    for map_name in maps:
+        game = Game(map_name=None if map_name == 'grid' else map_name,
+                    headless=True, seed=seed)
+        start = time.perf_counter()
+        game.simulate(steps, drive)
+        seconds = time.perf_counter() - start
+        results.append((map_name, steps / seconds, tuple(game.player.pos)))
+    pg.quit()
+    return results
+
+
+# the autopilot of --laps aims this many cells ahead on the driving line
+# and steers when it is off by more than STEER_THRESHOLD radians
+LOOK_AHEAD = 4
+STEER_THRESHOLD = 0.08
+# simulated seconds a lap of --laps may take
+LAP_TIME_LIMIT = 120
+
+
+def driving_line(game):
+    """
+    return the centers of the road cells (in world units) along one lap of
+    game's map: from just past the finish line all the way around to the
+    player's start, without crossing the finish line. Road cells far from
+    the verges are cheaper, so the line keeps to the middle of the road.
+    None if the map has no finish line ahead of the player
+    """
+    grid = game.surface.grid
+    rows, cols = grid.shape
+    road = (grid == ROAD) | (grid == BOOST)
+    finish = TriggerIndex(game.laps.index.rects[game.laps.index.kinds == FINISH],
+                          np.zeros(np.count_nonzero(game.laps.index.kinds == FINISH)))
+    # cells to the nearest cell off the road
+    depth = np.zeros(grid.shape)
+    inner = road.copy()
+    while inner.any():
+        depth += inner
+        shrunk = inner.copy()
+        for axis in (0, 1):
+            for shift in (1, -1):
+                shrunk &= np.roll(inner, shift, axis)
+        inner = shrunk
+
+    # the first cell past the finish line straight ahead of the player
+    x, y, angle = game.player.view()
+    start = np.array([(x % 1) * cols, (y % 1) * rows])
+    ahead = np.floor(start + np.outer(np.arange(max(rows, cols)),
+                                      (cos(angle), sin(angle))))
+    crossed = finish.crossings((ahead[:-1] + 0.5) / (cols, rows),
+                               (ahead[1:] + 0.5) / (cols, rows))[0]
+    if len(crossed) == 0:
+        return None
+    source = tuple(ahead[crossed[0] + 1].astype(int)[::-1] % (rows, cols))
+    target = tuple(np.floor(start).astype(int)[::-1])
+
+    # the steps between neighbouring road cells that cross the finish line
+    moves = [(dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc]
+    cells = np.argwhere(road)
+    centers = (cells[:, ::-1] + 0.5) / (cols, rows)
+    blocked = set()
+    for move, (dr, dc) in enumerate(moves):
+        ends = centers + np.array([dc, dr]) / (cols, rows)
+        crossing = finish.crossings(centers, ends)[0]
+        blocked.update((tuple(cell), move) for cell in cells[crossing].tolist())
+
+    # Dijkstra over the road cells
+    distance = {source: 0}
+    previous = {}
+    heap = [(0, source)]
+    while heap:
+        d, cell = heapq.heappop(heap)
+        if cell == target:
+            break
+        if d > distance[cell]:
+            continue
+        r, c = cell
+        for move, (dr, dc) in enumerate(moves):
+            step = ((r + dr) % rows, (c + dc) % cols)
+            if not road[step] or (cell, move) in blocked:
+                continue
+            new = d + np.hypot(dr, dc) * (1 + 4 / depth[step])
+            if new < distance.get(step, np.inf):
+                distance[step] = new
+                previous[step] = cell
+                heapq.heappush(heap, (new, step))
+    if target not in previous:
+        return None
+    line = [target]
+    while line[-1] != source:
+        line.append(previous[line[-1]])
+    cells = np.array(line[::-1], dtype=float)
+    return (cells[:, ::-1] + 0.5) / (cols, rows)
+
+
+def autopilot(line):
+    """
+    return an inputs function for Game.simulate that drives the player
+    around the closed driving line at full throttle
+    """
+    state = {'index': None}
+
+    def inputs(game):
+        x, y = np.mod(game.fleet.pos[game.player.row], 1)
+        angle = game.fleet.angle[game.player.row]
+        # the nearest point of the line, searched a little ahead of the
+        # last one so the progress never jumps to another part of the track
+        if state['index'] is None:
+            window = np.arange(len(line))
+        else:
+            window = (state['index'] + np.arange(12)) % len(line)
+        index = state['index'] = window[np.argmin(np.hypot(*(line[window] - (x, y)).T))]
+        tx, ty = line[(index + LOOK_AHEAD) % len(line)]
+        error = (atan2(ty - y, tx - x) - angle + pi) % (2 * pi) - pi
+        if error > STEER_THRESHOLD:
+            return Input.ACCELERATE | Input.RIGHT
+        if error < -STEER_THRESHOLD:
+            return Input.ACCELERATE | Input.LEFT
+        return Input.ACCELERATE
+    return inputs
+
+
+def bench_laps(maps, laps, seed=0):
+    """
+    drive the player around each map with the autopilot until LapTimer
+    recorded laps laps or LAP_TIME_LIMIT seconds per lap passed. Return
+    (map, lap times, sector times of every lap, steps per second), no lap
+    times for maps without a finish line
+    """
+    results = []
+    for map_name in maps:
+        game = Game(map_name=None if map_name == 'grid' else map_name,
+                    headless=True, seed=seed)
+        line = None
+        if game.surface is not None and len(game.laps.index):
+            line = driving_line(game)
+        if line is None:
+            results.append((map_name, [], [], 0))
+            continue
+        pilot = autopilot(line)
+        timer = game.laps
+        row = game.player.row
+        timer.grow(len(game.fleet))
+        start = time.perf_counter()
+        steps = 0
+        while (len(timer.laps[row]) < laps
+               and steps < laps * LAP_TIME_LIMIT * game.TICK_RATE):
+            game.simulate(game.TICK_RATE, pilot)
+            steps += game.TICK_RATE
+        seconds = time.perf_counter() - start
+        results.append((map_name, timer.laps[row], timer.sectors[row],
+                        steps / seconds))
+    pg.quit()
+    return results
+
+
+def bench_fleet(counts, steps, seed=0):
+    """
+    time KartFleet.step with every physics backend for fields of count
+    karts driving with random inputs. Return (count, backend, microseconds
+    per step, whether the final state matches the first backend)
+    """
+    results = []
+    game = Game(map_name='track2', headless=True, seed=seed)
+    game.started = True
+    start_pos = np.array(game.player.pos)
+    for count in counts:
+        reference = None
+        for backend in STEP_BACKENDS:
+            rng = np.random.default_rng(seed)
+            fleet = KartFleet(game, capacity=count, backend=backend)
+            game.fleet = fleet
+            for i in range(count):
+                fleet.add(start_pos + rng.normal(0, 0.01, 2),
+                          game.player.angle + rng.normal(0, 0.5))
+            inputs = rng.choice([int(Input.ACCELERATE | Input.LEFT),
+                                 int(Input.ACCELERATE | Input.RIGHT),
+                                 int(Input.ACCELERATE), int(Input.BRAKE), 0],
+                                size=(steps, count)).astype(np.uint8)
+            fleet.step(game.STEP) # compile
+            start = time.perf_counter()
+            for i in range(steps):
+                fleet.inputs[:count] = inputs[i]
+                fleet.step(game.STEP)
+            seconds = time.perf_counter() - start
+            state = np.column_stack((fleet.pos, fleet.vel, fleet.angle,
+                                     fleet.steer_time, fleet.frame))
+            if reference is None:
+                reference = state
+            results.append((count, backend, seconds / steps * 1e6,
+                            np.array_equal(state, reference)))
+    pg.quit()
+    return results
+
+
+def bench_triggers(counts, karts, steps, seed=0):
+    """
+    time LapTimer.step for count gates scattered over track2 and fields of
+    karts driving with random inputs, with the TriggerIndex grid and with
+    one cell that holds every gate. Return (gates, karts, microseconds per
+    step, microseconds per step testing every gate or None if that is too
+    slow, whether both found the same crossings)
+    """
+    results = []
+    game = Game(map_name='track2', headless=True, seed=seed)
+    game.started = True
+    start_pos = np.array(game.player.pos)
+    for count in counts:
+        rng = np.random.default_rng(seed)
+        rects = np.column_stack((rng.random((count, 2)),
+                                 rng.uniform(0.001, 0.01, (count, 2))))
+        kinds = rng.integers(len(KINDS), size=count)
+        names = rng.integers(1, 10, size=count).astype(str).tolist()
+        indices = [TriggerIndex(rects, kinds, names)]
+        if count * max(karts) <= BRUTE_FORCE_PAIRS:
+            indices.append(TriggerIndex(rects, kinds, names, cells=1))
+        for kart_count in karts:
+            times = []
+            crossings = []
+            for index in indices:
+                rng = np.random.default_rng(seed)
+                game.fleet = KartFleet(game, capacity=kart_count)
+                for i in range(kart_count):
+                    game.fleet.add(start_pos + rng.normal(0, 0.05, 2),
+                                   rng.uniform(0, 2 * pi))
+                inputs = rng.choice([int(Input.ACCELERATE | Input.LEFT),
+                                     int(Input.ACCELERATE | Input.RIGHT),
+                                     int(Input.ACCELERATE)],
+                                    size=(steps, kart_count)).astype(np.uint8)
+                game.laps.set_index(index)
+                found = []
+                seconds = 0
+                for i in range(steps):
+                    game.fleet.inputs[:kart_count] = inputs[i]
+                    game.fleet.step(game.STEP)
+                    start = time.perf_counter()
+                    game.laps.step()
+                    seconds += time.perf_counter() - start
+                    found.append(game.laps.triggered)
+                times.append(seconds / steps * 1e6)
+                crossings.append((found, game.laps.laps, game.laps.sectors))
+            brute_force = times[1] if len(times) > 1 else None
+            results.append((count, kart_count, times[0], brute_force,
+                            crossings[0] == crossings[-1]))
+    pg.quit()
+    return results
+
+
+def split_screen(game, count):
+    """
+    return count Viewports in a grid over the game screen, each following
+    its own kart of game.fleet
+    """
+    cols = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / cols))
+    w, h = game.game_screen_rect.w // cols, game.game_screen_rect.h // rows
+    while len(game.fleet) < count:
+        game.fleet.add(game.player.pos, game.player.angle)
+    return [Viewport(game, (i % cols * w, i // cols * h, w, h), row=i)
+            for i in range(count)]
+
+
+def bench_viewports(maps, sizes, count, frames, backend='auto', threads=None,
+                    packed=False, tiled=False):
+    """
+    time rendering count split screen viewports with one viewport kernel
+    call against one render call per viewport. Return (map, size, ms per
+    frame in one call, ms per frame in separate calls, mean ms of the
+    separate call of each viewport, whether both give the same pixels)
+    """
+    results = []
+    for map_name in maps:
+        for size in sizes:
+            game = Game(map_name=None if map_name == 'grid' else map_name,
+                        screen_size=size, backend=backend, threads=threads,
+                        packed=packed, tiled=tiled)
+            mode7 = game.map
+            viewports = split_screen(game, count)
+            tables = [perspective_tables(vp.rect.w, vp.rect.h, mode7.near,
+                                         mode7.far, mode7.fov_half, game.HORIZON)
+                      for vp in viewports]
+
+            def render_separately():
+                """
+                render every viewport with its own kernel call, return the
+                seconds each call took
+                """
+                seconds = []
+                screen_array = mode7.screen_array()
+                for vp, (row_fwd, row_half, row_step, horizon_offset) in \
+                        zip(viewports, tables):
+                    x, y, angle = vp.view()
+                    view = screen_array[vp.rect.left:vp.rect.right,
+                                        vp.rect.top:vp.rect.bottom]
+                    start = time.perf_counter()
+                    mode7.backend.render(mode7.texture_kind, view, *mode7.textures,
+                                         row_fwd, row_half, row_step,
+                                         horizon_offset, x, y, cos(angle),
+                                         sin(angle))
+                    seconds.append(time.perf_counter() - start)
+                del screen_array
+                return seconds
+
+            times = {'one call': [], 'separate': []}
+            viewport_times = []
+            same = True
+            for i in range(frames + 1):
+                for row in range(count):
+                    x, y, angle = path_orbit((i / frames + row / count) % 1)
+                    game.fleet.pos[row] = x, y
+                    game.fleet.angle[row] = angle
+                start = time.perf_counter()
+                mode7.render_viewports(viewports)
+                one_call = time.perf_counter() - start
+                pixels = pg.surfarray.array2d(game.game_screen)
+                start = time.perf_counter()
+                per_viewport = render_separately()
+                separate = time.perf_counter() - start
+                same &= np.array_equal(pixels, pg.surfarray.array2d(game.game_screen))
+                # the first frame compiles the viewport kernel
+                if i > 0:
+                    times['one call'].append(one_call)
+                    times['separate'].append(separate)
+                    viewport_times.append(per_viewport)
+            results.append((map_name, f'{size[0]}x{size[1]}',
+                            np.mean(times['one call']) * 1000,
+                            np.mean(times['separate']) * 1000,
+                            np.mean(viewport_times, axis=0) * 1000, same))
+    pg.quit()
+    return results
+
+
+@contextlib.contextmanager
+def count_surfaces(counter):
+    """
+    count the Surfaces that are created while the block runs in
+    counter[0]: new pg.Surface objects and pg.transform results that are
+    not written into a dest Surface. tracemalloc doesn't see their pixel
+    buffers, SDL allocates them
+    """
+    surface_type = pg.Surface
+    transforms = {name: getattr(pg.transform, name)
+                  for name in ('scale', 'smoothscale', 'rotate', 'rotozoom', 'flip')}
+
+    class CountedSurface(surface_type):
+        def __init__(self, *args, **kwargs):
+            counter[0] += 1
+            super().__init__(*args, **kwargs)
+
+    def counted(name, function):
+        def transform(surface, *args, **kwargs):
+            # scale and smoothscale take the dest Surface as the third
+            # argument, the others always return a new Surface
+            if name not in ('scale', 'smoothscale') or (
+                    len(args) < 2 and kwargs.get('dest') is None):
+                counter[0] += 1
+            return function(surface, *args, **kwargs)
+        return transform
+
+    pg.Surface = CountedSurface
+    for name, function in transforms.items():
+        setattr(pg.transform, name, counted(name, function))
+    try:
+        yield counter
+    finally:
+        pg.Surface = surface_type
+        for name, function in transforms.items():
+            setattr(pg.transform, name, function)
+
+
+def bench_allocations(maps, sizes, frames, backend='auto', threads=None,
+                      packed=False, tiled=False, preallocate=True, seed=0):
+    """
+    render full frames (step, update and draw) along the orbit path three
+    times, the first two laps warm up the caches (the kart state differs
+    a little between laps, so the second one still meets a few new sprite
+    sizes) and the Python and NumPy memory of the last one is traced.
+    Return (map, size, mean and largest bytes allocated and freed again
+    within a frame, bytes still held after the lap, full garbage
+    collections, Surfaces created). Pixel buffers that
+    SDL allocates for Surfaces are not traced, so new Surfaces are counted
+    with count_surfaces instead
+    """
+    results = []
+    for map_name in maps:
+        for size in sizes:
+            game = Game(map_name=None if map_name == 'grid' else map_name,
+                        screen_size=size, backend=backend, threads=threads,
+                        packed=packed, tiled=tiled, seed=seed,
+                        preallocate=preallocate)
+            game.started = True
+            game.inputs = Input.ACCELERATE | Input.LEFT
+
+            def frame(i):
+                # the kart steers and kicks up dust, but follows the path
+                x, y, angle = path_orbit(i / frames)
+                game.player.pos = x, y
+                game.player.angle = angle
+                game.step(game.STEP)
+                game.update(game.STEP)
+                game.draw()
+
+            for i in range(2 * frames):
+                frame(i % frames)
+            collections = []
+            # collections of the young generations only look at a few
+            # objects, full ones walk the whole heap and cause the hitches
+            callback = lambda phase, info: (phase == 'start'
+                                            and info['generation'] == 2
+                                            and collections.append(info))
+            gc.callbacks.append(callback)
+            tracemalloc.start()
+            transient = []
+            start = tracemalloc.get_traced_memory()[0]
+            with count_surfaces([0]) as surfaces:
+                for i in range(frames):
+                    tracemalloc.reset_peak()
+                    before = tracemalloc.get_traced_memory()[0]
+                    frame(i)
+                    transient.append(tracemalloc.get_traced_memory()[1] - before)
+            held = tracemalloc.get_traced_memory()[0] - start
+            tracemalloc.stop()
+            gc.callbacks.remove(callback)
+            results.append((map_name, f'{size[0]}x{size[1]}', np.mean(transient),
+                            max(transient), held, len(collections), surfaces[0]))
+    pg.quit()
+    return results
+
+
+def print_results(warmup, results):
+    print(f"backend: {warmup['backend']}")
+    if warmup['cache_hits'] is None:
+        print('JIT warm-up: none')
+    else:
+        source = 'cache load' if warmup['cache_hits'] else 'compilation'
+        print(f"JIT warm-up: {warmup['seconds'] * 1000:.1f} ms ({source})")
+    header = f"{'map':<8} {'size':<9} {'path':<9} {'fps':>9} {'p50 ms':>8} {'p99 ms':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['map']:<8} {r['size']:<9} {r['path']:<9} "
+              f"{r['fps']:>9.1f} {r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f}")
+        if 'page_loads' in r:
+            print(f"{'':<18} pages loaded {r['page_loads']}, missing "
+                  f"{r['page_misses']}, pool {r['page_pool_bytes'] / 2**20:.1f} MB")
+        if 'sprite_cache' in r:
+            cache = r['sprite_cache']
+            lookups = max(cache['hits'] + cache['misses'], 1)
+            print(f"{'':<18} sprite cache {cache['size']} entries, hits "
+                  f"{cache['hits'] / lookups:.1%}, misses {cache['misses']}, "
+                  f"evictions {cache['evictions']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--maps', nargs='+', default=['track1', 'track2', 'grid'],
+                        help="tmx map names, 'grid' for the procedural texture")
+    parser.add_argument('--sizes', nargs='+', type=parse_size,
+                        default=[(200, 150), (400, 300), (640, 480)])
+    parser.add_argument('--paths', nargs='+', choices=PATHS, default=list(PATHS))
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--full-frame', action='store_true',
+                        help='time Game.update and Game.draw instead of only Mode7')
+    parser.add_argument('--backend', choices=('auto',) + BACKENDS, default='auto')
+    parser.add_argument('--threads', type=int,
+                        help='threads for numba-parallel (default: all cores)')
+    parser.add_argument('--packed', action='store_true',
+                        help='use the packed 32 bit texture and framebuffer path')
+    parser.add_argument('--tiled', action='store_true',
+                        help='sample the map through its tile grid and atlas')
+    parser.add_argument('--indexed', action='store_true',
+                        help='render the map from 8 bit palette indices')
+    parser.add_argument('--texture-budget', type=float, metavar='MB',
+                        help='page the map texture with a pool of MB megabytes')
+    parser.add_argument('--load', action='store_true',
+                        help='time cold and warm map loading instead of rendering')
+    parser.add_argument('--quantize', type=int, nargs='+', metavar='SIZE',
+                        help='time the palette quantization of --indexed on '
+                             'SIZE x SIZE textures with many colors')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the output of all backends instead of timing')
+    parser.add_argument('--billboards', type=int, default=0, metavar='N',
+                        help='scatter N extra bushes over the map '
+                             '(drawn with --full-frame)')
+    parser.add_argument('--simulate', type=int, metavar='STEPS',
+                        help='time STEPS headless simulation steps instead of rendering')
+    parser.add_argument('--laps', type=int, metavar='N',
+                        help='drive N laps with an autopilot, exit with 1 if a '
+                             'map with a finish line records fewer laps')
+    parser.add_argument('--karts', type=int, nargs='+', metavar='N',
+                        help='time the kart physics for fields of N karts')
+    parser.add_argument('--triggers', type=int, nargs='+', metavar='N',
+                        help='time the lap timing for N gates on the track, '
+                             'with --karts fields (default: 8 and 64 karts)')
+    parser.add_argument('--viewports', type=int, metavar='N',
+                        help='time N split screen viewports in one kernel call '
+                             'against one call per viewport')
+    parser.add_argument('--allocations', action='store_true',
+                        help='trace the memory allocated per full frame, exit '
+                             'with 1 if a steady frame allocates a buffer, '
+                             'creates a Surface or collects all garbage')
+    parser.add_argument('--no-preallocate', dest='preallocate', action='store_false',
+                        help='allocate a new upscaled frame every frame')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args(argv)
+    texture_budget = None
+    if args.texture_budget is not None:
+        texture_budget = int(args.texture_budget * 2**20)
+
+    if args.load:
+        maps = [m for m in args.maps if m != 'grid']
+        for map_name, cold, warm in bench_load(maps, tiled=args.tiled,
+                                               packed=args.packed,
+                                               indexed=args.indexed):
+            print(f'{map_name:<8} cold {cold * 1000:8.1f} ms   '
+                  f'warm {warm * 1000:8.1f} ms')
+        return
+
+    if args.quantize:
+        for size, colors, seconds, peak in bench_quantize(args.quantize):
+            print(f'{size:5}x{size:<5} {colors:8} colors {seconds:8.2f} s   '
+                  f'peak {peak / 2**20:8.1f} MB')
+        return
+
+    if args.simulate:
+        for map_name, rate, pos in bench_simulate(args.maps, args.simulate):
+            print(f'{map_name:<8} {rate:10.0f} steps/s   '
+                  f'final position ({pos[0]:.6f}, {pos[1]:.6f})')
+        return
+
+    if args.laps:
+        failed = False
+        for map_name, times, sectors, rate in bench_laps(args.maps, args.laps):
+            if not rate:
+                print(f'{map_name:<8} no finish line')
+                continue
+            for lap, (seconds, split) in enumerate(zip(times, sectors), 1):
+                print(f'{map_name:<8} lap {lap} {seconds:8.3f} s   sectors '
+                      + ' '.join(f'{sector:7.3f}' for sector in split))
+            print(f'{map_name:<8} {len(times)} of {args.laps} laps   '
+                  f'{rate:8.0f} steps/s')
+            failed |= len(times) < args.laps
+        if failed:
+            raise SystemExit(1)
+        return
+
+    if args.triggers:
+        for gates, karts, micros, brute_force, same in \
+                bench_triggers(args.triggers, args.karts or [8, 64], args.frames):
+            compared = (f'every gate {brute_force:9.1f} us/step  '
+                        f"{'same crossings' if same else 'DIFFERENT CROSSINGS'}"
+                        if brute_force is not None else '')
+            print(f'{gates:6} gates {karts:5} karts  grid {micros:7.1f} us/step  '
+                  f'{micros / karts:6.2f} us/kart   {compared}')
+        return
+
+    if args.karts:
+        for count, backend, micros, same in bench_fleet(args.karts, args.frames):
+            print(f'{count:5} karts  {backend:<6} {micros:9.1f} us/step  '
+                  f"{micros / count:7.2f} us/kart  "
+                  f"{'same result' if same else 'DIFFERENT RESULT'}")
+        return
+
+    if args.allocations:
+        failed = False
+        for map_name, size, mean, largest, held, collections, surfaces in \
+                bench_allocations(args.maps, args.sizes, args.frames,
+                                  args.backend, args.threads, args.packed,
+                                  args.tiled, args.preallocate):
+            print(f'{map_name:<8} {size:<9} per frame {mean / 1024:8.1f} KB '
+                  f'(max {largest / 1024:8.1f} KB)   held {held / 1024:6.1f} KB   '
+                  f'{collections} full garbage collections   '
+                  f'{surfaces} new Surfaces')
+            failed |= (largest > FRAME_ALLOCATION_BUDGET or collections > 0
+                       or surfaces > 0)
+        if failed:
+            raise SystemExit(1)
+        return
+
+    if args.viewports:
+        for map_name, size, one_call, separate, per_viewport, same in \
+                bench_viewports(args.maps, args.sizes, args.viewports,
+                                args.frames, args.backend, args.threads,
+                                args.packed, args.tiled):
+            print(f'{map_name:<8} {size:<9} one call {one_call:7.3f} ms   '
+                  f'separate {separate:7.3f} ms   per viewport '
+                  f"{' '.join(f'{ms:.3f}' for ms in per_viewport)} ms   "
+                  f"{'same pixels' if same else 'DIFFERENT PIXELS'}")
+        return
+
+    if args.check:
+        mismatches = check_backends(args.maps, args.sizes, args.paths,
+                                    packed=args.packed, tiled=args.tiled,
+                                    indexed=args.indexed,
+                                    texture_budget=texture_budget)
+        for map_name, size, backend, count in mismatches:
+            print(f'{map_name:<8} {size:<9} {backend:<15} {count} differing pixels')
+        if any(count for *_, count in mismatches):
+            raise SystemExit(1)
+        return
+
+    warmup, results = bench(args.maps, args.sizes, args.paths, args.frames,
+                            args.full_frame, args.backend, args.threads,
+                            args.packed, args.tiled, args.billboards,
+                            args.preallocate, args.indexed, texture_budget)
+    print_results(warmup, results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'warmup': warmup, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import numpy as np
+from math import sin, cos
+
+
+
+def project(game, pos, size, viewport=None):
+    """
+    project sprites standing on the ground into the game screen with the
+    frustum Mode7 renders with. pos are their bottom centers and size their
+    (width, height), in world units. Return the rows of the visible ones,
+    sorted from far to near, together with their screen rectangles as
+    (left, top, width, height). With a Viewport, they are projected with
+    its camera into its rectangle instead of the player's full screen view
+    """
+    mode7 = game.map
+    if viewport is None:
+        cam_x, cam_y, angle = game.player.view(game.alpha)
+        left, top, screen_w, screen_h = game.game_screen_rect
+        mirror = False
+    else:
+        cam_x, cam_y, angle = viewport.view(game.alpha)
+        left, top, screen_w, screen_h = viewport.rect
+        mirror = viewport.mirror
+    horizon_offset = int(screen_h * game.HORIZON)
+    cos_a, sin_a = cos(angle), sin(angle)
+
+    # vector from the camera to the nearest repetition of each object
+    d = pos - (cam_x, cam_y)
+    d -= np.floor(d + 0.5)
+    fwd = d[:, 0] * cos_a + d[:, 1] * sin_a
+    # distance along the frustum edges of the scanline the object is on
+    distance = fwd / cos(mode7.fov_half)
+    rows = np.flatnonzero(distance > mode7.near + 1e-9)
+    if len(rows) == 0:
+        return rows, np.zeros((0, 4), dtype=int)
+
+    distance = distance[rows]
+    side = -d[rows, 0] * sin_a + d[rows, 1] * cos_a
+    # invert the per-scanline distance of perspective_tables
+    depth = (mode7.far - mode7.near) / (distance - mode7.near)
+    y = (depth - 0.0000001) * screen_h + horizon_offset
+    half = distance * sin(mode7.fov_half)
+    x = (side + half) / (2 * half) * screen_w
+    if mirror:
+        x = screen_w - x
+    # world units per pixel on that scanline
+    step = 2 * half / screen_w
+    w = size[rows, 0] / step
+    h = size[rows, 1] / step
+
+    visible = ((y >= horizon_offset) & (y - h < screen_h)
+               & (x + w / 2 > 0) & (x - w / 2 < screen_w)
+               & (w >= 1) & (w < screen_w * 4))
+    order = np.argsort(-distance[visible], kind='stable')
+    rects = np.column_stack((x - w / 2 + left, y - h + top, w, h))[visible][order]
+    return rows[visible][order], rects.astype(int)
+
+
+
+class Billboards:
+    """
+    world objects (bushes, cones, signs) that are drawn as upright sprites
+    on top of the Mode7 ground. All of them are kept in arrays and projected
+    into screen space together, with the same frustum Mode7 renders with,
+    so only the visible ones cost anything beyond a few array operations
+    """
+    def __init__(self, game):
+        self.game = game
+        self.images = []
+        # bottom center and size of each billboard in world units (the map
+        # texture repeats every 1.0 units)
+        self.pos = np.zeros((0, 2))
+        self.size = np.zeros((0, 2))
+        self.image = np.zeros(0, dtype=np.intp)
+        # billboards drawn in the last frame
+        self.visible = 0
+
+
+    def __len__(self):
+        return len(self.pos)
+
+
+    def add(self, positions, image, sizes=None):
+        """
+        add billboards showing image, positions are their bottom centers in
+        map pixels and sizes their (width, height) in map pixels (default:
+        the size of the image)
+        """
+        map_size = np.array(self.game.map.size, dtype=float)
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        if sizes is None:
+            sizes = np.tile(image.get_size(), (len(positions), 1))
+        sizes = np.asarray(sizes, dtype=float).reshape(-1, 2)
+
+        if image not in self.images:
+            self.images.append(image)
+        self.pos = np.concatenate((self.pos, positions / map_size))
+        self.size = np.concatenate((self.size, sizes / map_size))
+        self.image = np.concatenate(
+                (self.image, np.full(len(positions), self.images.index(image))))
+
+
+    def add_objects(self, arrays, images):
+        """
+        add the map objects from load_objects whose type is a key of images
+        (a dict of type name to Surface)
+        """
+        for object_type, image in images.items():
+            rects = arrays['object_rect'][arrays['object_type'] == object_type]
+            sizes = rects[:, 2:].copy()
+            # objects without a size (points) use the size of the image
+            empty = (sizes <= 0).any(axis=1)
+            sizes[empty] = image.get_size()
+            positions = np.column_stack((rects[:, 0] + sizes[:, 0] / 2,
+                                         rects[:, 1] + rects[:, 3]))
+            positions[empty] = rects[empty, :2]
+            self.add(positions, image, sizes)
+
+
+    def project(self, viewport=None):
+        """
+        return the rows and screen rectangles of the visible billboards
+        """
+        return project(self.game, self.pos, self.size, viewport)
+
+
+    def draw(self, screen, viewport=None):
+        if len(self.pos) == 0:
+            return
+        rows, rects = self.project(viewport)
+        self.visible = len(rows)
+        cache = self.game.sprite_cache
+        screen.blits([(cache.get(self.images[self.image[row]], (w, h)), (x, y))
+                      for row, (x, y, w, h) in zip(rows.tolist(), rects.tolist())],
+                     doreturn=False)
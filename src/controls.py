@@ -0,0 +1,35 @@
+import pygame as pg
+from enum import IntFlag
+
+
+
+class Input(IntFlag):
+    """
+    the buttons the kart reacts to during one simulation step. Being a
+    bit field, the state of all of them fits in a single byte
+    """
+    NONE = 0
+    ACCELERATE = 1
+    BRAKE = 2
+    LEFT = 4
+    RIGHT = 8
+
+
+KEYS = {
+    Input.ACCELERATE: pg.K_w,
+    Input.BRAKE: pg.K_s,
+    Input.LEFT: pg.K_a,
+    Input.RIGHT: pg.K_d
+}
+
+
+def read_keyboard():
+    """
+    return the Input currently held down on the keyboard
+    """
+    keys = pg.key.get_pressed()
+    inputs = Input.NONE
+    for button, key in KEYS.items():
+        if keys[key]:
+            inputs |= button
+    return inputs
@@ -0,0 +1,251 @@
+"""
+Headless frame renderer for datasets
+
+Renders Mode7 frames from a list of camera poses without a window, spread
+over a pool of worker processes. The poses come from a file (.npy or
+.csv with one x, y, angle row per frame) or from the player of a
+recorded race. The map texture is baked once and saved to a temporary
+folder, the workers memory-map it, so all of them read the same pages.
+Every worker renders whole chunks of frames and writes them to disk
+itself, so frames are never sent between processes:
+
+    python -m src.dataset --map track2 --poses poses.csv --out frames
+    python -m src.dataset --replay race.m7r --every 2 --format npz --out frames
+
+The output folder gets one file per chunk with the frames as a
+(frames, height, width, 3) uint8 array (the .npz files also hold the
+poses of their frames), poses.npy with all poses and dataset.json
+describing the set. The chunk files of an earlier run into the same
+folder are deleted first, other files are left alone.
+"""
+import os
+# the dummy video driver has to be selected before pygame is initialized
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import json
+import multiprocessing
+import re
+import tempfile
+import time
+from math import sin, cos
+from os import path
+
+import numpy as np
+
+from src.render import BACKENDS, select_backend
+
+
+FORMATS = ('npy', 'npz')
+# the names of the chunk files, and of the temporary files they are
+# written to
+CHUNK_NAME = 'chunk_{:05}.{}'
+CHUNK_FILE = re.compile(r'chunk_\d{5}\.(npy|npz)(\.tmp)?')
+
+# the render state of a worker process, set by init_worker
+worker = {}
+
+
+def parse_size(text):
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+def load_poses(filename):
+    """
+    return the (frames, 3) camera poses (x, y, angle) in a .npy file or a
+    comma separated text file. Lines starting with # are skipped
+    """
+    if filename.endswith('.npy'):
+        poses = np.load(filename)
+    else:
+        poses = np.loadtxt(filename, delimiter=',', ndmin=2)
+    if poses.ndim != 2 or poses.shape[1] != 3:
+        raise ValueError(f'{filename} must have 3 columns (x, y, angle), '
+                         f'not shape {poses.shape}')
+    return poses.astype(np.float64)
+
+
+def replay_poses(game, replay, every=1):
+    """
+    play replay in game and return the player's camera pose after every
+    every-th simulation step
+    """
+    replay.seek(game, replay.start_tick)
+    poses = []
+    while game.tick < replay.end_tick:
+        game.simulate(min(every, replay.end_tick - game.tick))
+        poses.append(game.player.view())
+    return np.array(poses, dtype=np.float64).reshape(-1, 3)
+
+
+def init_worker(texture_files, texture_kind, tables, sky, backend):
+    """
+    called once in every worker process: memory-map the textures and
+    select the render backend. Each worker renders on one thread, the
+    pool spreads the work over the cores
+    """
+    # copy-on-write like MapCache, read-only arrays would make numba
+    # compile the kernel again for a different array type
+    worker['textures'] = tuple(np.load(filename, mmap_mode='c')
+                               for filename in texture_files)
+    worker['kind'] = texture_kind
+    worker['tables'] = tables
+    worker['sky'] = sky
+    worker['backend'] = select_backend(backend, threads=1)
+
+
+def render_chunk(task):
+    """
+    render the poses of one chunk and write them to filename. Return the
+    chunk index, the number of frames and the seconds spent rendering
+    """
+    index, poses, filename, compress = task
+    start = time.perf_counter()
+    sky = worker['sky']
+    row_fwd = worker['tables'][0]
+    h, w = len(sky) + len(row_fwd), sky.shape[1]
+    frames = np.empty((len(poses), h, w, 3), dtype=np.uint8)
+    frames[:, :len(sky)] = sky
+    for frame, (x, y, angle) in zip(frames, poses.tolist()):
+        # the kernels index the screen (x, y, channel)
+        worker['backend'].render(worker['kind'], frame.transpose(1, 0, 2),
+                                 *worker['textures'], *worker['tables'],
+                                 x, y, cos(angle), sin(angle))
+    seconds = time.perf_counter() - start
+    # written under a temporary name, so a chunk file is always complete
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        if filename.endswith('.npy'):
+            np.save(f, frames)
+        elif compress:
+            np.savez_compressed(f, frames=frames, poses=poses)
+        else:
+            np.savez(f, frames=frames, poses=poses)
+    os.replace(tmp, filename)
+    return index, len(poses), seconds
+
+
+def clear_chunks(out):
+    """
+    delete the chunk files in the folder out, e.g. of an earlier dataset
+    with more frames or another format, and return how many there were
+    """
+    names = [name for name in os.listdir(out) if CHUNK_FILE.fullmatch(name)]
+    for name in names:
+        os.remove(path.join(out, name))
+    return len(names)
+
+
+def render_dataset(game, poses, out, workers=None, chunk=256, fmt='npy',
+                   compress=False, backend='auto'):
+    """
+    render a frame of game.map at the resolution of game.game_screen for
+    every pose and write them to the folder out in chunks of chunk frames.
+    Return a dict with the counts and times, which is also written to
+    out/dataset.json. Chunk files already in out are deleted
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'unknown format {fmt!r}, choose one of {", ".join(FORMATS)}')
+    import pygame as pg
+    workers = workers or os.cpu_count()
+    os.makedirs(out, exist_ok=True)
+    clear_chunks(out)
+    mode7 = game.map
+    row_fwd, row_half, row_step, horizon_offset = mode7.perspective_tables()
+    w, h = game.game_screen_rect.size
+    sky = np.ascontiguousarray(pg.surfarray.array3d(game.background).transpose(1, 0, 2))
+    tasks = []
+    for index, first in enumerate(range(0, len(poses), chunk)):
+        filename = path.join(out, CHUNK_NAME.format(index, fmt))
+        tasks.append((index, poses[first:first + chunk], filename, compress))
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as texture_dir:
+        texture_files = []
+        for i, texture in enumerate(mode7.textures):
+            filename = path.join(texture_dir, f'texture{i}.npy')
+            np.save(filename, np.ascontiguousarray(texture))
+            texture_files.append(filename)
+        # spawn instead of fork, the parent has pygame and maybe numba
+        # threads running
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers, init_worker,
+                          (texture_files, mode7.texture_kind,
+                           (row_fwd, row_half, row_step, horizon_offset),
+                           sky, backend)) as pool:
+            render_seconds = 0
+            for index, frames, seconds in pool.imap_unordered(render_chunk, tasks):
+                render_seconds += seconds
+    seconds = time.perf_counter() - start
+
+    np.save(path.join(out, 'poses.npy'), poses)
+    info = {
+        'map': game.map_name or 'grid',
+        'size': [w, h],
+        'horizon': horizon_offset,
+        'frames': len(poses),
+        'chunk': chunk,
+        'files': [path.basename(task[2]) for task in tasks],
+        'workers': workers,
+        'seconds': seconds,
+        'fps': len(poses) / seconds if seconds else 0,
+        # rendering only, summed over all workers
+        'render_seconds': render_seconds
+    }
+    with open(path.join(out, 'dataset.json'), 'w') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--map', default='track2',
+                        help="tmx map name, 'grid' for the procedural texture")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--poses', metavar='FILE',
+                        help='.npy or .csv file with one x, y, angle row per frame')
+    source.add_argument('--replay', metavar='FILE',
+                        help='render the player camera of a recorded race')
+    parser.add_argument('--every', type=int, default=1, metavar='STEPS',
+                        help='with --replay, render every STEPS-th simulation step')
+    parser.add_argument('--size', type=parse_size, default=(200, 150))
+    parser.add_argument('--tiled', action='store_true',
+                        help='sample the map through its tile grid and atlas')
+    parser.add_argument('--out', required=True, help='output folder')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--chunk', type=int, default=256, metavar='FRAMES',
+                        help='frames per output file')
+    parser.add_argument('--format', choices=FORMATS, default='npy')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the .npz files')
+    parser.add_argument('--backend', choices=('auto',) + BACKENDS, default='auto',
+                        help='render backend of the workers, each of them '
+                             'renders on one thread')
+    args = parser.parse_args(argv)
+
+    from src.game import Game
+    from src.replay import Replay
+
+    map_name = None if args.map == 'grid' else args.map
+    replay = None
+    if args.replay:
+        replay = Replay(args.replay)
+        map_name = replay.map_name
+    game = Game(map_name=map_name, screen_size=args.size, headless=True,
+                tiled=args.tiled, seed=replay.seed if replay else None)
+    if replay:
+        poses = replay_poses(game, replay, args.every)
+    else:
+        poses = load_poses(args.poses)
+    info = render_dataset(game, poses, args.out, args.workers, args.chunk,
+                          args.format, args.compress, args.backend)
+    print(f"{info['frames']} frames of {args.size[0]}x{args.size[1]} in "
+          f"{len(info['files'])} files, {info['seconds']:.2f} s with "
+          f"{info['workers']} workers ({info['fps']:.0f} frames/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+import numpy as np
+
+from src.billboard import project
+from src.controls import Input
+from src.surface import DRAG, ACCELERATION, BLOCKING, surface_at
+
+
+# kart image indices, the middle one drives straight and the turning
+# animation moves outwards (see LEFT and RIGHT in src.sprites)
+STRAIGHT_FRAME = 5
+LEFT_DIR = 0
+RIGHT_DIR = 1
+
+TURN_FORCE = 20 # how much the angle changes when turning
+REVERSE_TURN_FORCE = 50
+STEER_ANIM_SPEED = 10 # turning animation speed
+MAX_STEER_TIME = 0.6
+REVERSE_FACTOR = -0.4
+
+# the Input bits as plain ints for the kernels, numba can't use the enum
+ACCELERATE = int(Input.ACCELERATE)
+BRAKE = int(Input.BRAKE)
+LEFT = int(Input.LEFT)
+RIGHT = int(Input.RIGHT)
+
+
+# maps without surfaces are driven on like a road
+ROAD_GRID = np.zeros((1, 1), dtype=np.uint8)
+STEP_BACKENDS = ('numba', 'numpy')
+
+
+def step_karts_numpy(pos, vel, angle, steer_time, lastdir, moving, frame,
+                     inputs, speed, grid, drag, acceleration, blocking,
+                     ground_offset, dt):
+    """
+    advance the karts in the given arrays (one row per kart) by one step,
+    with the handling the player's kart always had. drag, acceleration and
+    blocking are indexed by the surface classes of grid
+    """
+    left = (inputs & LEFT) != 0
+    right = ((inputs & RIGHT) != 0) & ~left
+    turning = left | right
+    turn_force = np.where(moving == 1, TURN_FORCE, REVERSE_TURN_FORCE)
+    current_speed = np.hypot(vel[:, 0], vel[:, 1])
+
+    # steer, the image index is capped at 4 (len of animation minus 2)
+    index = np.minimum(4, (steer_time * STEER_ANIM_SPEED).astype(np.intp))
+    # the steering time starts over when the direction changes
+    steer_time[(left & (lastdir == RIGHT_DIR))
+               | (right & (lastdir == LEFT_DIR))] = 0
+    steer_time += np.where(turning, dt, -dt)
+    direction = np.where(left, -1, np.where(right, 1, 0))
+    angle += direction * turn_force * dt * current_speed * moving
+    lastdir[left] = LEFT_DIR
+    lastdir[right] = RIGHT_DIR
+    # the image turns the other way when driving backwards, the first
+    # turning image follows the straight one
+    image_dir = np.where(lastdir == LEFT_DIR, -1, 1) * moving
+    frame[:] = STRAIGHT_FRAME + image_dir * (index + turning)
+    np.clip(steer_time, 0, MAX_STEER_TIME, out=steer_time)
+
+    # move forward or backwards
+    accelerate = (inputs & ACCELERATE) != 0
+    brake = ((inputs & BRAKE) != 0) & ~accelerate
+    moving[accelerate] = 1
+    moving[brake] = -1
+    acc = np.where(accelerate, speed, np.where(brake, speed * REVERSE_FACTOR, 0))
+
+    # grip and acceleration depend on the surface under the kart
+    ground_x = pos[:, 0] + ground_offset * np.cos(angle)
+    ground_y = pos[:, 1] + ground_offset * np.sin(angle)
+    kind = surface_at(grid, ground_x, ground_y)
+    acc *= acceleration[kind]
+    vel[:, 0] += acc * np.cos(angle) * dt
+    vel[:, 1] += acc * np.sin(angle) * dt
+
+    new_kind = surface_at(grid, ground_x + vel[:, 0] * dt,
+                          ground_y + vel[:, 1] * dt)
+    # bounce off walls and the edge of the map, moving within blocking cells
+    # is allowed so that a kart starting out of bounds is not stuck
+    blocked = blocking[new_kind] & ~blocking[kind]
+    vel[blocked] *= -0.5
+    pos[~blocked] += vel[~blocked] * dt
+    vel *= drag[kind][:, None]
+
+
+def select_step(name='auto'):
+    """
+    return the kart physics kernel of one of STEP_BACKENDS, 'auto' picks
+    numba if it can be imported
+    """
+    if name != 'auto' and name not in STEP_BACKENDS:
+        raise ValueError(f'unknown physics backend {name!r}, '
+                         f'choose one of {", ".join(STEP_BACKENDS)} or auto')
+    if name != 'numpy':
+        try:
+            from src import fleet_numba
+            return fleet_numba.step_karts
+        except ImportError as error:
+            if name != 'auto':
+                print(f'Warning: Numba cannot be imported ({error}), cannot use '
+                      'the numba physics backend')
+    return step_karts_numpy
+
+
+def warmup_step(kernel):
+    """
+    call kernel once with a single kart, so that numba compiles it (or
+    loads it from its cache) before the first step
+    """
+    kernel(np.zeros((1, 2)), np.zeros((1, 2)), np.zeros(1), np.zeros(1),
+           np.zeros(1, np.int8), np.ones(1, np.int8),
+           np.zeros(1, np.intp), np.zeros(1, np.uint8), np.zeros(1),
+           ROAD_GRID, DRAG, ACCELERATION, BLOCKING, 0.0, 0.0)
+
+
+
+class KartFleet:
+    """
+    the state of all karts (the player and the opponents) in arrays, one
+    row per kart, so that a whole field of karts is advanced with a few
+    array operations per step. The handling is the same for every kart,
+    row 0 is the player
+    """
+    def __init__(self, game, capacity=8, backend='auto'):
+        """
+        backend is one of STEP_BACKENDS or 'auto'
+        """
+        self.game = game
+        self.kernel = select_step(backend)
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.angle = np.zeros(capacity)
+        # pose at the start of the step, for interpolating the camera
+        self.prev_pos = np.zeros((capacity, 2))
+        self.prev_angle = np.zeros(capacity)
+        self.speed = np.zeros(capacity)
+        self.steer_time = np.zeros(capacity)
+        self.lastdir = np.zeros(capacity, dtype=np.int8)
+        self.moving = np.ones(capacity, dtype=np.int8) # 1 forward, -1 backwards
+        self.frame = np.full(capacity, STRAIGHT_FRAME, dtype=np.intp)
+        # Input of every kart for the next step, row 0 is set by the game
+        self.inputs = np.zeros(capacity, dtype=np.uint8)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def grow(self, capacity):
+        for name in ('pos', 'vel', 'angle', 'prev_pos', 'prev_angle', 'speed',
+                     'steer_time', 'lastdir', 'moving', 'frame', 'inputs'):
+            old = getattr(self, name)
+            new = np.resize(old, (capacity,) + old.shape[1:])
+            new[len(old):] = old[0] if name in ('moving', 'frame') else 0
+            setattr(self, name, new)
+
+
+    def add(self, pos, angle, speed=0.5):
+        """
+        add a kart standing at pos and return its row
+        """
+        if self.count == len(self.pos):
+            self.grow(len(self.pos) * 2)
+        row = self.count
+        self.count += 1
+        self.pos[row] = self.prev_pos[row] = pos
+        self.angle[row] = self.prev_angle[row] = angle
+        self.vel[row] = 0
+        self.speed[row] = speed
+        self.steer_time[row] = 0
+        self.lastdir[row] = LEFT_DIR
+        self.moving[row] = 1
+        self.frame[row] = STRAIGHT_FRAME
+        self.inputs[row] = Input.NONE
+        return row
+
+
+    def view(self, row, alpha=1):
+        """
+        return the (x, y, angle) of a kart interpolated between the previous
+        and the current step
+        """
+        if alpha >= 1:
+            return self.pos[row, 0], self.pos[row, 1], self.angle[row]
+        pos = self.prev_pos[row] + (self.pos[row] - self.prev_pos[row]) * alpha
+        angle = (self.prev_angle[row]
+                 + (self.angle[row] - self.prev_angle[row]) * alpha)
+        return pos[0], pos[1], angle
+
+
+    def ground_pos(self):
+        """
+        return the world positions under the kart sprites, which are drawn
+        ahead of the kart positions (the player's is the camera position)
+        """
+        n = self.count
+        offset = self.game.player.ground_distance()
+        angle = self.angle[:n]
+        return self.pos[:n] + offset * np.column_stack((np.cos(angle),
+                                                        np.sin(angle)))
+
+
+    def step(self, dt):
+        """
+        advance all karts by one step with their current inputs, they only
+        move once the race has started
+        """
+        n = self.count
+        self.prev_pos[:n] = self.pos[:n]
+        self.prev_angle[:n] = self.angle[:n]
+        if not self.game.started:
+            return
+        surface = self.game.surface
+        grid = ROAD_GRID if surface is None else surface.grid
+        self.kernel(self.pos[:n], self.vel[:n], self.angle[:n],
+                    self.steer_time[:n], self.lastdir[:n], self.moving[:n],
+                    self.frame[:n], self.inputs[:n], self.speed[:n], grid,
+                    DRAG, ACCELERATION, BLOCKING,
+                    self.game.player.ground_distance(), dt)
+
+
+    def draw(self, screen, viewport=None):
+        """
+        draw the opponents as sprites standing on the ground, at the scale
+        of the player's kart. The player (row 0) is drawn by its sprite.
+        With a Viewport, all karts but the one it follows are drawn into it.
+        Return the rects of screen that were drawn to
+        """
+        if self.count < 2:
+            return []
+        game = self.game
+        own = game.player.row if viewport is None else viewport.row
+        images = game.player_images
+        # world size of a kart image, from the size of the player's sprite
+        # on the scanline it is drawn on
+        row_step = game.map.perspective_tables(game.layout_size)[2]
+        step = row_step[game.player.ground_row()]
+        size = np.tile(np.array(images[0].get_size()) * step,
+                       (self.count - 1, 1))
+        others = np.delete(np.arange(self.count), own)
+        rows, rects = project(game, self.ground_pos()[others], size, viewport)
+        frames = self.frame[others]
+        cache = game.sprite_cache
+        return screen.blits([(cache.get(images[frames[row]], (w, h)), (x, y))
+                             for row, (x, y, w, h)
+                             in zip(rows.tolist(), rects.tolist())])
@@ -0,0 +1,81 @@
+"""
+Numba-compiled kart physics. This module imports numba unconditionally,
+use src.fleet.select_step instead of importing it directly
+"""
+from math import sin, cos, hypot
+
+from numba import njit
+
+from src.fleet import (STRAIGHT_FRAME, LEFT_DIR, RIGHT_DIR, TURN_FORCE,
+                       REVERSE_TURN_FORCE, STEER_ANIM_SPEED, MAX_STEER_TIME,
+                       REVERSE_FACTOR, ACCELERATE, BRAKE, LEFT, RIGHT)
+
+
+@njit(cache=True)
+def surface_at(grid, x, y):
+    """
+    src.surface.surface_at for one position
+    """
+    rows, cols = grid.shape
+    return grid[int((y % 1) * rows) % rows, int((x % 1) * cols) % cols]
+
+
+@njit(cache=True)
+def step_karts(pos, vel, angle, steer_time, lastdir, moving, frame, inputs,
+               speed, grid, drag, acceleration, blocking, ground_offset, dt):
+    """
+    same as src.fleet.step_karts_numpy, one kart after the other. The
+    operations are done in the same order, so both give the same results
+    """
+    for i in range(pos.shape[0]):
+        left = (inputs[i] & LEFT) != 0
+        right = (inputs[i] & RIGHT) != 0 and not left
+        turning = left or right
+        turn_force = TURN_FORCE if moving[i] == 1 else REVERSE_TURN_FORCE
+        current_speed = hypot(vel[i, 0], vel[i, 1])
+
+        # steer
+        index = min(4, int(steer_time[i] * STEER_ANIM_SPEED))
+        if (left and lastdir[i] == RIGHT_DIR) or (right and lastdir[i] == LEFT_DIR):
+            steer_time[i] = 0
+        steer_time[i] += dt if turning else -dt
+        direction = -1 if left else (1 if right else 0)
+        angle[i] += direction * turn_force * dt * current_speed * moving[i]
+        if left:
+            lastdir[i] = LEFT_DIR
+        elif right:
+            lastdir[i] = RIGHT_DIR
+        image_dir = (-1 if lastdir[i] == LEFT_DIR else 1) * moving[i]
+        frame[i] = STRAIGHT_FRAME + image_dir * (index + turning)
+        steer_time[i] = min(max(steer_time[i], 0), MAX_STEER_TIME)
+
+        # move forward or backwards
+        accelerate = (inputs[i] & ACCELERATE) != 0
+        brake = (inputs[i] & BRAKE) != 0 and not accelerate
+        acc = 0.0
+        if accelerate:
+            moving[i] = 1
+            acc = speed[i]
+        elif brake:
+            moving[i] = -1
+            acc = speed[i] * REVERSE_FACTOR
+
+        # grip and acceleration depend on the surface under the kart
+        ground_x = pos[i, 0] + ground_offset * cos(angle[i])
+        ground_y = pos[i, 1] + ground_offset * sin(angle[i])
+        kind = surface_at(grid, ground_x, ground_y)
+        acc *= acceleration[kind]
+        vel[i, 0] += acc * cos(angle[i]) * dt
+        vel[i, 1] += acc * sin(angle[i]) * dt
+
+        new_kind = surface_at(grid, ground_x + vel[i, 0] * dt,
+                              ground_y + vel[i, 1] * dt)
+        if blocking[new_kind] and not blocking[kind]:
+            # bounce off walls and the edge of the map
+            vel[i, 0] *= -0.5
+            vel[i, 1] *= -0.5
+        else:
+            pos[i, 0] += vel[i, 0] * dt
+            pos[i, 1] += vel[i, 1] * dt
+        vel[i, 0] *= drag[kind]
+        vel[i, 1] *= drag[kind]
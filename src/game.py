@@ -1,3 +1,6 @@
+import time
+import_start = time.perf_counter()
+
 import pygame as pg
 
 try:
@@ -5,21 +8,49 @@ try:
 except ModuleNotFoundError:
     print('Warning: Pytmx is not installed')
     
+import os
+import threading
 import traceback
+from fractions import Fraction
 from math import sin, cos, pi
 from os import path
 import numpy as np
-from numba import njit
 
+from src.billboard import Billboards
+from src.controls import Input, read_keyboard
+from src.fleet import KartFleet, select_step, warmup_step
+from src.laps import LapTimer, TriggerIndex
+from src.mapcache import MapCache, create_in_memory
+from src.paging import (PAGE_SIZE, FILL_STRIDE, PagedTexture, page_side,
+                        band_pages, split_pages, fill_texel)
+from src.render import (Backend, select_backend, perspective_tables,
+                        viewport_tables, NEAR, FAR, FOV_HALF)
+from src.particle import ParticleSystem
+from src.profiler import FrameProfiler
+from src.resolution import ResolutionController
 from src.sprites import Player, TrafficLight
+from src.spritecache import SpriteCache
+from src.surface import SurfaceGrid, load_surfaces
+
+# seconds spent importing the modules above (numba is imported later,
+# together with the kernel warm-up)
+IMPORT_TIME = time.perf_counter() - import_start
+
+# a camera that moved less than this since the last render (in world units
+# or radians) counts as static, a kart rolling out creeps forward for a
+# long time. It is a few millionths of a texel of the 3200 pixel tracks
+STATIC_EPSILON = 1e-9
+
+# colors that quantize matches to the palette at once
+QUANTIZE_CHUNK = 4096
 
 
 
 def load_map(folder, name):
     """
     load a Tiled map in .tmx format and return a background image Surface, 
-    map objects as a TiledObjectGroup and layer_data as a list of 2D arrays
-    with tile indices
+    layer_data as a list of 2D arrays with tile indices, the map objects
+    as a dict of arrays (see load_objects) and the surface class grid
     """
     tiled_map = load_pygame(path.join(folder, f'{name}.tmx'))
     # create empty surface based on tile map dimensions
@@ -34,35 +65,326 @@ def load_map(folder, name):
                 if image:
                     bg_image.blit(image, (x * tiled_map.tilewidth, 
                                           y * tiled_map.tileheight))
-    return bg_image, layer_data
+    return bg_image, layer_data, load_objects(tiled_map), load_surfaces(tiled_map)
+
+
+def load_map_pages(folder, name, create, packed_format=None, indexed=False):
+    """
+    load a Tiled map like load_map, but bake it straight into the texture
+    pages of a paged map (see src.paging) one band of pages at a time, so
+    neither the map Surface nor its texture is ever in memory as a whole.
+    create(key, shape, dtype) returns the array the pages are written to,
+    e.g. a memory-mapped file of the map cache (see MapCache.load). Return
+    the arrays of a paged map, like bake_map
+    """
+    tiled_map = load_pygame(path.join(folder, f'{name}.tmx'))
+    width = tiled_map.width * tiled_map.tilewidth
+    height = tiled_map.height * tiled_map.tileheight
+    size = page_side(height, width)
+    rows = height // size
+    # the tiles blitted into every band, in layer order
+    bands = [[] for row in range(rows)]
+    for layer in tiled_map.layers:
+        if hasattr(layer, 'data'):
+            for x, y, image in layer.tiles():
+                if image:
+                    top = y * tiled_map.tileheight
+                    last = min((top + image.get_height() - 1) // size, rows - 1)
+                    for row in range(top // size, last + 1):
+                        bands[row].append((image, (x * tiled_map.tilewidth,
+                                                   top - row * size)))
+    band_image = pg.Surface((width, size))
+
+    def render_band(row):
+        band_image.fill(pg.Color('black'))
+        band_image.blits(bands[row], doreturn=False)
+        return image_to_texture(band_image, packed_format)
+
+    arrays = {}
+    if indexed:
+        # the palette depends on the colors of the whole map, so the bands
+        # are rendered twice instead of keeping them
+        unique, counts = np.zeros(0, np.uint32), np.zeros(0)
+        for row in range(rows):
+            keys, key_counts = np.unique(color_keys(render_band(row)),
+                                         return_counts=True)
+            unique, inverse = np.unique(np.concatenate((unique, keys)),
+                                        return_inverse=True)
+            counts = np.bincount(inverse, np.concatenate((counts, key_counts)))
+        arrays['palette'], mapping = make_palette(unique, counts.astype(np.int64))
+
+    pages = None
+    samples = []
+    for row in range(rows):
+        band = render_band(row)
+        if indexed:
+            band = mapping[np.searchsorted(unique, color_keys(band))].reshape(
+                    band.shape[:-1] + (1,))
+        if pages is None:
+            pages = create('pages', (rows, width // size, size, size,
+                                     band.shape[-1]), band.dtype)
+        pages[row] = band_pages(band, size)
+        # the rows of the band in the sample of fill_texel, copied so the
+        # band is not kept
+        samples.append(band[-row * size % FILL_STRIDE::FILL_STRIDE,
+                            ::FILL_STRIDE].copy())
+    arrays.update({'pages': pages,
+                   'fill': fill_texel(np.concatenate(samples), stride=1),
+                   'surface': load_surfaces(tiled_map),
+                   **load_objects(tiled_map)})
+    return arrays
+
+
+def load_objects(tiled_map):
+    """
+    return the objects of all object layers of a loaded map as a dict of
+    arrays: 'object_type' and 'object_name' strings and 'object_rect' with
+    the (x, y, width, height) of each object in map pixels
+    """
+    objects = list(tiled_map.objects)
+    return {
+        'object_type': np.array([obj.type or '' for obj in objects], dtype=str),
+        'object_name': np.array([obj.name or '' for obj in objects], dtype=str),
+        'object_rect': np.array([(obj.x, obj.y, obj.width, obj.height)
+                                 for obj in objects], dtype=float).reshape(-1, 4)
+    }
+
+
+def load_tiles(folder, name):
+    """
+    load a Tiled map in .tmx format and return a tile index grid (one
+    integer per map cell) and the list of tile Surfaces it indexes, instead
+    of baking the whole map into one Surface. Cells that stack tiles from
+    several layers get their own pre-blitted tile. The map objects and the
+    surface grid are returned as the third and fourth value, like load_map
+    """
+    tiled_map = load_pygame(path.join(folder, f'{name}.tmx'))
+    tile_size = (tiled_map.tilewidth, tiled_map.tileheight)
+    layer_data = np.array([layer.data for layer in tiled_map.layers
+                           if hasattr(layer, 'data')], dtype=np.int64)
+    if len(layer_data) == 0:
+        layer_data = np.zeros((1, tiled_map.height, tiled_map.width), np.int64)
+    # every distinct stack of tile ids becomes one tile of the atlas
+    stacks = layer_data.reshape(len(layer_data), -1).T
+    combos, grid = np.unique(stacks, axis=0, return_inverse=True)
+    dtype = np.uint16 if len(combos) <= np.iinfo(np.uint16).max else np.uint32
+    grid = grid.astype(dtype).reshape(tiled_map.height, tiled_map.width)
+    
+    tile_images = []
+    for combo in combos:
+        tile = pg.Surface(tile_size)
+        for gid in combo:
+            image = tiled_map.get_tile_image_by_gid(gid) if gid else None
+            if image:
+                tile.blit(image, (0, 0))
+        tile_images.append(tile)
+    return grid, tile_images, load_objects(tiled_map), load_surfaces(tiled_map)
+
+
+def image_to_texture(image, packed_format=None):
+    """
+    convert a Surface to the (y, x, channel) array the Mode7 kernels sample.
+    If packed_format is a Surface, the image is converted to its pixel
+    format and stored as one uint32 per pixel, contiguously in (y, x) order
+    so that neighbouring pixels of a map row are neighbours in memory
+    """
+    if packed_format:
+        image = image.convert(packed_format)
+        texture = pg.surfarray.array2d(image).T.astype(np.uint32, order='C')
+        return texture[:, :, None]
+    return np.ascontiguousarray(pg.surfarray.array3d(image).transpose(1, 0, 2))
+
+
+def color_keys(texture):
+    """
+    return the colors of an RGB texture (..., 3) as one integer each, so
+    that unique sorts a flat array
+    """
+    pixels = texture.reshape(-1, 3)
+    return (pixels[:, 0].astype(np.uint32) << 16
+            | pixels[:, 1].astype(np.uint32) << 8 | pixels[:, 2])
+
+
+def quantize(texture, colors=256):
+    """
+    return an RGB texture (..., 3) as a uint8 texture (..., 1) of indices
+    into a palette of at most colors RGB entries, padded to colors rows.
+    Textures with more colors keep the most frequent ones, the others are
+    mapped to the closest of them
+    """
+    unique, inverse, counts = np.unique(color_keys(texture),
+                                        return_inverse=True, return_counts=True)
+    palette, mapping = make_palette(unique, counts, colors)
+    return mapping[inverse].reshape(texture.shape[:-1] + (1,)), palette
+
+
+def make_palette(unique, counts, colors=256):
+    """
+    return the palette of quantize for the sorted color_keys unique that
+    occur counts times, and the uint8 palette index of each of them
+    """
+    rgb = np.column_stack((unique >> 16, unique >> 8 & 255, unique & 255))
+    # the most frequent colors first
+    order = np.argsort(-counts, kind='stable')
+    palette = rgb[order[:colors]]
+    if len(unique) > colors:
+        # the closest palette entry of a block of colors at a time, so the
+        # distances take QUANTIZE_CHUNK x colors entries for any texture
+        # as |palette|^2 - 2 color.palette (|color|^2 doesn't change the
+        # closest entry), which is exact in float64 for 8 bit channels
+        rgb = rgb.astype(np.float64)
+        palette_rgb = palette.astype(np.float64)
+        norms = (palette_rgb ** 2).sum(axis=1)
+        mapping = np.empty(len(unique), np.intp)
+        for first in range(0, len(unique), QUANTIZE_CHUNK):
+            block = rgb[first:first + QUANTIZE_CHUNK]
+            distance = norms - 2 * block @ palette_rgb.T
+            mapping[first:first + len(block)] = np.argmin(distance, axis=1)
+    else:
+        mapping = np.empty(len(unique), np.intp)
+        mapping[order] = np.arange(len(unique))
+    padded = np.zeros((colors, 3), np.uint8)
+    padded[:len(palette)] = palette
+    return padded, mapping.astype(np.uint8)
 
 
 class Game:
 
     HORIZON = 0.2
+    # the simulation always advances in steps of 1 / TICK_RATE seconds
+    TICK_RATE = 60
+    STEP = 1 / TICK_RATE
+    # longest frame time that is caught up with, after a longer stall the
+    # simulation slows down instead of running hundreds of steps at once
+    MAX_FRAME_TIME = 0.25
 
-    def __init__(self):
+    def __init__(self, map_name='track2', screen_size=(200, 150),
+                 display_size=(800, 600), backend='auto', threads=None,
+                 packed=False, tiled=False, map_cache=True, headless=False,
+                 seed=None, mirror=False, profile=None, preallocate=True,
+                 frame_budget=None, indexed=False, dirty_rects=False,
+                 texture_budget=None):
+        """
+        map_name is the name of a .tmx file in the assets folder, or None
+        to use the procedural grid texture. screen_size is the internal
+        Mode7 render resolution that gets upscaled to display_size, and
+        the layout resolution that sprites are placed in.
+        backend, threads and packed are passed on to Mode7. If tiled is
+        True, the map is rendered from its tile grid instead of a bitmap.
+        If map_cache is True, the baked map is cached in assets/cache.
+        If headless is True, no window is opened and the game is only
+        simulated (see simulate), seed makes the random numbers repeatable.
+        If mirror is True, a rear-view mirror is shown at the top of the
+        screen (see viewports). If profile is a .csv or .json file name,
+        the stages of every frame are timed and written to it on exit.
+        If preallocate is True, the upscaled frame is written straight into
+        the display Surface instead of a new Surface every frame.
+        If frame_budget is given (in seconds), the render resolution is
+        scaled up and down so that frames take about that long to render
+        (see set_resolution).
+        If indexed is True, the map is stored as 8 bit palette indices and
+        Mode7 renders indices (see Mode7), this can't be combined with packed.
+        If dirty_rects is True, frames with a static camera only upscale
+        and update the parts of the window the sprites changed (see draw).
+        If texture_budget is given (in bytes), the map is split into pages
+        that are memory-mapped from the map cache and only the pages around
+        the camera are kept in memory (see src.paging), not with tiled.
+        
+        The render backend is imported and its kernel compiled in a
+        background thread while the assets load, startup_times holds how
+        long each step took
+        """
+        if packed and indexed:
+            raise ValueError('packed and indexed textures cannot be combined')
+        if tiled and texture_budget is not None:
+            raise ValueError('paged textures are split from the bitmap, '
+                             'they cannot be tiled')
+        init_start = time.perf_counter()
+        self.startup_times = {'imports': IMPORT_TIME}
+        self.headless = headless
+        if headless:
+            # nothing is rendered, so no kernel has to be compiled
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+            backend = 'numpy'
         pg.init()
         self.clock = pg.time.Clock()
-        self.display_screen = pg.display.set_mode((800, 600))
+        if packed:
+            # the packed renderer writes whole 32 bit pixels, so both
+            # screens use the same 32 bit format as the map texture
+            self.display_screen = pg.display.set_mode(display_size, 0, 32)
+            self.game_screen = pg.Surface(screen_size, 0, self.display_screen)
+        else:
+            self.display_screen = pg.display.set_mode(display_size)
+            self.game_screen = pg.Surface(screen_size)
         self.display_rect = self.display_screen.get_rect()
-        self.game_screen = pg.Surface((200, 150))
+        self.preallocate = preallocate
+        self.dirty_rects = dirty_rects
         self.game_screen_rect = self.game_screen.get_rect()
+        # the sky, ground and billboards of the last rendered camera, the
+        # sprites are drawn over them and erased with this copy
+        self.scene = pg.Surface(self.game_screen_rect.size, 0, self.game_screen)
+        self.scene_changed = True
+        # the game screen rects the sprites covered in the last frame
+        self.sprite_rects = []
+        self.overlay_shown = False
+        # sprites and HUD positions are given at the layout resolution and
+        # scaled by self.scale when they are drawn
+        self.layout_size = self.game_screen_rect.size
+        self.scale = 1
+        self.resolution = None
+        if frame_budget is not None:
+            max_scale = min(d / s for d, s in zip(display_size, screen_size))
+            self.resolution = ResolutionController(frame_budget,
+                                                   max_scale=max_scale)
+        
+        # paged textures are sampled like tiles
+        texture_kind = 'bitmap'
+        if (tiled and map_name) or texture_budget is not None:
+            texture_kind = 'tiled'
+        self.render_backend = backend
+        warmup_thread = threading.Thread(
+                target=self.warm_up,
+                args=(backend, threads, texture_kind, packed, mirror, indexed),
+                daemon=True)
+        warmup_thread.start()
+        
+        asset_start = time.perf_counter()
         # specify the directories for asset loading
         base_dir = path.dirname(__file__)
         assets_folder = path.join(base_dir, '..', 'assets')
+        self.map_cache = MapCache(assets_folder) if map_cache else None
 
-        bg_image = pg.image.load(path.join(assets_folder, 'clouds-4258726_640.jpg')).convert()
-        
-        # Calculate horizon position (must match Mode7.update())
-        horizon_y = int(self.game_screen.get_height() * self.HORIZON)
-        
-        # Scale image to fit width and height above horizon
-        self.background = pg.transform.scale(bg_image, 
-                                            (self.game_screen.get_width(), horizon_y))
+        self.sky_image = pg.image.load(
+                path.join(assets_folder, 'clouds-4258726_640.jpg')).convert()
+        self.scale_sky()
 
         self.fps = 60
+        self.map_name = map_name
+        if seed is None:
+            seed = int(np.random.default_rng().integers(2**63))
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        # buttons held during the current simulation step
+        self.inputs = Input.NONE
+        self.tick = 0
+        # src.replay Recorder that records and Replay that supplies the
+        # inputs of every step
+        self.recorder = None
+        self.replay = None
+        # called with the game before every step to set the inputs of the
+        # opponents in game.fleet
+        self.opponent_inputs = None
+        # fraction of a step between the last step and the rendered frame
+        self.alpha = 1
+        # Viewports that Mode7 renders in one kernel call instead of the
+        # player's full screen view, e.g. for split screen or mirrors
+        self.viewports = []
+        self.profile = profile
         self.all_sprites = pg.sprite.Group()
+        self.sprite_cache = SpriteCache()
+        self.profiler = FrameProfiler(enabled=profile is not None,
+                                      sprite_cache=self.sprite_cache)
+        self.particles = ParticleSystem(self)
         self.running = True
         
         player_image_strip = pg.image.load(
@@ -75,65 +397,522 @@ class Game:
         self.traffic_light_images = pg.image.load(
                 path.join(assets_folder, 'lights.png')).convert_alpha()
         self.bush_image = pg.image.load(
-                path.join(assets_folder, 'bush.png')).convert_alpha()  # TODO: unused
+                path.join(assets_folder, 'bush.png')).convert_alpha()
         
+        self.fleet = KartFleet(self)
         self.player = Player(self)
         self.traffic_light = TrafficLight(self, (100, 60))
+        self.startup_times['assets'] = time.perf_counter() - asset_start
+        
+        map_start = time.perf_counter()
+        arrays = None
+        if map_name is not None:
+            try:
+                arrays = self.bake_map(assets_folder, map_name, tiled, packed,
+                                       indexed, texture_budget is not None)
+            except Exception:
+                traceback.print_exc()
+        self.startup_times['map'] = time.perf_counter() - map_start
+        
+        # the kernel has to be ready before the map can be rendered
+        wait_start = time.perf_counter()
+        warmup_thread.join()
+        self.startup_times['jit wait'] = time.perf_counter() - wait_start
+        
+        mode7_options = {'backend': self.render_backend, 'threads': threads,
+                         'packed': packed, 'indexed': indexed,
+                         'texture_budget': texture_budget}
+        if arrays is None:
+            self.map = Mode7(self, **mode7_options)
+        else:
+            try:
+                if tiled:
+                    tiles = (arrays['grid'], arrays['atlas'])
+                    self.map = Mode7(self, tiles=tiles,
+                                     palette=arrays.get('palette'),
+                                     **mode7_options)
+                else:
+                    self.map = Mode7(self, texture=arrays.get('texture'),
+                                     pages=arrays.get('pages'),
+                                     fill=arrays.get('fill'),
+                                     palette=arrays.get('palette'),
+                                     **mode7_options)
+            except Exception:
+                traceback.print_exc()
+                self.map = Mode7(self, **mode7_options)
+        
+        # surface classes for the kart physics, None drives everywhere
+        self.surface = None
+        if arrays is not None and 'surface' in arrays:
+            self.surface = SurfaceGrid(arrays['surface'])
+        
+        self.billboards = Billboards(self)
+        if arrays is not None and 'object_type' in arrays:
+            self.billboards.add_objects(arrays, {'bush': self.bush_image})
+        
+        # finish line, checkpoints and triggers of the map (see src.laps)
+        self.laps = LapTimer(self)
+        if arrays is not None and 'object_type' in arrays:
+            self.laps.set_index(TriggerIndex.from_objects(arrays, self.map.size))
+        
+        if mirror:
+            w, h = self.game_screen_rect.size
+            horizon_y = int(h * self.HORIZON)
+            mirror_rect = pg.Rect(0, 2, int(w * 0.4), horizon_y - 4)
+            mirror_rect.centerx = w // 2
+            self.viewports = [Viewport(self, self.game_screen_rect),
+                              Viewport(self, mirror_rect, mirror=True)]
+            
+        self.started = False
+        self.startup_times['total'] = time.perf_counter() - init_start
+        
+    
+    def scale_sky(self):
+        """
+        scale the sky image to the width of the game screen and the height
+        above the horizon (must match Mode7.update())
+        """
+        horizon_y = int(self.game_screen_rect.h * self.HORIZON)
+        self.background = pg.transform.scale(
+                self.sky_image, (self.game_screen_rect.w, horizon_y))
+        
+    
+    def set_resolution(self, scale):
+        """
+        render at scale times the layout resolution from the next frame on.
+        The game screen, the sky and the viewports are rebuilt, the Mode7
+        tables follow the new screen size by themselves
+        """
+        size = tuple(max(int(round(s * scale)), 1) for s in self.layout_size)
+        if size == self.game_screen_rect.size:
+            return
+        self.game_screen = pg.Surface(size, 0, self.game_screen)
+        self.game_screen_rect = self.game_screen.get_rect()
+        self.scene = pg.Surface(size, 0, self.game_screen)
+        self.sprite_rects = []
+        self.scale = size[1] / self.layout_size[1]
+        self.scale_sky()
+        for viewport in self.viewports:
+            viewport.resize()
+        self.map.invalidate()
         
+    
+    def warm_up(self, backend, threads, texture_kind, packed, viewports=False,
+                indexed=False):
+        """
+        select the render backend and compile its kernel and the kart
+        physics kernel (or load them from the numba cache), runs in a
+        background thread during startup. If viewports is True, the
+        viewport kernel is compiled as well
+        """
+        start = time.perf_counter()
         try:
-            self.map_img, _ = load_map(folder=assets_folder, name='track2')
-            self.map = Mode7(self, self.map_img)
+            self.render_backend = select_backend(backend, threads)
+            # a small surface with the pixel format of the game screen
+            surface = pg.Surface((self.game_screen_rect.w, 2), 0, self.game_screen)
+            if indexed:
+                surface = pg.Surface(surface.get_size(), 0, 8)
+                screen_array = pg.surfarray.pixels2d(surface)[:, :, None]
+                pixel = (np.uint8, 1)
+            elif packed:
+                screen_array = pg.surfarray.pixels2d(surface)[:, :, None]
+                pixel = (np.uint32, 1)
+            else:
+                screen_array = pg.surfarray.pixels3d(surface)
+                pixel = (np.uint8, 3)
+            self.render_backend.warmup(texture_kind, screen_array, *pixel,
+                                       self.HORIZON)
+            if viewports:
+                self.render_backend.warmup_viewports(texture_kind, screen_array,
+                                                     *pixel, self.HORIZON)
+            del screen_array
+            warmup_step(select_step())
         except Exception:
+            # Mode7 will select the backend again and compile on first use
             traceback.print_exc()
-            self.map = Mode7(self)
-            
-        self.started = False
+        self.startup_times['jit'] = time.perf_counter() - start
+        
+    
+    def print_startup_report(self):
+        print('Startup times:')
+        for step, seconds in self.startup_times.items():
+            print(f'  {step:<10} {seconds * 1000:8.1f} ms')
+        
+    
+    def bake_map(self, folder, name, tiled, packed, indexed=False, paged=False):
+        """
+        return the texture arrays for map name, either from the map cache or
+        by loading and baking the .tmx file. Indexed maps also have a
+        'palette' array. Paged maps have their texture split into 'pages'
+        (see src.paging) and the 'fill' texel instead of a 'texture'
+        """
+        packed_format = self.game_screen if packed else None
+        
+        def bake(create):
+            if paged:
+                return load_map_pages(folder, name, create, packed_format,
+                                      indexed)
+            if tiled:
+                grid, tile_images, objects, surface = load_tiles(folder=folder,
+                                                                 name=name)
+                atlas = np.stack([image_to_texture(image, packed_format)
+                                  for image in tile_images])
+                arrays = {'grid': grid, 'atlas': atlas, 'surface': surface,
+                          **objects}
+            else:
+                map_img, _, objects, surface = load_map(folder=folder,
+                                                        name=name)
+                arrays = {'texture': image_to_texture(map_img, packed_format),
+                          'surface': surface, **objects}
+            if indexed:
+                key = 'atlas' if tiled else 'texture'
+                arrays[key], arrays['palette'] = quantize(arrays[key])
+            return arrays
+        
+        if self.map_cache is None:
+            return bake(create_in_memory)
+        # packed textures depend on the pixel format of the screen
+        variant = 'tiled' if tiled else 'bitmap'
+        if indexed:
+            variant += '-indexed'
+        if paged:
+            variant += f'-paged{PAGE_SIZE}'
+        if packed:
+            variant += '-packed-' + '-'.join(
+                    f'{m:x}' for m in self.game_screen.get_masks())
+        arrays = self.map_cache.load(name, variant, bake)
+        print(f"Map {name}: {'loaded from cache' if self.map_cache.hit else 'baked'}"
+              f' in {self.map_cache.load_time * 1000:.1f} ms')
+        return arrays
         
     
     def events(self):
         for event in pg.event.get():
             if event.type == pg.QUIT:
                 self.running = False
+            elif event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                self.profiler.toggle_overlay()
+        self.inputs = read_keyboard()
 
     
-    def update(self, dt):
-        self.game_screen.blit(self.background, (0, 0))
-        self.map.update(dt)
+    def step(self, dt=STEP):
+        """
+        advance the simulation by one fixed step, reading self.inputs
+        """
+        if self.replay is not None:
+            self.inputs = self.replay.input_at(self.tick)
+        if self.recorder is not None:
+            self.recorder.record(self)
+        self.fleet.inputs[self.player.row] = self.inputs
+        if self.opponent_inputs is not None:
+            self.opponent_inputs(self)
+        self.fleet.step(dt)
+        self.laps.step()
+        self.profiler.mark('kart physics')
         self.all_sprites.update(dt)
+        self.profiler.mark('sprite update')
+        self.particles.update(dt)
+        self.profiler.mark('particle update')
+        self.tick += 1
         
         if self.traffic_light.done:
             self.started = True
         
+    
+    def simulate(self, steps, inputs=None):
+        """
+        run steps simulation steps as fast as possible without rendering.
+        inputs is called with the game before every step and returns the
+        Input for that step, by default self.inputs is kept
+        """
+        for i in range(steps):
+            if inputs is not None:
+                self.inputs = inputs(self)
+            self.step(self.STEP)
+        
+    
+    def update(self, dt):
+        """
+        render the sky, the Mode7 ground and the billboards for the current
+        frame, dt is the real time since the last frame. They only depend
+        on the camera, so while it doesn't move (see Mode7.changed) they
+        are not rendered again, the sprites of the last frame are erased
+        with the copy in self.scene instead
+        """
+        self.scene_changed = self.map.changed()
+        if not self.scene_changed:
+            for rect in self.sprite_rects:
+                self.game_screen.blit(self.scene, rect, rect)
+            self.map.controls(dt)
+            self.profiler.mark('mode7')
+            return
+        if self.viewports:
+            for viewport in self.viewports:
+                self.game_screen.blit(viewport.sky, viewport.rect)
+        else:
+            self.game_screen.blit(self.background, (0, 0))
+        self.profiler.mark('sky')
+        self.map.update(dt)
+        self.profiler.mark('mode7')
+        if self.viewports:
+            for viewport in self.viewports:
+                self.game_screen.set_clip(viewport.rect)
+                self.billboards.draw(self.game_screen, viewport)
+            self.game_screen.set_clip(None)
+            for viewport in self.viewports:
+                if viewport.mirror:
+                    pg.draw.rect(self.game_screen, (40, 40, 40),
+                                 viewport.rect.inflate(2, 2), 1)
+        else:
+            self.billboards.draw(self.game_screen)
+        self.scene.blit(self.game_screen, (0, 0))
+        self.profiler.mark('sprite draw')
+        
 
     def draw(self):
+        """
+        draw the karts, sprites and particles over the scene and show the
+        frame. With dirty_rects, frames with an unchanged scene only
+        upscale and update the rects the sprites covered in this frame or
+        the last one
+        """
+        previous_rects = self.sprite_rects
+        rects = []
+        if self.viewports:
+            for viewport in self.viewports:
+                self.game_screen.set_clip(viewport.rect)
+                rects += self.fleet.draw(self.game_screen, viewport)
+            self.game_screen.set_clip(None)
+        else:
+            rects += self.fleet.draw(self.game_screen)
         for s in self.all_sprites:
-            s.draw(self.game_screen)
+            rects.append(s.draw(self.game_screen))
+        rects += self.particles.draw(self.game_screen)
+        self.sprite_rects = rects
+        self.profiler.mark('sprite draw')
         
-        transformed_screen = pg.transform.scale(self.game_screen,
-                                                self.display_rect.size)
-        self.display_screen.blit(transformed_screen, (0, 0))
+        overlay = self.profiler.overlay or self.overlay_shown
+        self.overlay_shown = self.profiler.overlay
+        if self.dirty_rects and not self.scene_changed and not overlay:
+            self.present(previous_rects + rects)
+            return
+        if self.preallocate:
+            pg.transform.scale(self.game_screen, self.display_rect.size,
+                               self.display_screen)
+        else:
+            transformed_screen = pg.transform.scale(self.game_screen,
+                                                    self.display_rect.size)
+            self.display_screen.blit(transformed_screen, (0, 0))
+        self.profiler.draw_overlay(self.display_screen)
+        self.profiler.mark('upscale')
         pg.display.update()
+        self.profiler.mark('display')
+        
+        
+    def present(self, rects):
+        """
+        upscale the game screen rects to the display and update only those
+        parts of the window. The rects are merged where they overlap and
+        grown to blocks of whole display pixels, so that the partial upscale
+        gives the same pixels as the full one
+        """
+        scale_x = Fraction(self.display_rect.w, self.game_screen_rect.w)
+        scale_y = Fraction(self.display_rect.h, self.game_screen_rect.h)
+        block_x, block_y = scale_x.denominator, scale_y.denominator
+        merged = []
+        for rect in rects:
+            left = rect.left // block_x * block_x
+            top = rect.top // block_y * block_y
+            # the right and bottom edges are rounded up
+            rect = pg.Rect(left, top, -((left - rect.right) // block_x) * block_x,
+                           -((top - rect.bottom) // block_y) * block_y)
+            rect = rect.clip(self.game_screen_rect)
+            if not rect:
+                continue
+            i = rect.collidelist(merged)
+            while i >= 0:
+                rect = rect.union(merged.pop(i))
+                i = rect.collidelist(merged)
+            merged.append(rect)
+        display_rects = []
+        for rect in merged:
+            display_rect = pg.Rect(int(rect.x * scale_x), int(rect.y * scale_y),
+                                   int(rect.w * scale_x), int(rect.h * scale_y))
+            pg.transform.scale(self.game_screen.subsurface(rect),
+                               display_rect.size,
+                               self.display_screen.subsurface(display_rect))
+            display_rects.append(display_rect)
+        self.profiler.mark('upscale')
+        pg.display.update(display_rects)
+        self.profiler.mark('display')
         
         
     def run(self):
         self.running = True
+        accumulator = 0
+        self.profiler.start()
         while self.running:
             delta_time = self.clock.tick(self.fps) / 1000
+            self.clock_start = time.perf_counter()
+            self.profiler.mark('wait')
             pg.display.set_caption(f'FPS: {round(self.clock.get_fps(), 2)}')
-            self.events()        
+            self.events()
+            self.profiler.mark('events')
+            # run as many fixed steps as fit into the time that passed,
+            # the remainder is carried over to the next frame
+            accumulator += min(delta_time, self.MAX_FRAME_TIME)
+            while accumulator >= self.STEP:
+                self.step(self.STEP)
+                accumulator -= self.STEP
+            self.alpha = accumulator / self.STEP
             self.update(delta_time)
             self.draw()
+            self.profiler.end_frame((len(self.all_sprites) + len(self.fleet) - 1,
+                                     self.billboards.visible, len(self.particles)))
+            if self.resolution is not None:
+                # the time since the frame started, without waiting for it
+                busy = time.perf_counter() - self.clock_start
+                scale = self.resolution.update(busy)
+                if scale is not None:
+                    self.set_resolution(scale)
         
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.profile is not None:
+            self.profiler.export(self.profile)
+        self.map.close()
         pg.quit()
         
         
         
+class Viewport:
+    """
+    a rectangle of the game screen that Mode7 renders from the camera of
+    one kart (a row of game.fleet). A mirror looks backwards and is
+    flipped horizontally, like a rear-view mirror
+    """
+    def __init__(self, game, rect, row=0, mirror=False):
+        self.game = game
+        self.rect = pg.Rect(rect)
+        if not game.game_screen_rect.contains(self.rect):
+            raise ValueError(f'viewport {self.rect} is not inside the game '
+                             f'screen {game.game_screen_rect}')
+        # the rectangle at the layout resolution, for resize
+        self.layout_rect = [v / game.scale for v in self.rect]
+        self.row = row
+        self.mirror = mirror
+        self.sky = pg.transform.scale(
+                game.sky_image, (self.rect.w, int(self.rect.h * game.HORIZON)))
+        
+    def resize(self):
+        """
+        follow a change of the game's render resolution
+        """
+        scale = self.game.scale
+        left, top, right, bottom = (round(v * scale) for v in (
+                self.layout_rect[0], self.layout_rect[1],
+                self.layout_rect[0] + self.layout_rect[2],
+                self.layout_rect[1] + self.layout_rect[3]))
+        self.rect = pg.Rect(left, top, right - left, bottom - top).clip(
+                self.game.game_screen_rect)
+        self.sky = pg.transform.scale(
+                self.game.sky_image, (self.rect.w, int(self.rect.h * self.game.HORIZON)))
+        
+    def view(self, alpha=1):
+        """
+        return the camera (x, y, angle) of the viewport, like Player.view
+        """
+        x, y, angle = self.game.fleet.view(self.row, alpha)
+        if self.mirror:
+            angle += pi
+        return x, y, angle
+        
+        
+        
 class Mode7:
-    def __init__(self, game, sprite=None, size=(1024, 1024)):
+    def __init__(self, game, sprite=None, size=(1024, 1024), backend='auto',
+                 threads=None, packed=False, tiles=None, texture=None,
+                 indexed=False, palette=None, texture_budget=None, pages=None,
+                 fill=None):
+        """
+        backend is one of the names in src.render.BACKENDS, 'auto' or a
+        Backend that was already selected.
+        threads limits the number of cores used by numba-parallel
+        (default: all of them). If packed is True, the texture is stored as
+        one uint32 per pixel in the format of game.game_screen, and frames
+        are written through pixels2d instead of pixels3d.
+        Instead of a sprite, the map can be given as a texture array (see
+        image_to_texture) or as a (grid, atlas) tuple, in that case the map
+        is sampled through the tile index grid from the atlas.
+        If indexed is True, the texture holds one uint8 palette index per
+        pixel (see quantize, RGB textures are quantized here unless their
+        palette is given). The kernels render indices into an 8 bit ground
+        Surface, which is converted to RGB by its palette when it is blitted
+        to the game screen, so set_palette changes every pixel for free.
+        If texture_budget is given (in bytes), the map is sampled through a
+        PagedTexture that keeps that many bytes of pages in memory. The
+        pages and their fill texel can be given instead of the texture
+        (see split_pages and fill_texel)
+        """
         self.game = game
+        if isinstance(backend, Backend):
+            self.backend = backend
+        else:
+            self.backend = select_backend(backend, threads)
+        self.packed = packed
+        self.indexed = indexed
+        # the 8 bit Surface indexed maps are rendered into, the palette of
+        # the map and the one in use
+        self.ground = None
+        self.palette = None
+        self.current_palette = None
+        
+        self.near = NEAR
+        self.far = FAR
+        self.fov_half = FOV_HALF
+        self.tables = {}
+        self.viewport_tables_key = None
+        # what the last rendered frame depended on, see changed
+        self.rendered = None
+        self.pager = None
+        
+        if tiles is not None:
+            self.grid, self.atlas = tiles
+            tile_h, tile_w = self.atlas.shape[1:3]
+            self.size = (self.grid.shape[1] * tile_w,
+                         self.grid.shape[0] * tile_h)
+            self.rect = pg.Rect((0, 0), self.size)
+            self.texture_kind = 'tiled'
+            if indexed and palette is None:
+                self.atlas, palette = quantize(self.atlas)
+            self.textures = (self.grid, self.atlas)
+            self.set_palette(palette)
+            return
+        
+        if texture is not None and texture_budget is not None:
+            # maps that were baked without pages are split in memory
+            if indexed and palette is None:
+                texture, palette = quantize(texture)
+            pages, fill = split_pages(texture), fill_texel(texture)
+        
+        if pages is not None:
+            self.page_texture(pages, fill, texture_budget)
+            self.set_palette(palette)
+            return
+        
+        if texture is not None:
+            if indexed and palette is None:
+                texture, palette = quantize(texture)
+            self.texture = texture
+            self.size = (texture.shape[1], texture.shape[0])
+            self.rect = pg.Rect((0, 0), self.size)
+            self.texture_kind = 'bitmap'
+            self.textures = (self.texture,)
+            self.set_palette(palette)
+            return
+        
         if sprite:
             self.image = sprite
-            self.size = sprite.get_size()
         else:
             self.image = pg.Surface(size)
             self.image.fill(pg.Color('black'))
@@ -146,45 +925,243 @@ class Mode7:
                 pg.draw.line(self.image, pg.Color('blueviolet'),
                              (0, y), (size[0], y), 4)
         self.rect = self.image.get_rect()
+        self.size = self.rect.size
         
         # Convert source image to numpy array once
-        self.image_array = pg.surfarray.array3d(self.image)
+        self.texture = image_to_texture(
+                self.image, self.game.game_screen if packed else None)
+        if indexed:
+            self.texture, palette = quantize(self.texture)
+        self.texture_kind = 'bitmap'
+        self.textures = (self.texture,)
+        if texture_budget is not None:
+            self.page_texture(split_pages(self.texture),
+                              fill_texel(self.texture), texture_budget)
+        self.set_palette(palette)
+        
+    def page_texture(self, pages, fill, texture_budget):
+        """
+        sample the map through a PagedTexture of pages that keeps about
+        texture_budget bytes of them in memory
+        """
+        rows, cols, size = pages.shape[:3]
+        self.size = (cols * size, rows * size)
+        self.rect = pg.Rect((0, 0), self.size)
+        self.close()
+        self.pager = PagedTexture(pages, fill, texture_budget // pages[0, 0].nbytes)
+        self.texture_kind = 'tiled'
+        self.textures = (self.pager.table, self.pager.pool)
+        
+    def close(self):
+        """
+        stop the loader thread of a paged texture
+        """
+        if self.pager is not None:
+            self.pager.close()
+            self.pager = None
+        
+    def page_in(self, cameras, rows):
+        """
+        let the pager load the pages around cameras (x, y, angle), which
+        follow the karts in rows of game.fleet
+        """
+        if self.pager is not None:
+            self.pager.update(cameras, self.game.fleet.vel[rows].tolist(),
+                              self.fov_half)
+        
+    def set_palette(self, palette):
+        """
+        set the RGB colors of the palette indices of an indexed map, e.g.
+        a darker copy of self.palette for the night. The first call sets
+        self.palette, the palette of the baked map
+        """
+        if not self.indexed:
+            return
+        palette = np.asarray(palette, np.uint8)
+        if self.palette is None:
+            self.palette = palette
+        self.current_palette = [tuple(color) for color in palette.tolist()]
+        if self.ground is not None:
+            self.ground.set_palette(self.current_palette)
+        # the ground in the game's scene has the old colors
+        self.invalidate()
+        
+    def view_key(self):
+        """
+        return what a rendered frame depends on besides the texture: the
+        frustum, the screen and viewport layout, and the cameras as an array
+        """
+        game = self.game
+        if game.viewports:
+            layout = tuple((tuple(vp.rect), vp.mirror) for vp in game.viewports)
+            cameras = [vp.view(game.alpha) for vp in game.viewports]
+        else:
+            layout = None
+            cameras = [game.player.view(game.alpha)]
+        settings = (self.near, self.far, self.fov_half, game.HORIZON,
+                    game.game_screen_rect.size, layout)
+        return settings, np.array(cameras, dtype=np.float64)
+        
+    def changed(self):
+        """
+        return True if the frame would differ from the last rendered one,
+        cameras that moved less than STATIC_EPSILON count as unchanged
+        """
+        if self.rendered is None:
+            return True
+        settings, cameras = self.view_key()
+        last_settings, last_cameras = self.rendered
+        return (settings != last_settings or cameras.shape != last_cameras.shape
+                or np.abs(cameras - last_cameras).max() > STATIC_EPSILON
+                # pages that were loading are sampled from the fallback
+                or (self.pager is not None and self.pager.pending()))
+        
+    def invalidate(self):
+        """
+        make changed return True until the next render
+        """
+        self.rendered = None
+        
+    def perspective_tables(self, size=None):
+        """
+        return the per-scanline tables for a screen of size (default: the
+        game screen), they are only recalculated if the frustum parameters
+        or the size changed
+        """
+        w, h = size or self.game.game_screen_rect.size
+        key = (self.near, self.far, self.fov_half, self.game.HORIZON, w, h)
+        tables = self.tables.get(key)
+        if tables is None:
+            if len(self.tables) >= 16:
+                # the debug controls change the frustum every frame
+                self.tables.clear()
+            tables = self.tables[key] = perspective_tables(
+                    w, h, self.near, self.far, self.fov_half, self.game.HORIZON)
+        return tables
+        
+    def viewport_tables(self, viewports):
+        """
+        return the concatenated per-scanline tables of viewports, the
+        viewport of every row and the (left, width, row_offset) of every
+        viewport for the viewport kernels. Like perspective_tables, they
+        are only recalculated when the frustum or a viewport changed
+        """
+        key = (self.near, self.far, self.fov_half, self.game.HORIZON,
+               tuple((tuple(vp.rect), vp.mirror) for vp in viewports))
+        if key != self.viewport_tables_key:
+            (row_fwd, row_half, row_step, row_viewport,
+             first_row, horizon_offset) = viewport_tables(
+                    [vp.rect.size for vp in viewports], self.near, self.far,
+                    self.fov_half, self.game.HORIZON,
+                    [vp.mirror for vp in viewports])
+            rects = np.array([tuple(vp.rect) for vp in viewports], np.intp)
+            # the kernels write row r of the tables to screen row r + offset
+            layout = np.column_stack((rects[:, 0], rects[:, 2],
+                                      rects[:, 1] + horizon_offset - first_row))
+            self.viewport_tables_cache = (row_fwd, row_half, row_step,
+                                          row_viewport, layout.astype(np.intp))
+            self.viewport_tables_key = key
+            # the buffers that render_viewports fills every frame
+            self.cameras = np.zeros((len(viewports), 4))
+            self.viewport_layout = np.empty_like(self.viewport_tables_cache[-1])
+            # the rows of every viewport in the tables
+            self.viewport_rows = np.searchsorted(row_viewport,
+                                                 np.arange(len(viewports) + 1))
+        return self.viewport_tables_cache
         
-        self.near = 0.005
-        self.far = 0.01215
-        self.fov_half = pi / 4
+    def screen_array(self):
+        """
+        return a pixel view of the game screen (of the ground Surface for
+        indexed maps), it locks the surface until it is deleted
+        """
+        if self.indexed:
+            size = self.game.game_screen_rect.size
+            if self.ground is None or self.ground.get_size() != size:
+                self.ground = pg.Surface(size, 0, 8)
+                self.ground.set_palette(self.current_palette)
+            return pg.surfarray.pixels2d(self.ground)[:, :, None]
+        if self.packed:
+            return pg.surfarray.pixels2d(self.game.game_screen)[:, :, None]
+        return pg.surfarray.pixels3d(self.game.game_screen)
+        
+    def render_viewports(self, viewports):
+        """
+        render all viewports with a single kernel call, the texture and the
+        tables of every viewport are set up once for all of them. While the
+        profiler is enabled, the rows of every viewport are rendered by a
+        call of their own to measure its time (the threads of one call
+        work on the rows of all viewports at once)
+        """
+        tables = self.viewport_tables(viewports)
+        cameras = self.cameras
+        views = [viewport.view(self.game.alpha) for viewport in viewports]
+        self.page_in(views, [viewport.row for viewport in viewports])
+        for i, (x, y, angle) in enumerate(views):
+            cameras[i] = x, y, cos(angle), sin(angle)
+        screen_array = self.screen_array()
+        if self.game.profiler.enabled:
+            self.game.profiler.mark_viewports(
+                    self.render_viewports_timed(screen_array, tables))
+        else:
+            self.backend.render_viewports(self.texture_kind, screen_array,
+                                          *self.textures, *tables, cameras)
+        del screen_array
+        if self.indexed:
+            for viewport in viewports:
+                self.present(viewport.rect)
+        
+    def render_viewports_timed(self, screen_array, tables):
+        """
+        render the viewports of the viewport tables with one viewport kernel
+        call each and return the seconds every call took
+        """
+        row_fwd, row_half, row_step, row_viewport, layout = tables
+        seconds = []
+        for first, last in zip(self.viewport_rows[:-1], self.viewport_rows[1:]):
+            # the kernel writes row r of the tables to screen row r + offset
+            self.viewport_layout[:] = layout
+            self.viewport_layout[:, 2] += first
+            start = time.perf_counter()
+            self.backend.render_viewports(
+                self.texture_kind, screen_array, *self.textures,
+                row_fwd[first:last], row_half[first:last], row_step[first:last],
+                row_viewport[first:last], self.viewport_layout, self.cameras)
+            seconds.append(time.perf_counter() - start)
+        return seconds
+        
+    def present(self, rect):
+        """
+        blit the ground rows of rect from the indexed ground Surface to the
+        game screen, converting the indices to colors with the palette
+        """
+        horizon_offset = int(rect.h * self.game.HORIZON)
+        area = (rect.x, rect.y + horizon_offset, rect.w, rect.h - horizon_offset)
+        self.game.game_screen.blit(self.ground, area[:2], area)
         
     def update(self, dt):
-        screen = self.game.game_screen
-        screen_rect = self.game.game_screen_rect
-        player = self.game.player
-        
-        # Calculate frustum corners
-        far_x1 = player.pos.x + cos(player.angle - self.fov_half) * self.far
-        far_y1 = player.pos.y + sin(player.angle - self.fov_half) * self.far
-        near_x1 = player.pos.x + cos(player.angle - self.fov_half) * self.near
-        near_y1 = player.pos.y + sin(player.angle - self.fov_half) * self.near
-        
-        far_x2 = player.pos.x + cos(player.angle + self.fov_half) * self.far
-        far_y2 = player.pos.y + sin(player.angle + self.fov_half) * self.far
-        near_x2 = player.pos.x + cos(player.angle + self.fov_half) * self.near
-        near_y2 = player.pos.y + sin(player.angle + self.fov_half) * self.near
-        
-        # Render using compiled function
-        screen_array = pg.surfarray.pixels3d(screen)
-        
-        render_mode7(
-            screen_array,
-            self.image_array,
-            screen_rect.w, screen_rect.h,
-            self.rect.w, self.rect.h,
-            far_x1, far_y1, near_x1, near_y1,
-            far_x2, far_y2, near_x2, near_y2,
-            self.game.HORIZON
-        )
-        
-        del screen_array  # Release the lock on the surface
+        if self.game.viewports:
+            self.render_viewports(self.game.viewports)
+        else:
+            x, y, angle = self.game.player.view(self.game.alpha)
+            self.page_in([(x, y, angle)], [self.game.player.row])
+            row_fwd, row_half, row_step, horizon_offset = self.perspective_tables()
+            
+            # Render using compiled function
+            screen_array = self.screen_array()
+            self.backend.render(
+                self.texture_kind,
+                screen_array,
+                *self.textures,
+                row_fwd, row_half, row_step, horizon_offset,
+                x, y, cos(angle), sin(angle)
+            )
+            del screen_array  # Release the lock on the surface
+            if self.indexed:
+                self.present(self.game.game_screen_rect)
+        self.rendered = self.view_key()
+        self.controls(dt)
         
+    def controls(self, dt):
         # Debug controls
         keys = pg.key.get_pressed()
         if keys[pg.K_LEFT]:
@@ -201,61 +1178,3 @@ class Mode7:
             self.fov_half -= 0.2 * dt
         elif keys[pg.K_e]:
             self.fov_half += 0.2 * dt
-
-
-@njit(cache=True, fastmath=True)
-def render_mode7(screen_array, image_array, screen_w, screen_h,
-                 image_w, image_h,
-                 far_x1, far_y1, near_x1, near_y1,
-                 far_x2, far_y2, near_x2, near_y2,
-                 horizon):
-    """
-    JIT-compiled Mode7 renderer - this will be compiled to machine code
-    """
-    horizon_offset = int(screen_h * horizon)
-    
-    for y in range(screen_h):
-        # Prevent division by zero
-        sample_depth = y / screen_h + 0.0000001
-        
-        # Perspective calculation
-        start_x = (far_x1 - near_x1) / sample_depth + near_x1
-        start_y = (far_y1 - near_y1) / sample_depth + near_y1
-        end_x = (far_x2 - near_x2) / sample_depth + near_x2
-        end_y = (far_y2 - near_y2) / sample_depth + near_y2
-        
-        # Pre-calculate deltas for the scanline
-        dx = (end_x - start_x) / screen_w
-        dy = (end_y - start_y) / screen_w
-        
-        # Current sample position
-        sample_x = start_x
-        sample_y = start_y
-        
-        y_screen = y + horizon_offset
-        if y_screen >= screen_h:
-            continue
-        
-        for x in range(screen_w):
-            # Wrap coordinates for infinite tiling
-            wrapped_x = sample_x - int(sample_x)
-            wrapped_y = sample_y - int(sample_y)
-            
-            if wrapped_x < 0:
-                wrapped_x += 1
-            if wrapped_y < 0:
-                wrapped_y += 1
-            
-            # Sample texture
-            tex_x = int(wrapped_x * image_w) % image_w
-            tex_y = int(wrapped_y * image_h) % image_h
-            
-            # Copy pixel (RGB)
-            screen_array[x, y_screen, 0] = image_array[tex_x, tex_y, 0]
-            screen_array[x, y_screen, 1] = image_array[tex_x, tex_y, 1]
-            screen_array[x, y_screen, 2] = image_array[tex_x, tex_y, 2]
-            
-            # Move to next pixel along scanline
-            sample_x += dx
-            sample_y += dy
-            
\ No newline at end of file
@@ -0,0 +1,288 @@
+"""
+Checkpoints, triggers and lap timing
+
+The map objects whose type is 'finish', 'checkpoint' or 'trigger' are
+gates: rectangles in world units, thin ones (or Tiled objects with a width
+or height of 0) are lines. A kart passes a gate in the step in which the
+segment from its previous to its current position enters the rectangle.
+
+TriggerIndex keeps the gates in a uniform grid over the map, the gates
+that overlap each cell are listed in one array with the start of every
+cell in another one (like a sparse matrix). Every step only the gates in
+the cells around the segment of each kart are tested, so the cost grows
+with the number of karts and not with the number of gates on the track.
+
+LapTimer follows every kart through the checkpoints in order. The first
+lap starts when a kart crosses the finish line and a lap counts when it
+crosses it again after all checkpoints. Checkpoints are passed in the
+order of their names (names that are numbers by their value), objects
+with the same name are one checkpoint. The times between two gates of a
+lap are its sector times. Times are measured in steps plus the fraction of
+the step at which the segment reached the gate, so they only depend on
+the inputs, not on the frame rate.
+"""
+import numpy as np
+
+
+FINISH, CHECKPOINT, TRIGGER = range(3)
+KINDS = ('finish', 'checkpoint', 'trigger')
+# bounds of the number of grid cells along each side of the map
+MIN_CELLS = 16
+MAX_CELLS = 512
+
+
+def expand(counts):
+    """
+    return the index of the owner and the position within it of every
+    element of consecutive runs of counts elements
+    """
+    owner = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, position
+
+
+def checkpoint_order(names):
+    """
+    return the stage of every checkpoint name, counting from 1 in the
+    order they are passed in
+    """
+    def key(name):
+        return (0, int(name), '') if name.isdigit() else (1, 0, name)
+    order = sorted(set(names), key=key)
+    return [order.index(name) + 1 for name in names]
+
+
+
+class TriggerIndex:
+    """
+    uniform grid of gate rectangles, see the module docstring
+    """
+    def __init__(self, rects=(), kinds=(), names=None, cells=None):
+        """
+        rects are the (x, y, width, height) of the gates in world units
+        inside the map (0 to 1), kinds their KINDS indices. cells is the
+        number of grid cells along each side, by default about as many
+        cells as gates. With cells=1 every gate is tested, like no index
+        """
+        self.rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+        self.kinds = np.asarray(kinds, dtype=np.int8).reshape(-1)
+        count = len(self.rects)
+        self.names = list(names) if names is not None else [''] * count
+        if cells is None:
+            cells = int(np.clip(np.ceil(np.sqrt(count)), MIN_CELLS, MAX_CELLS))
+        self.cells = cells
+        self.low = self.rects[:, :2]
+        self.high = self.rects[:, :2] + self.rects[:, 2:]
+
+        # one entry per gate and overlapped cell, sorted by cell
+        first = np.clip(np.floor(self.low * cells).astype(np.intp), 0, cells - 1)
+        last = np.clip(np.floor(self.high * cells).astype(np.intp), 0, cells - 1)
+        span = last - first + 1
+        gate, k = expand(span[:, 0] * span[:, 1])
+        cell = ((first[gate, 1] + k // span[gate, 0]) * cells
+                + first[gate, 0] + k % span[gate, 0])
+        order = np.argsort(cell, kind='stable')
+        self.items = gate[order].astype(np.int32)
+        # the gates of cell i are items[start[i]:start[i + 1]]
+        self.start = np.searchsorted(cell[order], np.arange(cells * cells + 1))
+
+
+    def __len__(self):
+        return len(self.rects)
+
+
+    @classmethod
+    def from_objects(cls, arrays, map_size, cells=None):
+        """
+        return the index of the gates among the map objects from
+        load_objects, map_size is the (width, height) of the map in pixels
+        """
+        types = arrays['object_type']
+        mask = np.isin(types, KINDS)
+        rects = arrays['object_rect'][mask] / np.tile(map_size, 2)
+        kinds = [KINDS.index(kind) for kind in types[mask]]
+        return cls(rects, kinds, arrays['object_name'][mask].tolist(), cells)
+
+
+    def crossings(self, start, end):
+        """
+        return the kart indices, gate indices and step fractions (above 0,
+        up to 1) at which the segments from start to end (arrays of world
+        positions, in any repetition of the map) enter gates, ordered by
+        kart and fraction
+        """
+        none = (np.zeros(0, np.intp), np.zeros(0, np.intp), np.zeros(0))
+        if len(start) == 0 or len(self.rects) == 0:
+            return none
+        cells = self.cells
+        # the segments from inside the map, the cells around them can be in
+        # the neighbouring repetitions of it
+        origin = np.floor(start)
+        p0 = start - origin
+        p1 = end - origin
+        low = np.floor(np.minimum(p0, p1) * cells).astype(np.intp)
+        span = np.floor(np.maximum(p0, p1) * cells).astype(np.intp) - low + 1
+        kart, k = expand(span[:, 0] * span[:, 1])
+        cx = low[kart, 0] + k % span[kart, 0]
+        cy = low[kart, 1] + k // span[kart, 0]
+        cell = (cy % cells) * cells + cx % cells
+
+        # the gates listed in those cells
+        first = self.start[cell]
+        pair, k = expand(self.start[cell + 1] - first)
+        if len(pair) == 0:
+            return none
+        gate = self.items[first[pair] + k]
+        kart = kart[pair]
+        shift = np.column_stack((cx[pair] // cells, cy[pair] // cells))
+
+        # slab test of the segments against the rectangles, relative to the
+        # segment starts
+        a = p0[kart]
+        d = p1[kart] - a
+        lo = self.low[gate] + shift - a
+        hi = self.high[gate] + shift - a
+        parallel = d == 0
+        inside = (lo <= 0) & (hi >= 0)
+        d = np.where(parallel, 1, d)
+        near = np.where(parallel, np.where(inside, -np.inf, np.inf),
+                        np.minimum(lo / d, hi / d)).max(axis=1)
+        far = np.where(parallel, np.where(inside, np.inf, -np.inf),
+                       np.maximum(lo / d, hi / d)).min(axis=1)
+        hit = (near > 0) & (near <= 1) & (near <= far)
+        kart, gate, near = kart[hit], gate[hit], near[hit]
+
+        # gates that overlap several of the cells are found more than once
+        order = np.lexsort((near, kart))
+        kart, gate, near = kart[order], gate[order], near[order]
+        _, unique = np.unique(kart * len(self.rects) + gate, return_index=True)
+        unique.sort()
+        return kart[unique], gate[unique].astype(np.intp), near[unique]
+
+
+
+class LapTimer:
+    """
+    checkpoint progress, lap and sector times of the karts of game.fleet,
+    updated by step after every fleet step. Times are in seconds
+    """
+    def __init__(self, game, index=None):
+        self.game = game
+        # called with the kart row, the lap number (from 1) and the lap
+        # time whenever a kart completes a lap
+        self.on_lap = None
+        self.set_index(index if index is not None else TriggerIndex())
+
+
+    def set_index(self, index):
+        """
+        time laps through the gates of a TriggerIndex, this resets all times
+        """
+        self.index = index
+        kinds = index.kinds
+        # the stage of every gate: 0 for the finish line, the checkpoints
+        # from 1, -1 for triggers
+        self.stage = np.full(len(index), -1, dtype=np.intp)
+        self.stage[kinds == FINISH] = 0
+        checkpoints = np.flatnonzero(kinds == CHECKPOINT)
+        self.stage[checkpoints] = checkpoint_order(
+                [index.names[gate] for gate in checkpoints])
+        self.stages = int(self.stage.max(initial=0))
+        self.reset()
+
+
+    def reset(self):
+        """
+        forget all times, every kart starts its first lap at its next
+        finish line crossing
+        """
+        # the next stage each kart has to pass, -1 before the first lap
+        self.next_stage = np.full(0, -1, dtype=np.intp)
+        self.lap_start = np.zeros(0)
+        self.sector_start = np.zeros(0)
+        # completed lap times and their sector times, per kart
+        self.laps = []
+        self.sectors = []
+        # sector times of the running lap, per kart
+        self.current = []
+        # (kart row, gate) of the triggers entered in the last step
+        self.triggered = []
+
+
+    def grow(self, count):
+        added = count - len(self.next_stage)
+        if added <= 0:
+            return
+        self.next_stage = np.concatenate((self.next_stage,
+                                          np.full(added, -1, dtype=np.intp)))
+        self.lap_start = np.concatenate((self.lap_start, np.zeros(added)))
+        self.sector_start = np.concatenate((self.sector_start, np.zeros(added)))
+        for i in range(added):
+            self.laps.append([])
+            self.sectors.append([])
+            self.current.append([])
+
+
+    def step(self):
+        """
+        find the gates the karts entered in the last fleet step and update
+        their laps. Called by Game.step before game.tick is advanced
+        """
+        fleet = self.game.fleet
+        count = len(fleet)
+        self.triggered = []
+        if len(self.index) == 0 or count == 0:
+            return
+        self.grow(count)
+        karts, gates, fractions = self.index.crossings(fleet.prev_pos[:count],
+                                                       fleet.pos[:count])
+        step = self.game.STEP
+        for row, gate, fraction in zip(karts.tolist(), gates.tolist(),
+                                       fractions.tolist()):
+            stage = self.stage[gate]
+            if stage < 0:
+                self.triggered.append((row, gate))
+                continue
+            expected = self.next_stage[row]
+            now = (self.game.tick + fraction) * step
+            if stage == 0 and expected < 0:
+                # the first crossing of the finish line starts the timing
+                self.lap_start[row] = self.sector_start[row] = now
+            elif stage != expected:
+                # out of order, e.g. a checkpoint passed backwards
+                continue
+            else:
+                self.current[row].append(float(now - self.sector_start[row]))
+                self.sector_start[row] = now
+                if stage == 0:
+                    self.complete_lap(row, now)
+            self.next_stage[row] = (stage + 1) % (self.stages + 1)
+
+
+    def complete_lap(self, row, now):
+        seconds = float(now - self.lap_start[row])
+        self.laps[row].append(seconds)
+        self.sectors[row].append(tuple(self.current[row]))
+        self.current[row] = []
+        self.lap_start[row] = now
+        if self.on_lap is not None:
+            self.on_lap(row, len(self.laps[row]), seconds)
+
+
+    def lap_time(self, row):
+        """
+        return the time of the running lap of a kart, None before its first
+        lap started
+        """
+        if row >= len(self.next_stage) or self.next_stage[row] < 0:
+            return None
+        return self.game.tick * self.game.STEP - self.lap_start[row]
+
+
+    def best_lap(self, row):
+        """
+        return the best lap time of a kart, None without a completed lap
+        """
+        if row >= len(self.laps) or not self.laps[row]:
+            return None
+        return min(self.laps[row])
@@ -0,0 +1,176 @@
+"""
+On-disk cache for baked maps
+
+Baking a map (parsing the .tmx with pytmx, blitting every tile and copying
+the result into a texture array) is the slowest part of the startup. The
+cache stores the baked arrays as raw .npy files next to a manifest with the
+hashes of every source file (the .tmx, its .tsx tilesets and their images).
+A warm start only hashes the sources and memory-maps the arrays. Arrays
+that don't fit in memory can be baked straight into memory-mapped files
+of the entry (see load).
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from os import path
+
+import numpy as np
+
+
+MANIFEST = 'manifest.json'
+# bumped whenever the layout of the baked arrays changes
+VERSION = 5
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def create_in_memory(key, shape, dtype):
+    """
+    the create function of bakes without a map cache
+    """
+    return np.empty(shape, dtype)
+
+
+def map_sources(folder, name):
+    """
+    return the paths of all files a .tmx map is baked from: the map itself,
+    external tilesets and the images they reference
+    """
+    tmx = path.join(folder, f'{name}.tmx')
+    sources = [tmx]
+    documents = [tmx]
+    while documents:
+        document = documents.pop()
+        base = path.dirname(document)
+        root = ET.parse(document).getroot()
+        for tileset in root.iter('tileset'):
+            source = tileset.get('source')
+            if source:
+                tsx = path.normpath(path.join(base, source))
+                sources.append(tsx)
+                documents.append(tsx)
+        for image in root.iter('image'):
+            source = image.get('source')
+            if source:
+                sources.append(path.normpath(path.join(base, source)))
+    return sources
+
+
+class MapCache:
+    def __init__(self, folder, cache_dir=None):
+        """
+        folder is the assets folder with the .tmx files, the cache is kept
+        in its 'cache' subfolder unless cache_dir is given
+        """
+        self.folder = folder
+        self.cache_dir = cache_dir or path.join(folder, 'cache')
+        # seconds spent in the last call to load and whether it was a hit
+        self.load_time = 0
+        self.hit = False
+
+    def entry_dir(self, name, variant):
+        return path.join(self.cache_dir, f'{name}.{variant}')
+
+    def is_valid(self, entry):
+        """
+        return True if the manifest of the cache entry matches the current
+        contents of all the source files it was baked from
+        """
+        try:
+            with open(path.join(entry, MANIFEST)) as f:
+                manifest = json.load(f)
+            if manifest['version'] != VERSION:
+                return False
+            return all(file_hash(path.join(self.folder, source)) == digest
+                       for source, digest in manifest['sources'].items())
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def load(self, name, variant, bake):
+        """
+        return the arrays baked for map name. variant distinguishes
+        different bakes of the same map (e.g. pixel formats). On a miss,
+        bake(create) is called and has to return a dict of numpy arrays,
+        which is stored. create(key, shape, dtype) returns a new array for
+        key that is memory-mapped from the entry being written, so bake can
+        fill arrays larger than memory a part at a time. On a hit the
+        arrays are memory-mapped copy-on-write, so they have the same
+        (writeable) array type as freshly baked ones and the render kernels
+        are not compiled twice
+        """
+        start = time.perf_counter()
+        entry = self.entry_dir(name, variant)
+        self.hit = self.is_valid(entry)
+        if self.hit:
+            arrays = self.read(entry)
+        else:
+            # write into a temporary folder first, so that an interrupted
+            # write never leaves a valid looking entry behind
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = tempfile.mkdtemp(dir=self.cache_dir)
+            except OSError:
+                tmp = None
+            created = {}
+
+            def create(key, shape, dtype):
+                if tmp is None:
+                    return create_in_memory(key, shape, dtype)
+                created[key] = np.lib.format.open_memmap(
+                        path.join(tmp, f'{key}.npy'), 'w+', dtype, shape)
+                return created[key]
+
+            try:
+                arrays = bake(create)
+            except BaseException:
+                if tmp is not None:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            if self.store(name, entry, tmp, arrays, created) and created:
+                # map the created arrays from the entry like on a hit
+                arrays.update(self.read(entry, created))
+        self.load_time = time.perf_counter() - start
+        return arrays
+
+    def read(self, entry, names=None):
+        if names is None:
+            with open(path.join(entry, MANIFEST)) as f:
+                names = json.load(f)['arrays']
+        return {key: np.load(path.join(entry, f'{key}.npy'), mmap_mode='c')
+                for key in names}
+
+    def store(self, name, entry, tmp, arrays, created):
+        """
+        write arrays into the temporary folder tmp, except the ones that
+        were created in it, and make it the cache entry. Return whether it
+        was written
+        """
+        try:
+            if tmp is None:
+                raise OSError
+            sources = {path.relpath(source, self.folder): file_hash(source)
+                       for source in map_sources(self.folder, name)}
+            for key, array in arrays.items():
+                if key in created:
+                    created[key].flush()
+                else:
+                    np.save(path.join(tmp, f'{key}.npy'),
+                            np.ascontiguousarray(array))
+            with open(path.join(tmp, MANIFEST), 'w') as f:
+                json.dump({'version': VERSION, 'sources': sources,
+                           'arrays': list(arrays)}, f, indent=2)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+            return True
+        except OSError:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+            print(f'Warning: could not write the map cache to {self.cache_dir}')
+            return False
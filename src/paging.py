@@ -0,0 +1,269 @@
+"""
+Paged Mode7 textures
+
+A baked map is split into square pages stored page after page in an array
+that is usually memory-mapped from the map cache, so the whole texture
+never has to be in memory. PagedTexture keeps the pages around the cameras
+in a pool with a fixed number of slots and an indirection table with the
+slot of every page, which are exactly the tile grid and atlas the tiled
+Mode7 kernels sample. Slot 0 holds a page filled with the most common
+texel, pages that are not resident (far away, or not loaded yet) are
+sampled from it, like distance fog.
+
+Every frame, update finds the pages inside the frustum up to page_distance
+from each camera. Missing ones are read from the page array on a
+background thread and installed at the start of a later frame, the least
+recently used pages give up their slots. The pages around where the karts
+will be in PREFETCH_SECONDS are requested as well.
+"""
+import queue
+import threading
+from collections import OrderedDict
+from itertools import zip_longest
+from math import sin, cos, gcd
+
+import numpy as np
+
+
+# largest side of a page in texels
+PAGE_SIZE = 128
+# smallest one, smaller pages would need a page table entry for almost
+# every texel
+MIN_PAGE_SIZE = 16
+# fill_texel samples every this many texels along both sides
+FILL_STRIDE = 7
+# the camera position in this many seconds is paged in ahead of time
+PREFETCH_SECONDS = 0.5
+# the table is uint16, like the tile grids of the tiled kernels
+MAX_SLOTS = np.iinfo(np.uint16).max
+
+
+def page_side(height, width, largest=PAGE_SIZE):
+    """
+    return the side of the pages of a height x width texture, the largest
+    power of two up to largest that divides both sides. ValueError if
+    that is less than MIN_PAGE_SIZE
+    """
+    size = gcd(height, width, 1 << (largest.bit_length() - 1))
+    if size < MIN_PAGE_SIZE:
+        raise ValueError(f'cannot page a {width}x{height} texture, its sides '
+                         f'have to be multiples of {MIN_PAGE_SIZE}')
+    return size
+
+
+def band_pages(band, size):
+    """
+    return a (size, x, channel) band of a texture as a (cols, size, size,
+    channel) array of its pages
+    """
+    height, width, channels = band.shape
+    return band.reshape(size, width // size, size, channels).swapaxes(0, 1)
+
+
+def split_pages(texture, page_size=PAGE_SIZE):
+    """
+    return a (y, x, channel) texture as a (rows, cols, size, size, channel)
+    array of pages, each of them contiguous, of the page_side of the texture
+    """
+    h, w, channels = texture.shape
+    size = page_side(h, w, page_size)
+    rows, cols = h // size, w // size
+    pages = np.empty((rows, cols, size, size, channels), texture.dtype)
+    # a band of pages at a time, so memory-mapped textures are read in order
+    for row in range(rows):
+        pages[row] = band_pages(texture[row * size:(row + 1) * size], size)
+    return pages
+
+
+def fill_texel(texture, stride=FILL_STRIDE):
+    """
+    return the most common texel of a strided sample of texture
+    """
+    sample = texture[::stride, ::stride].reshape(-1, texture.shape[-1])
+    values, counts = np.unique(sample, axis=0, return_counts=True)
+    return values[np.argmax(counts)]
+
+
+
+class PagedTexture:
+    """
+    the resident pages of a paged texture, see the module docstring.
+    table and pool are the grid and atlas for the tiled kernels
+    """
+    def __init__(self, pages, fill, slots, page_distance=0.125):
+        """
+        pages is a (rows, cols, size, size, channel) array (see split_pages),
+        fill the texel of the fallback page and slots the number of pages
+        that are kept in memory. page_distance is how far ahead of the
+        camera pages are loaded, in world units (the map is 1 unit wide)
+        """
+        self.pages = pages
+        rows, cols, size = pages.shape[:3]
+        self.page_distance = page_distance
+        slots = min(max(slots, 1), MAX_SLOTS - 1)
+        self.pool = np.empty((slots + 1,) + pages.shape[2:], pages.dtype)
+        self.pool[0] = fill
+        self.table = np.zeros((rows, cols), np.uint16)
+        # resident page (flat index) -> slot, least recently used first
+        self.resident = OrderedDict()
+        self.free = list(range(slots, 0, -1))
+        # pages read by the loader thread and not installed yet
+        self.loaded = {}
+        self.lock = threading.Lock()
+        self.requested = set()
+        self.queue = queue.Queue()
+        self.loads = 0
+        # pages inside a frustum that were sampled from the fallback page
+        self.misses = 0
+        # if True, update reads missing pages itself instead of waiting for
+        # the loader thread, so the pixels don't depend on its timing
+        self.wait = False
+        self.started = False
+        threading.Thread(target=self.load_pages, daemon=True).start()
+
+
+    @property
+    def nbytes(self):
+        return self.pool.nbytes + self.table.nbytes
+
+
+    def load_pages(self):
+        # runs on the loader thread, reading a page from a memory-mapped
+        # array is where the disk access happens
+        while True:
+            page = self.queue.get()
+            if page is None:
+                return
+            rows, cols = self.table.shape
+            data = np.array(self.pages[page // cols, page % cols])
+            with self.lock:
+                self.loaded[page] = data
+
+
+    def footprint(self, x, y, angle, fov_half):
+        """
+        return the flat indices of the pages that the frustum of a camera
+        at (x, y, angle) covers up to page_distance, nearest first
+        """
+        rows, cols = self.table.shape
+        distance = self.page_distance
+        corners = np.array([(x, y),
+                            (x + distance * cos(angle - fov_half),
+                             y + distance * sin(angle - fov_half)),
+                            (x + distance * cos(angle + fov_half),
+                             y + distance * sin(angle + fov_half))])
+        # the corners in page units, the pages around them repeat like
+        # the texture
+        corners *= (cols, rows)
+        low = np.floor(corners.min(axis=0)).astype(int)
+        high = np.floor(corners.max(axis=0)).astype(int)
+        px, py = np.meshgrid(np.arange(low[0], high[0] + 1),
+                             np.arange(low[1], high[1] + 1))
+        centers = np.column_stack((px.ravel(), py.ravel())) + 0.5
+        # keep the pages whose center is within half a diagonal of the
+        # triangle, every edge distance is measured on the inside
+        inside = np.ones(len(centers), dtype=bool)
+        for i in range(3):
+            a, b = corners[i], corners[(i + 1) % 3]
+            edge = b - a
+            normal = np.array((-edge[1], edge[0])) / max(np.hypot(*edge), 1e-12)
+            if np.dot(corners[(i + 2) % 3] - a, normal) < 0:
+                normal = -normal
+            inside &= (centers - a) @ normal >= -0.7072
+        centers = centers[inside]
+        order = np.argsort(np.hypot(*(centers - corners[0]).T), kind='stable')
+        cells = np.floor(centers[order]).astype(int)
+        flat = (cells[:, 1] % rows) * cols + cells[:, 0] % cols
+        # a footprint wider than the map repeats pages
+        unique, first = np.unique(flat, return_index=True)
+        return unique[np.argsort(first)].tolist()
+
+
+    def install(self, page, data, keep):
+        """
+        copy a loaded page into a slot, evicting the least recently used
+        page that is not in keep. keep can't have more pages than slots
+        """
+        if self.free:
+            slot = self.free.pop()
+        else:
+            old = next(old for old in self.resident if old not in keep)
+            slot = self.resident.pop(old)
+            self.table.flat[old] = 0
+        self.pool[slot] = data
+        self.resident[page] = slot
+        self.table.flat[page] = slot
+
+
+    def update(self, cameras, velocities, fov_half):
+        """
+        make the pages in the frusta of cameras (x, y, angle) resident
+        and request the ones around where they will be after moving with
+        velocities for PREFETCH_SECONDS. The first call (every call if
+        self.wait is True) reads the pages it needs itself, later ones
+        never wait for the disk
+        """
+        # the nearest pages of every camera first
+        footprints = [self.footprint(x, y, angle, fov_half)
+                      for x, y, angle in cameras]
+        needed = [page for pages in zip_longest(*footprints)
+                  for page in pages if page is not None]
+        ahead = []
+        for (x, y, angle), (vx, vy) in zip(cameras, velocities):
+            if vx or vy:
+                ahead += self.footprint(x + vx * PREFETCH_SECONDS,
+                                        y + vy * PREFETCH_SECONDS, angle,
+                                        fov_half)
+        # only as many pages as there are slots, the nearest ones. Pages
+        # that can't have a slot are never requested, otherwise they would
+        # be loaded again every frame and pending would never be False
+        slots = len(self.pool) - 1
+        footprint = list(dict.fromkeys(needed))
+        needed = footprint[:slots]
+        keep = set(needed)
+        ahead = [page for page in dict.fromkeys(ahead)
+                 if page not in keep][:slots - len(needed)]
+        keep.update(ahead)
+
+        with self.lock:
+            loaded, self.loaded = self.loaded, {}
+        if self.wait or not self.started:
+            self.started = True
+            rows, cols = self.table.shape
+            for page in needed:
+                if page not in self.resident and page not in loaded:
+                    loaded[page] = self.pages[page // cols, page % cols]
+        for page in needed:
+            if page in self.resident:
+                self.resident.move_to_end(page)
+        # the pages needed now first, the prefetched ones only take the
+        # slots of pages that aren't needed or ahead, which always exist.
+        # Pages the cameras have left behind are dropped
+        now = set(needed)
+        for page in sorted(loaded, key=lambda page: page not in now):
+            self.requested.discard(page)
+            if page in keep and page not in self.resident:
+                self.install(page, loaded[page], keep)
+                self.loads += 1
+
+        if not self.wait:
+            for page in needed + ahead:
+                if page not in self.resident and page not in self.requested:
+                    self.requested.add(page)
+                    self.queue.put(page)
+        self.misses += sum(page not in self.resident for page in footprint)
+
+
+    def close(self):
+        """
+        stop the loader thread, which holds on to the page array. Call it
+        when the PagedTexture isn't used anymore
+        """
+        self.queue.put(None)
+
+
+    def pending(self):
+        """
+        return True while pages requested by update are still loading
+        """
+        return bool(self.requested)
@@ -1,109 +1,134 @@
 import pygame as pg
-from random import choice, randint
+import numpy as np
 
-vec = pg.math.Vector2
+# velocities, vanish speeds and size factors of particles are given per
+# frame at this frame rate, update scales them to the actual time step
+FRAME_RATE = 60
 
 
 
-def lerp_colors(color, start, end, dist):
-    # linear interpolation between two colors
-    color.r, color.g, color.b = list(map(lambda x: int((x[0] * (1 - dist)) +
-                                    (x[1] * dist)), zip(start[:3], end[:3])))
-
-
-
-class Particle(pg.sprite.Sprite):
-    def __init__(self, game, pos, images=None, colors=[], vel=vec(),
-                 random_angle=0, vanish_speed=4, start_size=1, end_size=1,
-                 lifespan=4):
-        super().__init__(game.all_sprites)
+class ParticleSystem:
+    """
+    all particles of the game in preallocated arrays (one row per particle)
+    instead of one Sprite each, so that updating and killing them is a
+    handful of array operations per frame no matter how many there are
+    """
+    def __init__(self, game, capacity=1024):
         self.game = game
+        self.capacity = capacity
+        # the game's generator, so that runs with the same seed are identical
+        self.rng = game.rng
+        # images are shared by many particles, rows only store an index
+        self.images = []
+        self.image_indices = {}
         
-        if images:
-            # if initialized with a list of images, choose one at random
-            self.original_image = choice(images).copy()
-            if start_size != 1:
-                s = self.original_image.get_size()
-                self.original_image = pg.transform.scale(self.original_image, 
-                                     (s[0] * start_size, s[1] * start_size))
-            self.image = self.original_image.copy()
-            self.rect = self.image.get_rect()
-            self.size = list(self.rect.size)
-            self.end_size = end_size
-            self.size_factor = 1 + (end_size - start_size) / lifespan
-        else:
-            # if not initialized with images, draw a circle
-            self.image = pg.Surface((20, 20))
-            self.image.set_colorkey((0, 0, 0))
-            self.rect = self.image.get_rect()
-            pg.draw.ellipse(self.image, (255, 255, 255), self.rect)
-
-        self.colors = colors
-        self.color = self.colors[0]
-        self.alpha = 255
-
-        if len(self.colors) > 1:
-            self.prev_color = self.colors[0]
-            self.target_color = self.colors[1]
-            self.target_index = 1
-
-        self.lerp_dist = 0
-        self.lerp_speed = 0.07
-        self.vanish_speed = vanish_speed
-            
-        self.pos = vec(pos)
-        self.rect.center = self.pos
-        # set random velocity vector
-        self.vel = vel.rotate(randint(-random_angle, random_angle))
-        
-        self.forces = [self.vel] # additional forces to impact the vel
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        # sum of the additional forces acting on each particle
+        self.force = np.zeros((capacity, 2))
+        self.alpha = np.zeros(capacity)
+        self.vanish_speed = np.zeros(capacity)
+        self.size = np.zeros((capacity, 2))
+        self.size_factor = np.ones(capacity)
+        self.color = np.zeros((capacity, 3), dtype=np.uint8)
+        self.image = np.zeros(capacity, dtype=np.intp)
+        # spawn order, particles are drawn oldest first
+        self.born = np.zeros(capacity, dtype=np.int64)
+        self.spawned = 0
         
     
-    def add_force(self, force, random_angle=0):
-        self.forces.append(force.rotate(randint(-random_angle, random_angle)))
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
     
     
-    def update(self, dt):
-        # add velocity to position
-        for f in self.forces:
-            self.pos += f
-
-        # update rect
-        self.rect = self.image.get_rect()
-        self.rect.center = self.pos
+    def random_rotate(self, vector, random_angle):
+        # rotate by a random whole number of degrees, like Vector2.rotate
+        angle = np.radians(self.rng.integers(-random_angle, random_angle + 1))
+        c, s = np.cos(angle), np.sin(angle)
+        return (vector[0] * c - vector[1] * s, vector[0] * s + vector[1] * c)
+    
+    
+    def free_slot(self):
+        """
+        return the index of an unused row. If all rows are in use, the
+        particle closest to vanishing is recycled
+        """
+        free = np.flatnonzero(~self.alive)
+        if len(free):
+            return free[0]
+        return np.argmin(self.alpha)
+    
+    
+    def emit(self, pos, image, color=(255, 255, 255), vel=(0, 0),
+             random_angle=0, vanish_speed=4, start_size=1, end_size=1,
+             lifespan=4, force=None, force_angle=0):
+        """
+        spawn a particle of image tinted with color at pos. vel is its
+        velocity per frame, rotated by up to random_angle degrees, and
+        force an optional extra velocity rotated by up to force_angle. Its
+        alpha drops by vanish_speed per frame. Its size starts at start_size
+        times the image size and changes by a factor of
+        1 + (end_size - start_size) / lifespan per frame
+        """
+        i = self.free_slot()
+        if image not in self.image_indices:
+            self.image_indices[image] = len(self.images)
+            self.images.append(image)
         
+        self.alive[i] = True
+        self.pos[i] = pos
+        self.vel[i] = self.random_rotate(vel, random_angle)
+        self.force[i] = 0
+        if force is not None:
+            self.force[i] = self.random_rotate(force, force_angle)
+        self.alpha[i] = 255
+        self.vanish_speed[i] = vanish_speed
+        w, h = image.get_size()
+        self.size[i] = (int(w * start_size), int(h * start_size))
+        self.size_factor[i] = 1 + (end_size - start_size) / lifespan
+        self.color[i] = pg.Color(color)[:3]
+        self.image[i] = self.image_indices[image]
+        self.born[i] = self.spawned
+        self.spawned += 1
+        return i
+    
+    
+    def update(self, dt):
+        alive = self.alive
+        if not alive.any():
+            return
+        frames = dt * FRAME_RATE
+        self.pos[alive] += (self.vel[alive] + self.force[alive]) * frames
         # reduce alpha gradually
-        self.alpha -= self.vanish_speed
-        if self.alpha < 0:
-            self.kill()
-        else:
-            self.color.a = int(self.alpha)
-            
-        self.size[0] = int(self.size[0] * self.size_factor)
-        self.size[1] = int(self.size[1] * self.size_factor)
+        self.alpha[alive] -= self.vanish_speed[alive] * frames
+        alive &= self.alpha >= 0
+        self.size[alive] = np.floor(self.size[alive]
+                                    * self.size_factor[alive, None] ** frames)
         
     
     def draw(self, screen):
-        self.blend_colors()
-        self.image = self.original_image.copy()
-        self.image = pg.transform.scale(self.image, self.size)
-        self.image.fill(self.color, None, pg.BLEND_RGBA_MULT)
+        """
+        draw the living particles, oldest first, and return the rects of
+        screen that were drawn to
+        """
+        rows = np.flatnonzero(self.alive)
+        if len(rows) == 0:
+            return []
+        rows = rows[np.argsort(self.born[rows])]
+        # particles live at the layout resolution (see Game.scale)
+        scale = self.game.scale
+        sizes = (self.size[rows] * scale).astype(int)
+        topleft = (self.pos[rows] * scale - sizes / 2).astype(int)
         
-        screen.blit(self.image, self.rect)
+        # particles spawned together share size and tint, so every distinct
+        # (image, size, tint) is only looked up once per frame
+        looks = np.column_stack((self.image[rows], sizes, self.color[rows],
+                                 self.alpha[rows].astype(int)))
+        unique, inverse = np.unique(looks, axis=0, return_inverse=True)
+        cache = self.game.sprite_cache
+        images = [cache.get(self.images[image], (w, h), (r, g, b, a))
+                  for image, w, h, r, g, b, a in unique.tolist()]
         
-    
-    def blend_colors(self):
-        if len(self.colors) > 1:
-            if self.lerp_dist < 1:   
-                # linear interpolation between previous and target color
-                lerp_colors(self.color, self.prev_color, 
-                            self.target_color, self.lerp_dist)
-                self.lerp_dist += self.lerp_speed
-            else:
-                # if lerp distance reached 1, set the next target color
-                self.target_index += 1
-                if self.target_index < len(self.colors):
-                    self.prev_color = self.target_color
-                    self.target_color = self.colors[self.target_index]
-                    self.lerp_dist = 0
-                    
+        return screen.blits([(images[i], dest) for i, dest
+                             in zip(inverse.ravel().tolist(), topleft.tolist())])
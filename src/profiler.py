@@ -0,0 +1,256 @@
+"""
+Per-stage frame profiler
+
+Game.run calls mark(stage) after each stage of a frame, every call adds the
+time since the previous one to that stage. The stage times and the sprite
+counts of the last window frames are kept in a ring buffer, so rolling
+percentiles only look at recent frames. While the profiler is disabled,
+mark and end_frame return right away, so it can stay in release builds.
+
+    python run.py --profile frames.csv      one row per frame
+    python run.py --profile frames.json     percentiles and histograms
+
+F3 toggles an overlay with the p50/p95/p99 of every stage (and enables
+profiling if it was off). With a SpriteCache, the hits, misses and
+evictions of every frame are kept as counts as well, to tune its size and
+rounding steps. With split screen viewports, Mode7 measures the render
+time of every viewport (see mark_viewports).
+"""
+import csv
+import json
+import time
+
+import numpy as np
+import pygame as pg
+
+
+STAGES = ('wait', 'events', 'kart physics', 'sprite update', 'particle update',
+          'sky', 'mode7', 'sprite draw', 'upscale', 'display')
+COUNTS = ('sprites', 'billboards', 'particles')
+# counted per frame from the SpriteCache statistics
+CACHE_COUNTS = ('cache hits', 'cache misses', 'cache evictions')
+PERCENTILES = (50, 95, 99)
+# histogram bin edges in milliseconds, the last bin takes everything above
+HISTOGRAM_MS = (0, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16.7, 33.3, 50)
+# frames between two updates of the overlay text
+OVERLAY_INTERVAL = 30
+# viewports whose render times are kept
+MAX_VIEWPORTS = 8
+
+
+
+class FrameProfiler:
+    """
+    rolling per-stage frame times, see the module docstring
+    """
+    def __init__(self, window=600, enabled=False, sprite_cache=None):
+        self.enabled = enabled
+        self.sprite_cache = sprite_cache
+        self.overlay = False
+        self.window = window
+        self.index = {stage: i for i, stage in enumerate(STAGES)}
+        # seconds per stage and counts of the last window frames
+        self.times = np.zeros((window, len(STAGES)))
+        self.counts = np.zeros((window, len(COUNTS + CACHE_COUNTS)),
+                               dtype=np.int64)
+        # seconds per viewport, NaN for viewports a frame didn't have
+        self.viewport_times = np.full((window, MAX_VIEWPORTS), np.nan)
+        self.current_viewports = np.full(MAX_VIEWPORTS, np.nan)
+        # the sprite cache totals at the end of the last frame
+        self.cache_totals = (0, 0, 0)
+        self.frames = 0
+        self.current = [0.0] * len(STAGES)
+        self.last = time.perf_counter()
+        self.font = None
+        self.overlay_lines = []
+
+
+    def start(self):
+        """
+        start timing the next frame from now, the time since the last mark
+        is not counted
+        """
+        self.last = time.perf_counter()
+        self.current = [0.0] * len(STAGES)
+        self.current_viewports[:] = np.nan
+        self.cache_totals = self.read_cache()
+
+
+    def read_cache(self):
+        """
+        return the hit, miss and eviction totals of the sprite cache
+        """
+        cache = self.sprite_cache
+        if cache is None:
+            return (0, 0, 0)
+        return (cache.hits, cache.misses, cache.evictions)
+
+
+    def enable(self, enabled=True):
+        if enabled and not self.enabled:
+            self.start()
+        self.enabled = enabled
+
+
+    def mark(self, stage):
+        """
+        add the time since the last mark to stage
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.current[self.index[stage]] += now - self.last
+        self.last = now
+
+
+    def mark_viewports(self, seconds):
+        """
+        store the render time of every viewport in this frame, they are
+        part of the mode7 stage
+        """
+        if not self.enabled:
+            return
+        seconds = seconds[:MAX_VIEWPORTS]
+        self.current_viewports[:len(seconds)] = seconds
+
+
+    def end_frame(self, counts):
+        """
+        store the stage times of the frame that just ended together with
+        counts, a tuple with a number for each of COUNTS
+        """
+        if not self.enabled:
+            return
+        row = self.frames % self.window
+        self.times[row] = self.current
+        totals = self.read_cache()
+        self.counts[row] = tuple(counts) + tuple(
+                now - last for now, last in zip(totals, self.cache_totals))
+        self.cache_totals = totals
+        self.viewport_times[row] = self.current_viewports
+        self.current = [0.0] * len(STAGES)
+        self.current_viewports[:] = np.nan
+        self.frames += 1
+
+
+    def recent(self):
+        """
+        return the stage times, counts and viewport times of the frames in
+        the window, oldest first. Viewports that no frame had are left out
+        """
+        n = min(self.frames, self.window)
+        start = self.frames - n
+        order = np.arange(start, self.frames) % self.window
+        viewports = self.viewport_times[order]
+        seen = ~np.isnan(viewports).all(axis=0)
+        viewports = viewports[:, :np.count_nonzero(seen)]
+        return self.times[order], self.counts[order], viewports
+
+
+    def summary(self):
+        """
+        return a dict with the mean, the PERCENTILES and a histogram (see
+        HISTOGRAM_MS) of every stage and of the whole frame in milliseconds,
+        together with the mean counts and the sprite cache statistics (its
+        hit rate over the window and its totals) and the mean and PERCENTILES
+        of every viewport
+        """
+        times, counts, viewports = self.recent()
+        result = {'frames': len(times), 'stages': {}, 'counts': {}}
+        if len(times) == 0:
+            return result
+        times = np.column_stack((times, times.sum(axis=1))) * 1000
+        edges = np.array(HISTOGRAM_MS + (np.inf,))
+        for i, stage in enumerate(STAGES + ('frame',)):
+            values = np.percentile(times[:, i], PERCENTILES)
+            stats = {'mean': float(times[:, i].mean())}
+            stats.update({f'p{p}': float(v) for p, v in zip(PERCENTILES, values)})
+            stats['histogram'] = np.histogram(times[:, i], edges)[0].tolist()
+            result['stages'][stage] = stats
+        for i, name in enumerate(COUNTS + CACHE_COUNTS):
+            result['counts'][name] = float(counts[:, i].mean())
+        if self.sprite_cache is not None:
+            hits, misses = counts[:, len(COUNTS):len(COUNTS) + 2].sum(axis=0)
+            cache = self.sprite_cache.stats()
+            cache['window_hit_rate'] = float(hits / max(hits + misses, 1))
+            cache['max_size'] = self.sprite_cache.max_size
+            result['sprite_cache'] = cache
+        if viewports.shape[1]:
+            result['viewports'] = []
+            for column in viewports.T * 1000:
+                column = column[~np.isnan(column)]
+                stats = {'mean': float(column.mean())}
+                stats.update({f'p{p}': float(v) for p, v in
+                              zip(PERCENTILES, np.percentile(column, PERCENTILES))})
+                result['viewports'].append(stats)
+        result['histogram_ms'] = list(HISTOGRAM_MS)
+        return result
+
+
+    def export(self, filename):
+        """
+        write the frames in the window to a .csv file (one row per frame,
+        in milliseconds) or their summary to a .json file
+        """
+        if filename.endswith('.json'):
+            with open(filename, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+            return
+        times, counts, viewports = self.recent()
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('frame',) + STAGES + ('total',) + COUNTS
+                            + CACHE_COUNTS + tuple(f'viewport {v}' for v in
+                                                   range(viewports.shape[1])))
+            first = self.frames - len(times)
+            for i, (row, count, viewport) in enumerate(zip(
+                    times.tolist(), counts.tolist(), viewports.tolist())):
+                writer.writerow([first + i]
+                                + [f'{t * 1000:.4f}' for t in row]
+                                + [f'{sum(row) * 1000:.4f}'] + count
+                                + ['' if np.isnan(t) else f'{t * 1000:.4f}'
+                                   for t in viewport])
+
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        if self.overlay:
+            self.enable()
+
+
+    def draw_overlay(self, screen):
+        """
+        draw the rolling percentiles of every stage onto screen, the text is
+        only updated every OVERLAY_INTERVAL frames
+        """
+        if not self.overlay:
+            return
+        if self.font is None:
+            pg.font.init()
+            self.font = pg.font.SysFont('dejavusansmono,couriernew,monospace', 12)
+        if self.frames % OVERLAY_INTERVAL == 0 or not self.overlay_lines:
+            summary = self.summary()
+            lines = [f"{'ms':<16}" + ''.join(f'{f"p{p}":>7}' for p in PERCENTILES)]
+            for stage, stats in summary['stages'].items():
+                lines.append(f'{stage:<16}' + ''.join(
+                        f"{stats[f'p{p}']:7.2f}" for p in PERCENTILES))
+            for v, stats in enumerate(summary.get('viewports', [])):
+                lines.append(f'{f"viewport {v}":<16}' + ''.join(
+                        f"{stats[f'p{p}']:7.2f}" for p in PERCENTILES))
+            lines.append('  '.join(f'{name} {count:.0f}'
+                                   for name, count in summary['counts'].items()
+                                   if name in COUNTS))
+            if 'sprite_cache' in summary:
+                cache = summary['sprite_cache']
+                counts = summary['counts']
+                lines.append(f"sprite cache {cache['size']}/{cache['max_size']}  "
+                             f"hits {cache['window_hit_rate']:.1%}  "
+                             f"misses {counts['cache misses']:.1f}/frame  "
+                             f"evictions {counts['cache evictions']:.1f}/frame")
+            self.overlay_lines = [self.font.render(line, True, (255, 255, 255),
+                                                   (0, 0, 0))
+                                  for line in lines]
+        y = 4
+        for line in self.overlay_lines:
+            screen.blit(line, (4, y))
+            y += line.get_height()
@@ -0,0 +1,374 @@
+"""
+Mode7 render backends
+
+All backends take the same arguments (the per-scanline tables from
+perspective_tables and the camera pose) and write the same pixels into
+screen_array. The texture is indexed (y, x, channel) and the screen array
+(x, y, channel), where the channels are either three RGB bytes or a single
+packed uint32 pixel. Tiled textures are a (rows, cols) grid of tile indices
+into an atlas indexed (tile, y, x, channel).
+
+    numba-parallel  numba kernel, scanlines split across cores
+    numba           single-threaded numba kernel
+    numpy           vectorized NumPy, no compilation needed
+
+Every backend also has viewport kernels that render several cameras into
+rectangles of one screen array in a single call (split screen, mirrors).
+They take the tables of all viewports concatenated by viewport_tables.
+
+numba is only imported when one of its backends is selected, so the game
+also runs on interpreters where numba is not available.
+"""
+import threading
+from math import sin, cos, pi
+
+import numpy as np
+
+
+BACKENDS = ('numba-parallel', 'numba', 'numpy')
+
+# the default frustum of Mode7, in world units and radians. The debug keys
+# change the one Mode7 renders with, the kart physics always use these
+NEAR = 0.005
+FAR = 0.01215
+FOV_HALF = pi / 4
+
+# the work arrays of the NumPy kernels, per thread, see work_buffer
+work_buffers = threading.local()
+# distinct buffers kept per thread before all of them are dropped
+MAX_WORK_BUFFERS = 64
+
+
+def perspective_tables(screen_w, screen_h, near, far, fov_half, horizon):
+    """
+    return the camera-space tables for every visible scanline: forward
+    distance, half width and the step between two pixels. They only depend
+    on the frustum parameters and the screen size, so the renderer only has
+    to rotate and translate them by the camera pose each frame
+    """
+    horizon_offset = int(screen_h * horizon)
+    # rows above the horizon are covered by the sky
+    y = np.arange(max(screen_h - horizon_offset, 0))
+    # Prevent division by zero
+    sample_depth = y / screen_h + 0.0000001
+    # distance from the camera to both edges of the scanline
+    distance = (far - near) / sample_depth + near
+    row_fwd = distance * cos(fov_half)
+    row_half = distance * sin(fov_half)
+    row_step = 2 * row_half / screen_w
+    return row_fwd, row_half, row_step, horizon_offset
+
+
+def viewport_tables(sizes, near, far, fov_half, horizon, mirrored=None):
+    """
+    return the perspective_tables of several viewports of (width, height)
+    concatenated into one set of tables, together with the viewport of
+    every row and the first row and horizon offset of every viewport.
+    The scanlines of mirrored viewports run from right to left
+    """
+    tables = []
+    for i, (w, h) in enumerate(sizes):
+        row_fwd, row_half, row_step, horizon_offset = perspective_tables(
+                w, h, near, far, fov_half, horizon)
+        if mirrored is not None and mirrored[i]:
+            row_half, row_step = -row_half, -row_step
+        tables.append((row_fwd, row_half, row_step, horizon_offset))
+    counts = [len(t[0]) for t in tables]
+    first_row = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+    return (np.concatenate([t[0] for t in tables]),
+            np.concatenate([t[1] for t in tables]),
+            np.concatenate([t[2] for t in tables]),
+            np.repeat(np.arange(len(tables)), counts).astype(np.intp),
+            first_row,
+            np.array([t[3] for t in tables], dtype=np.intp))
+
+
+def work_buffer(name, shape, dtype=np.float64):
+    """
+    return an uninitialized array of shape and dtype that is reused by the
+    next call with the same arguments on this thread, so that the NumPy
+    kernels don't allocate whole-frame arrays every frame
+    """
+    buffers = work_buffers.__dict__
+    key = (name, shape, dtype)
+    array = buffers.get(key)
+    if array is None:
+        if len(buffers) >= MAX_WORK_BUFFERS:
+            # e.g. after many resolution changes
+            buffers.clear()
+        array = buffers[key] = np.empty(shape, dtype)
+    return array
+
+
+def wrap_texels(sample, size, out):
+    """
+    write the texels of the world coordinates in sample to out, like
+    wrap in render_numba. sample is overwritten
+    """
+    trunc = work_buffer('trunc', sample.shape)
+    negative = work_buffer('negative', sample.shape, np.bool_)
+    np.trunc(sample, out=trunc)
+    np.subtract(sample, trunc, out=sample)
+    np.less(sample, 0, out=negative)
+    np.add(sample, 1, out=sample, where=negative)
+    np.multiply(sample, size, out=sample)
+    # truncates towards zero like astype
+    np.copyto(out, sample, casting='unsafe')
+    np.remainder(out, size, out=out)
+
+
+def sample_texels(screen_w, image_w, image_h,
+                  row_fwd, row_half, row_step, pos_x, pos_y, cos_a, sin_a):
+    """
+    return the texel coordinates (tex_x, tex_y) sampled by every pixel of
+    the visible scanlines, each as a (rows, screen_w) array. They are work
+    buffers, so they are only valid until the next call
+    """
+    center_x = pos_x + row_fwd * cos_a
+    center_y = pos_y + row_fwd * sin_a
+    start_x = center_x + row_half * sin_a
+    start_y = center_y - row_half * cos_a
+    dx = -row_step * sin_a
+    dy = row_step * cos_a
+
+    # the scanline start plus a ramp of x positions times the step. The
+    # per-row values are expanded with copyto first, ufuncs that broadcast
+    # them would allocate an iteration buffer on every call
+    shape = (len(row_fwd), screen_w)
+    ramp = work_buffer('ramp', shape)
+    np.copyto(ramp, np.arange(screen_w))
+    sample = work_buffer('sample', shape)
+    start = work_buffer('start', shape)
+    tex_x = work_buffer('tex_x', shape, np.intp)
+    tex_y = work_buffer('tex_y', shape, np.intp)
+
+    for row_start, step, size, tex in ((start_x, dx, image_w, tex_x),
+                                       (start_y, dy, image_h, tex_y)):
+        np.copyto(sample, step[:, None])
+        np.multiply(sample, ramp, out=sample)
+        np.copyto(start, row_start[:, None])
+        np.add(start, sample, out=sample)
+        wrap_texels(sample, size, tex)
+    return tex_x, tex_y
+
+
+def gather(source, index, name='gather'):
+    """
+    return the pixels of source (flattened to (pixels, channels)) at the
+    flat indices in index, in a work buffer of index.shape + (channels,)
+    """
+    channels = source.shape[-1]
+    out = work_buffer(name, index.shape + (channels,), source.dtype)
+    # mode='clip' writes straight into out, 'raise' would buffer
+    np.take(source.reshape(-1, channels), index, axis=0, out=out, mode='clip')
+    return out
+
+
+def render_mode7_numpy(screen_array, texture,
+                       row_fwd, row_half, row_step, horizon_offset,
+                       pos_x, pos_y, cos_a, sin_a):
+    """
+    vectorized Mode7 renderer - computes the sample coordinates of the
+    whole frame at once and gathers the pixels with one fancy index
+    """
+    if len(row_fwd) == 0:
+        return
+    image_h, image_w = texture.shape[:2]
+    tex_x, tex_y = sample_texels(screen_array.shape[0], image_w, image_h,
+                                 row_fwd, row_half, row_step,
+                                 pos_x, pos_y, cos_a, sin_a)
+    # flat texel index, tex_y is reused for it
+    np.multiply(tex_y, image_w, out=tex_y)
+    np.add(tex_y, tex_x, out=tex_y)
+    # the gather is (rows, x, channels), the screen array is (x, y, channels)
+    screen_array[:, horizon_offset:horizon_offset + len(row_fwd)] = \
+        gather(texture, tex_y).swapaxes(0, 1)
+
+
+def render_mode7_tiled_numpy(screen_array, grid, atlas,
+                             row_fwd, row_half, row_step, horizon_offset,
+                             pos_x, pos_y, cos_a, sin_a):
+    """
+    vectorized Mode7 renderer that samples through a tile index grid
+    """
+    if len(row_fwd) == 0:
+        return
+    tile_h, tile_w = atlas.shape[1:3]
+    tex_x, tex_y = sample_texels(screen_array.shape[0],
+                                 grid.shape[1] * tile_w, grid.shape[0] * tile_h,
+                                 row_fwd, row_half, row_step,
+                                 pos_x, pos_y, cos_a, sin_a)
+    # flat index into the grid of the tile under each sample
+    index = work_buffer('index', tex_x.shape, np.intp)
+    inner = work_buffer('inner', tex_x.shape, np.intp)
+    np.floor_divide(tex_y, tile_h, out=index)
+    np.multiply(index, grid.shape[1], out=index)
+    np.floor_divide(tex_x, tile_w, out=inner)
+    np.add(index, inner, out=index)
+    tiles = gather(grid[..., None], index, 'tiles')[..., 0]
+    # flat index into the atlas, (tile * tile_h + y) * tile_w + x, in
+    # intp because tile * tile_h can overflow the dtype of the grid
+    np.copyto(index, tiles)
+    np.multiply(index, tile_h, out=index)
+    np.remainder(tex_y, tile_h, out=inner)
+    np.add(index, inner, out=index)
+    np.multiply(index, tile_w, out=index)
+    np.remainder(tex_x, tile_w, out=inner)
+    np.add(index, inner, out=index)
+    screen_array[:, horizon_offset:horizon_offset + len(row_fwd)] = \
+        gather(atlas, index).swapaxes(0, 1)
+
+
+def render_viewports_numpy(kernel, screen_array, textures,
+                           row_fwd, row_half, row_step, row_viewport,
+                           viewports, cameras):
+    """
+    render the viewports (see render_mode7_viewports in render_numba) one
+    after the other with a single-view NumPy kernel
+    """
+    for v, (left, width, row_offset) in enumerate(viewports.tolist()):
+        first, last = np.searchsorted(row_viewport, (v, v + 1))
+        pos_x, pos_y, cos_a, sin_a = cameras[v].tolist()
+        kernel(screen_array[left:left + width], *textures,
+               row_fwd[first:last], row_half[first:last], row_step[first:last],
+               row_offset + first, pos_x, pos_y, cos_a, sin_a)
+
+
+def render_mode7_viewports_numpy(screen_array, texture, *args):
+    render_viewports_numpy(render_mode7_numpy, screen_array, (texture,), *args)
+
+
+def render_mode7_tiled_viewports_numpy(screen_array, grid, atlas, *args):
+    render_viewports_numpy(render_mode7_tiled_numpy, screen_array,
+                           (grid, atlas), *args)
+
+
+class Backend:
+    """
+    the render kernels of one backend together with the number of threads
+    they run on. kernels maps the texture kind ('bitmap' for one texture
+    array, 'tiled' for a tile grid and atlas) to a kernel, viewport_kernels
+    maps it to the kernel that renders several viewports at once
+    """
+    def __init__(self, name, kernels, viewport_kernels, threads=1,
+                 set_threads=None):
+        self.name = name
+        self.kernels = kernels
+        self.viewport_kernels = viewport_kernels
+        self.threads = threads
+        self.set_threads = set_threads
+
+    def render(self, kind, *args):
+        if self.set_threads:
+            # the numba thread count is per calling thread
+            self.set_threads(self.threads)
+        self.kernels[kind](*args)
+
+    def render_viewports(self, kind, *args):
+        if self.set_threads:
+            self.set_threads(self.threads)
+        self.viewport_kernels[kind](*args)
+
+    def warmup(self, kind, screen_array, dtype, channels, horizon,
+               grid_dtype=np.uint16):
+        """
+        call the kernel for kind once with tiny arrays of the same types as
+        the real ones, so that numba compiles it (or loads it from its cache)
+        before the first frame. screen_array should be a pixel view of a
+        small Surface in the format of the real screen, horizon the one of
+        the game
+        """
+        tables = perspective_tables(screen_array.shape[0], screen_array.shape[1],
+                                    NEAR, FAR, FOV_HALF, horizon)
+        if kind == 'tiled':
+            textures = (np.zeros((1, 1), grid_dtype),
+                        np.zeros((1, 2, 2, channels), dtype))
+        else:
+            textures = (np.zeros((2, 2, channels), dtype),)
+        self.render(kind, screen_array, *textures, *tables, 0.5, 0.5, 1.0, 0.0)
+
+    def warmup_viewports(self, kind, screen_array, dtype, channels, horizon,
+                         grid_dtype=np.uint16):
+        """
+        same as warmup for the viewport kernel of kind, with one viewport
+        covering screen_array
+        """
+        row_fwd, row_half, row_step, row_viewport, first_row, offset = \
+            viewport_tables([screen_array.shape[:2]], NEAR, FAR, FOV_HALF,
+                            horizon)
+        viewports = np.array([(0, screen_array.shape[0], offset[0])], np.intp)
+        cameras = np.array([(0.5, 0.5, 1.0, 0.0)])
+        if kind == 'tiled':
+            textures = (np.zeros((1, 1), grid_dtype),
+                        np.zeros((1, 2, 2, channels), dtype))
+        else:
+            textures = (np.zeros((2, 2, channels), dtype),)
+        self.render_viewports(kind, screen_array, *textures, row_fwd, row_half,
+                              row_step, row_viewport, viewports, cameras)
+
+    def __repr__(self):
+        if self.set_threads:
+            return f'{self.name} ({self.threads} threads)'
+        return self.name
+
+
+def select_backend(name='auto', threads=None):
+    """
+    return a Backend for name, which is one of BACKENDS or 'auto'. 'auto'
+    picks numba-parallel on multi-core machines, numba otherwise, and
+    falls back to numpy if numba cannot be imported
+    """
+    if name != 'auto' and name not in BACKENDS:
+        raise ValueError(f'unknown render backend {name!r}, '
+                         f'choose one of {", ".join(BACKENDS)} or auto')
+
+    if name != 'numpy':
+        try:
+            from src import render_numba
+        except ImportError as error:
+            # not installed, or installed but broken (e.g. built for
+            # another NumPy version)
+            if name != 'auto':
+                print(f'Warning: Numba cannot be imported ({error}), cannot '
+                      f'use the {name} backend')
+            name = 'numpy'
+
+    if name == 'auto':
+        max_threads = render_numba.max_threads()
+        if min(threads or max_threads, max_threads) > 1:
+            name = 'numba-parallel'
+        else:
+            name = 'numba'
+
+    if name == 'numba-parallel':
+        max_threads = render_numba.max_threads()
+        kernels = {
+            'bitmap': render_numba.render_mode7_parallel,
+            'tiled': render_numba.render_mode7_tiled_parallel
+        }
+        viewport_kernels = {
+            'bitmap': render_numba.render_mode7_viewports_parallel,
+            'tiled': render_numba.render_mode7_tiled_viewports_parallel
+        }
+        return Backend(name, kernels, viewport_kernels,
+                       min(threads or max_threads, max_threads),
+                       render_numba.set_num_threads)
+    if name == 'numba':
+        kernels = {
+            'bitmap': render_numba.render_mode7,
+            'tiled': render_numba.render_mode7_tiled
+        }
+        viewport_kernels = {
+            'bitmap': render_numba.render_mode7_viewports,
+            'tiled': render_numba.render_mode7_tiled_viewports
+        }
+        return Backend(name, kernels, viewport_kernels)
+    kernels = {
+        'bitmap': render_mode7_numpy,
+        'tiled': render_mode7_tiled_numpy
+    }
+    viewport_kernels = {
+        'bitmap': render_mode7_viewports_numpy,
+        'tiled': render_mode7_tiled_viewports_numpy
+    }
+    return Backend(name, kernels, viewport_kernels)
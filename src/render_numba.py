@@ -0,0 +1,241 @@
+"""
+Numba-compiled Mode7 kernels. This module imports numba unconditionally,
+use src.render to pick a backend instead of importing it directly
+"""
+from numba import njit, prange, config, set_num_threads
+
+
+# fastmath without 'contract', 'reassoc' and 'arcp', so that LLVM keeps the
+# exact order of floating point operations and the kernels match the
+# NumPy backend pixel for pixel
+FASTMATH = {'nnan', 'ninf', 'nsz'}
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def row_start(row, row_fwd, row_half, row_step, pos_x, pos_y, cos_a, sin_a):
+    """
+    rotate the camera-space scanline into the world and move it to the
+    camera, return its start point and the step between two pixels
+    """
+    center_x = pos_x + row_fwd[row] * cos_a
+    center_y = pos_y + row_fwd[row] * sin_a
+    start_x = center_x + row_half[row] * sin_a
+    start_y = center_y - row_half[row] * cos_a
+    dx = -row_step[row] * sin_a
+    dy = row_step[row] * cos_a
+    return start_x, start_y, dx, dy
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def wrap(sample, size):
+    """
+    return the texel for a world coordinate, the texture repeats every
+    1.0 units for infinite tiling
+    """
+    wrapped = sample - int(sample)
+    if wrapped < 0:
+        wrapped += 1
+    return int(wrapped * size) % size
+
+
+@njit(cache=True)
+def log2(n):
+    """
+    return the base 2 logarithm of n if n is a power of two, else -1
+    """
+    shift = 0
+    while (1 << shift) < n:
+        shift += 1
+    if (1 << shift) == n:
+        return shift
+    return -1
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def render_row(screen_array, texture, row,
+               row_fwd, row_half, row_step, horizon_offset,
+               pos_x, pos_y, cos_a, sin_a):
+    """
+    render a single scanline, shared by the serial and parallel kernels
+    so that both produce exactly the same pixels
+    """
+    image_h, image_w, channels = texture.shape
+    start_x, start_y, dx, dy = row_start(row, row_fwd, row_half, row_step,
+                                         pos_x, pos_y, cos_a, sin_a)
+    y_screen = row + horizon_offset
+
+    for x in range(screen_array.shape[0]):
+        # sample position along the scanline (multiplied instead of
+        # accumulated, the vectorized backend computes it the same way)
+        tex_x = wrap(start_x + dx * x, image_w)
+        tex_y = wrap(start_y + dy * x, image_h)
+
+        # Copy pixel (three RGB bytes or one packed value)
+        if channels == 3:
+            screen_array[x, y_screen, 0] = texture[tex_y, tex_x, 0]
+            screen_array[x, y_screen, 1] = texture[tex_y, tex_x, 1]
+            screen_array[x, y_screen, 2] = texture[tex_y, tex_x, 2]
+        else:
+            screen_array[x, y_screen, 0] = texture[tex_y, tex_x, 0]
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def render_row_tiled(screen_array, grid, atlas, row,
+                     row_fwd, row_half, row_step, horizon_offset,
+                     pos_x, pos_y, cos_a, sin_a):
+    """
+    render a single scanline by looking up the tile under each sample in
+    the tile index grid and sampling that tile from the atlas
+    """
+    tile_h, tile_w, channels = atlas.shape[1:]
+    image_h = grid.shape[0] * tile_h
+    image_w = grid.shape[1] * tile_w
+    shift_x = log2(tile_w)
+    shift_y = log2(tile_h)
+    start_x, start_y, dx, dy = row_start(row, row_fwd, row_half, row_step,
+                                         pos_x, pos_y, cos_a, sin_a)
+    y_screen = row + horizon_offset
+
+    for x in range(screen_array.shape[0]):
+        tex_x = wrap(start_x + dx * x, image_w)
+        tex_y = wrap(start_y + dy * x, image_h)
+        if shift_x >= 0 and shift_y >= 0:
+            # power of two tiles, shifts and masks instead of divisions
+            tile = grid[tex_y >> shift_y, tex_x >> shift_x]
+            tile_y = tex_y & (tile_h - 1)
+            tile_x = tex_x & (tile_w - 1)
+        else:
+            tile = grid[tex_y // tile_h, tex_x // tile_w]
+            tile_y = tex_y % tile_h
+            tile_x = tex_x % tile_w
+
+        if channels == 3:
+            screen_array[x, y_screen, 0] = atlas[tile, tile_y, tile_x, 0]
+            screen_array[x, y_screen, 1] = atlas[tile, tile_y, tile_x, 1]
+            screen_array[x, y_screen, 2] = atlas[tile, tile_y, tile_x, 2]
+        else:
+            screen_array[x, y_screen, 0] = atlas[tile, tile_y, tile_x, 0]
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def render_mode7(screen_array, texture,
+                 row_fwd, row_half, row_step, horizon_offset,
+                 pos_x, pos_y, cos_a, sin_a):
+    """
+    JIT-compiled Mode7 renderer - this will be compiled to machine code
+    """
+    for row in range(row_fwd.shape[0]):
+        render_row(screen_array, texture, row,
+                   row_fwd, row_half, row_step, horizon_offset,
+                   pos_x, pos_y, cos_a, sin_a)
+
+
+@njit(cache=True, fastmath=FASTMATH, parallel=True)
+def render_mode7_parallel(screen_array, texture,
+                          row_fwd, row_half, row_step, horizon_offset,
+                          pos_x, pos_y, cos_a, sin_a):
+    """
+    same as render_mode7, but the scanlines are split across all threads
+    of the numba thread pool
+    """
+    for row in prange(row_fwd.shape[0]):
+        render_row(screen_array, texture, row,
+                   row_fwd, row_half, row_step, horizon_offset,
+                   pos_x, pos_y, cos_a, sin_a)
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def render_mode7_tiled(screen_array, grid, atlas,
+                       row_fwd, row_half, row_step, horizon_offset,
+                       pos_x, pos_y, cos_a, sin_a):
+    """
+    Mode7 renderer that samples through a tile index grid
+    """
+    for row in range(row_fwd.shape[0]):
+        render_row_tiled(screen_array, grid, atlas, row,
+                         row_fwd, row_half, row_step, horizon_offset,
+                         pos_x, pos_y, cos_a, sin_a)
+
+
+@njit(cache=True, fastmath=FASTMATH, parallel=True)
+def render_mode7_tiled_parallel(screen_array, grid, atlas,
+                                row_fwd, row_half, row_step, horizon_offset,
+                                pos_x, pos_y, cos_a, sin_a):
+    """
+    same as render_mode7_tiled, with the scanlines split across threads
+    """
+    for row in prange(row_fwd.shape[0]):
+        render_row_tiled(screen_array, grid, atlas, row,
+                         row_fwd, row_half, row_step, horizon_offset,
+                         pos_x, pos_y, cos_a, sin_a)
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def render_mode7_viewports(screen_array, texture,
+                           row_fwd, row_half, row_step, row_viewport,
+                           viewports, cameras):
+    """
+    render several viewports in one call. The tables hold the rows of
+    every viewport one after the other, row_viewport the viewport of each
+    row, viewports the (left, width, row_offset) and cameras the
+    (pos_x, pos_y, cos_a, sin_a) of each viewport
+    """
+    for row in range(row_fwd.shape[0]):
+        v = row_viewport[row]
+        left = viewports[v, 0]
+        render_row(screen_array[left:left + viewports[v, 1]], texture, row,
+                   row_fwd, row_half, row_step, viewports[v, 2],
+                   cameras[v, 0], cameras[v, 1], cameras[v, 2], cameras[v, 3])
+
+
+@njit(cache=True, fastmath=FASTMATH, parallel=True)
+def render_mode7_viewports_parallel(screen_array, texture,
+                                    row_fwd, row_half, row_step, row_viewport,
+                                    viewports, cameras):
+    """
+    same as render_mode7_viewports, the scanlines of all viewports are
+    split across threads together
+    """
+    for row in prange(row_fwd.shape[0]):
+        v = row_viewport[row]
+        left = viewports[v, 0]
+        render_row(screen_array[left:left + viewports[v, 1]], texture, row,
+                   row_fwd, row_half, row_step, viewports[v, 2],
+                   cameras[v, 0], cameras[v, 1], cameras[v, 2], cameras[v, 3])
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def render_mode7_tiled_viewports(screen_array, grid, atlas,
+                                 row_fwd, row_half, row_step, row_viewport,
+                                 viewports, cameras):
+    """
+    same as render_mode7_viewports, sampling through a tile index grid
+    """
+    for row in range(row_fwd.shape[0]):
+        v = row_viewport[row]
+        left = viewports[v, 0]
+        render_row_tiled(screen_array[left:left + viewports[v, 1]], grid, atlas,
+                         row, row_fwd, row_half, row_step, viewports[v, 2],
+                         cameras[v, 0], cameras[v, 1], cameras[v, 2],
+                         cameras[v, 3])
+
+
+@njit(cache=True, fastmath=FASTMATH, parallel=True)
+def render_mode7_tiled_viewports_parallel(screen_array, grid, atlas,
+                                          row_fwd, row_half, row_step,
+                                          row_viewport, viewports, cameras):
+    """
+    same as render_mode7_tiled_viewports, with the scanlines of all
+    viewports split across threads
+    """
+    for row in prange(row_fwd.shape[0]):
+        v = row_viewport[row]
+        left = viewports[v, 0]
+        render_row_tiled(screen_array[left:left + viewports[v, 1]], grid, atlas,
+                         row, row_fwd, row_half, row_step, viewports[v, 2],
+                         cameras[v, 0], cameras[v, 1], cameras[v, 2],
+                         cameras[v, 3])
+
+
+def max_threads():
+    return config.NUMBA_NUM_THREADS
@@ -0,0 +1,344 @@
+"""
+Input recording and replay
+
+A replay stores the Input of every simulation step, so playing it back
+through the deterministic fixed-step simulation reproduces the whole race.
+Inputs take 4 bits per step and are written in zlib compressed blocks while
+the race is running, together with a checkpoint of the simulation state at
+regular intervals. Checkpoints allow seeking without simulating from the
+start and detect replays that no longer reproduce (e.g. after a physics
+change).
+
+File layout (little endian):
+
+    header      magic b'M7RP', version, tick rate, seed, checkpoint
+                interval, length and name of the map
+    'C' record  one checkpoint (see CHECKPOINT)
+    'I' record  number of steps, compressed size, zlib(inputs, two per byte)
+    'L' record  number and time of a lap the player completed (see LAP)
+    'E' record  total number of steps, written when the recording is closed
+
+The recorded lap times let verify check that a replay still drives the
+same laps, not only that it reaches the checkpoints.
+
+Verify replays from the command line:
+
+    python -m src.replay verify race1.m7r race2.m7r
+"""
+import struct
+import zlib
+
+import numpy as np
+
+from src.controls import Input
+
+
+MAGIC = b'M7RP'
+VERSION = 2
+# versions that can be read, version 1 replays have no lap records
+VERSIONS = (1, 2)
+# version, tick rate, seed, checkpoint interval, length of the map name
+HEADER = struct.Struct('<BHQIB')
+# tick, player position, angle, velocity, time passed, steer time, dust
+# timer, last direction and moving, traffic light timer, image index and
+# done, game started
+CHECKPOINT = struct.Struct('<q8d2bdb??')
+BLOCK = struct.Struct('<HI')
+# lap number counted from the start of the recording, lap time in seconds
+LAP = struct.Struct('<Id')
+END = struct.Struct('<q')
+
+
+def capture(game):
+    """
+    return the simulation state of game as a tuple for CHECKPOINT.
+    Particles and opponents are not part of it, they don't affect the
+    player's race
+    """
+    player = game.player
+    light = game.traffic_light
+    return (game.tick, player.pos.x, player.pos.y, player.angle,
+            player.vel.x, player.vel.y, player.time_passed,
+            player.steer_time, player.dust_timer, player.lastdir.value,
+            player.moving, light.timer, light.img_index, light.done,
+            game.started)
+
+
+def restore(game, state):
+    """
+    set the simulation state of game to a tuple returned by capture
+    """
+    player = game.player
+    light = game.traffic_light
+    (game.tick, x, y, player.angle, vel_x, vel_y, player.time_passed,
+     player.steer_time, player.dust_timer, player.lastdir,
+     player.moving, light.timer, light.img_index, light.done,
+     game.started) = state
+    player.pos = (x, y)
+    player.vel = (vel_x, vel_y)
+    game.fleet.prev_pos[player.row] = (x, y)
+    game.fleet.prev_angle[player.row] = player.angle
+    # the traffic light removes itself after the last image
+    if light.img_index < len(light.images):
+        light.image = light.images[light.img_index]
+        light.add(game.all_sprites)
+    else:
+        light.kill()
+    game.particles.alive[:] = False
+    # lap times are not part of the checkpoint, the timing starts again at
+    # the next finish line crossing
+    game.laps.reset()
+
+
+
+class Recorder:
+    """
+    writes a replay while the game runs. Call record(game) at the start of
+    every simulation step, Game.step does this for game.recorder
+    """
+    def __init__(self, filename, game, checkpoint_interval=600,
+                 block_size=600):
+        self.file = open(filename, 'wb')
+        self.checkpoint_interval = checkpoint_interval
+        self.block = np.zeros(block_size, dtype=np.uint8)
+        self.count = 0
+        self.steps = 0
+        self.start_tick = game.tick
+        # the lap timing of the player, laps are written as they complete.
+        # A replay starts timing at its first finish line crossing, so a
+        # lap that is already running is not recorded
+        self.lap_timer = game.laps
+        self.row = game.player.row
+        self.laps_written = self.laps_done()
+        self.laps_skipped = int(game.laps.lap_time(self.row) is not None)
+        self.laps_recorded = 0
+        name = (game.map_name or '').encode('utf-8')
+        self.file.write(MAGIC)
+        self.file.write(HEADER.pack(VERSION, game.TICK_RATE, game.seed,
+                                    checkpoint_interval, len(name)))
+        self.file.write(name)
+
+
+    def laps_done(self):
+        laps = self.lap_timer.laps
+        return len(laps[self.row]) if self.row < len(laps) else 0
+
+
+    def write_laps(self):
+        """
+        write the laps the player completed since the last call
+        """
+        done = self.laps_done()
+        for lap in range(self.laps_written, done):
+            if self.laps_skipped:
+                self.laps_skipped -= 1
+                continue
+            self.laps_recorded += 1
+            self.file.write(b'L' + LAP.pack(self.laps_recorded,
+                                            self.lap_timer.laps[self.row][lap]))
+        self.laps_written = done
+
+
+    def record(self, game):
+        self.write_laps()
+        if self.steps % self.checkpoint_interval == 0:
+            # checkpoints always start a new block, so that a reader can
+            # resume decoding inputs right after one
+            self.flush()
+            self.file.write(b'C' + CHECKPOINT.pack(*capture(game)))
+        self.block[self.count] = game.inputs
+        self.count += 1
+        self.steps += 1
+        if self.count == len(self.block):
+            self.flush()
+
+
+    def flush(self):
+        if self.count == 0:
+            return
+        block = self.block[:self.count]
+        # two steps per byte, the first one in the low bits
+        packed = block[0::2].copy()
+        packed[:self.count // 2] |= block[1::2] << 4
+        packed = zlib.compress(packed.tobytes())
+        self.file.write(b'I' + BLOCK.pack(self.count, len(packed)) + packed)
+        self.file.flush()
+        self.count = 0
+
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.write_laps()
+        self.file.write(b'E' + END.pack(self.steps))
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class Replay:
+    """
+    a replay loaded into arrays: inputs holds the Input of every step,
+    checkpoints the tick and state of every checkpoint, in tick order, and
+    laps the recorded lap times of the player
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if data[:4] != MAGIC:
+            raise ValueError(f'{filename} is not a replay')
+        (version, self.tick_rate, self.seed, self.checkpoint_interval,
+         name_length) = HEADER.unpack_from(data, 4)
+        if version not in VERSIONS:
+            raise ValueError(f'{filename} has unsupported replay version {version}')
+        offset = 4 + HEADER.size
+        self.map_name = data[offset:offset + name_length].decode('utf-8') or None
+        offset += name_length
+
+        blocks = []
+        self.checkpoints = []
+        self.laps = []
+        # files of interrupted recordings have no end record, they are
+        # played up to their last complete block
+        self.complete = False
+        while offset < len(data):
+            tag = data[offset:offset + 1]
+            offset += 1
+            try:
+                if tag == b'C':
+                    self.checkpoints.append(CHECKPOINT.unpack_from(data, offset))
+                    offset += CHECKPOINT.size
+                elif tag == b'I':
+                    count, size = BLOCK.unpack_from(data, offset)
+                    offset += BLOCK.size
+                    packed = np.frombuffer(
+                            zlib.decompress(data[offset:offset + size]),
+                            dtype=np.uint8)
+                    offset += size
+                    block = np.empty(len(packed) * 2, dtype=np.uint8)
+                    block[0::2] = packed & 15
+                    block[1::2] = packed >> 4
+                    blocks.append(block[:count])
+                elif tag == b'L':
+                    self.laps.append(LAP.unpack_from(data, offset)[1])
+                    offset += LAP.size
+                elif tag == b'E':
+                    self.complete = True
+                    break
+                else:
+                    raise ValueError(f'{filename} is damaged at byte {offset - 1}')
+            except (struct.error, zlib.error):
+                # the last record was cut off
+                break
+        self.inputs = np.concatenate(blocks) if blocks else np.zeros(0, np.uint8)
+        self.start_tick = self.checkpoints[0][0] if self.checkpoints else 0
+
+
+    def __len__(self):
+        return len(self.inputs)
+
+
+    @property
+    def end_tick(self):
+        return self.start_tick + len(self.inputs)
+
+
+    def input_at(self, tick):
+        """
+        return the Input of a tick, nothing is pressed after the end
+        """
+        step = tick - self.start_tick
+        if 0 <= step < len(self.inputs):
+            return Input(int(self.inputs[step]))
+        return Input.NONE
+
+
+    def attach(self, game):
+        """
+        let game take its inputs from this replay, Game.step does this for
+        game.replay
+        """
+        game.replay = self
+
+
+    def seek(self, game, tick):
+        """
+        restore the last checkpoint before tick and simulate up to it
+        """
+        if not self.checkpoints:
+            raise ValueError('the replay has no checkpoints')
+        ticks = [state[0] for state in self.checkpoints]
+        i = max(np.searchsorted(ticks, tick, side='right') - 1, 0)
+        restore(game, self.checkpoints[i])
+        self.attach(game)
+        game.simulate(max(tick - game.tick, 0))
+
+
+    def verify(self, game):
+        """
+        play the whole replay from its first checkpoint and return the
+        ticks of the checkpoints the simulation doesn't match and the lap
+        times of the player in the replayed race, which match self.laps if
+        the replay still reproduces
+        """
+        self.seek(game, self.start_tick)
+        mismatches = []
+        for state in self.checkpoints[1:]:
+            game.simulate(state[0] - game.tick)
+            if capture(game) != state:
+                mismatches.append(state[0])
+        game.simulate(self.end_tick - game.tick)
+        row = game.player.row
+        laps = game.laps.laps[row] if row < len(game.laps.laps) else []
+        return mismatches, list(laps)
+
+
+
+def format_laps(laps):
+    return ' '.join(f'{seconds:.3f}' for seconds in laps) + ' s' if laps else 'none'
+
+
+
+def main(argv=None):
+    import argparse
+    import time
+    from src.game import Game
+
+    parser = argparse.ArgumentParser(description='verify replays headless')
+    parser.add_argument('command', choices=('verify',))
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for filename in args.files:
+        replay = Replay(filename)
+        # a new game for every replay, with its seed and no state (e.g. of
+        # the particle random numbers) left over from the one before
+        game = Game(map_name=replay.map_name, headless=True, seed=replay.seed)
+        start = time.perf_counter()
+        mismatches, laps = replay.verify(game)
+        seconds = time.perf_counter() - start
+        status = 'ok' if not mismatches else f'differs at ticks {mismatches}'
+        if laps != replay.laps:
+            status += (f', lap times differ: recorded {format_laps(replay.laps)}'
+                       f', replayed {format_laps(laps)}')
+        elif laps:
+            status += f', laps {format_laps(laps)}'
+        print(f'{filename}: {len(replay)} steps '
+              f'({len(replay) / replay.tick_rate:.1f} s of racing) '
+              f'replayed in {seconds:.2f} s, {status}')
+        failed += bool(mismatches) or laps != replay.laps
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
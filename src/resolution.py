@@ -0,0 +1,73 @@
+"""
+Dynamic render resolution
+
+ResolutionController watches how long frames take to update and render
+(without the time Game.run waits for the next frame) and moves the Mode7
+render resolution through a list of scales of the layout resolution. It
+steps down when the frames use up most of the budget and up when the next
+scale is expected to fit with room to spare, so that it doesn't switch
+back and forth between two scales.
+"""
+import numpy as np
+
+
+# render resolutions, as scales of the layout resolution (Game screen_size)
+SCALES = (0.5, 0.75, 1, 1.5, 2, 3, 4)
+
+
+
+class ResolutionController:
+    """
+    pick the render scale for a frame time budget. target is the budget in
+    seconds, window the number of frames that are averaged before a
+    decision. A step down happens above high * target, a step up if the
+    next scale is predicted to stay below low * target
+    """
+    def __init__(self, target=1 / 60, scales=SCALES, max_scale=None, scale=1,
+                 window=30, high=0.9, low=0.6):
+        self.target = target
+        # the smallest scale is kept even if it is above max_scale (a window
+        # smaller than half the layout)
+        self.scales = ([s for s in scales if max_scale is None or s <= max_scale]
+                       or [min(scales)])
+        # start at the scale closest to the requested one
+        self.level = int(np.argmin([abs(s - scale) for s in self.scales]))
+        self.window = window
+        self.high = high
+        self.low = low
+        self.times = np.zeros(window)
+        self.frames = 0
+        self.changes = 0
+
+
+    @property
+    def scale(self):
+        return self.scales[self.level]
+
+
+    def update(self, seconds):
+        """
+        add the busy time of a frame, return the new scale if the resolution
+        should change, else None
+        """
+        self.times[self.frames % self.window] = seconds
+        self.frames += 1
+        if self.frames < self.window:
+            return None
+        mean = self.times.mean()
+        level = self.level
+        if mean > self.high * self.target and level > 0:
+            level -= 1
+        elif level + 1 < len(self.scales):
+            # the cost of Mode7 grows with the number of pixels, the fixed
+            # costs make this an overestimate
+            predicted = mean * (self.scales[level + 1] / self.scale) ** 2
+            if predicted < self.low * self.target:
+                level += 1
+        if level == self.level:
+            return None
+        self.level = level
+        self.changes += 1
+        # the next decision only looks at frames at the new resolution
+        self.frames = 0
+        return self.scale
@@ -0,0 +1,72 @@
+import pygame as pg
+from collections import OrderedDict
+
+
+
+class SpriteCache:
+    """
+    shared cache of scaled and tinted Surfaces, so that sprites that are
+    drawn at a changing size (particles, billboards) don't scale and tint
+    their source image again every frame.
+    Sizes are rounded to multiples of size_step and tint channels to
+    multiples of tint_step, larger steps mean more hits but coarser
+    animations. The least recently used entry is dropped once the cache
+    holds max_size Surfaces
+    """
+    def __init__(self, max_size=512, size_step=2, tint_step=16):
+        self.max_size = max_size
+        self.size_step = size_step
+        self.tint_step = tint_step
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def quantize(self, value, step):
+        return int(round(value / step) * step)
+
+
+    def get(self, image, size, tint=None):
+        """
+        return image scaled to size and multiplied by tint (an RGBA color,
+        or None to only scale). The returned Surface is shared, don't
+        draw on it
+        """
+        w = max(self.quantize(size[0], self.size_step), 1)
+        h = max(self.quantize(size[1], self.size_step), 1)
+        if tint is not None:
+            tint = tuple(min(self.quantize(c, self.tint_step), 255) for c in tint)
+        # the entry keeps a reference to the source image, so its id can't
+        # be reused by another Surface while the entry exists
+        key = (id(image), w, h, tint)
+        entry = self.entries.get(key)
+        if entry:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        surface = pg.transform.scale(image, (w, h))
+        if tint is not None:
+            surface.fill(tint, None, pg.BLEND_RGBA_MULT)
+        self.entries[key] = (image, surface)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return surface
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0
+        }
+
+
+    def clear(self):
+        self.entries.clear()
@@ -1,8 +1,10 @@
 import pygame as pg
-from math import sin, cos, pi
 from enum import Enum
+from functools import lru_cache
+
+from src.controls import Input
+from src.render import perspective_tables, NEAR, FAR, FOV_HALF
 
-from src.particle import Particle
 
 vec = pg.math.Vector2
 
@@ -16,53 +18,123 @@ class Direction(Enum):
     RIGHT = 1
 
 
+@lru_cache(maxsize=8)
+def physics_tables(w, h, horizon):
+    """
+    return the perspective_tables of the default frustum for a w x h
+    layout. The kart physics use them instead of the tables of Mode7, so
+    that the debug keys can't change a race that is recorded or replayed
+    """
+    return perspective_tables(w, h, NEAR, FAR, FOV_HALF, horizon)
+
+
+def draw_scaled(game, screen, image, rect):
+    """
+    blit image at rect, both given at the layout resolution, onto screen
+    at the game's current render resolution. Return the rect of screen
+    that was drawn to
+    """
+    scale = game.scale
+    if scale == 1:
+        return screen.blit(image, rect)
+    size = (rect.w * scale, rect.h * scale)
+    return screen.blit(game.sprite_cache.get(image, size),
+                       (round(rect.x * scale), round(rect.y * scale)))
+
+
 class Player(pg.sprite.Sprite):
+    """
+    the player's kart on the screen. Its physics state is row 0 of
+    game.fleet, the attributes below read and write that row
+    """
     def __init__(self, game):
         super().__init__(game.all_sprites)
         self.game = game
-        self.pos = vec(999.904, 1000.38)
-        self.angle = -1.54
-        self.acc = vec()
-        self.vel = vec()
-        self.speed = 0.5
+        self.row = game.fleet.add((999.904, 1000.38), -1.54, speed=0.5)
         
         self.image = game.player_images[LEFT[0]]
         self.rect = self.image.get_rect()
         self.rect.topleft = (84, 84)
         
         self.time_passed = 0 # seconds from the start of the game
-        self.steer_time = 0 # seconds the player is pressing a direction
-        self.lastdir: Direction = Direction.LEFT
-        self.moving = 1 # 1 forward, -1 backwards
         self.dust_timer = 0
         
     
+    @property
+    def pos(self):
+        return vec(self.game.fleet.pos[self.row].tolist())
+    
+    @pos.setter
+    def pos(self, value):
+        self.game.fleet.pos[self.row] = tuple(value)
+    
+    @property
+    def vel(self):
+        return vec(self.game.fleet.vel[self.row].tolist())
+    
+    @vel.setter
+    def vel(self, value):
+        self.game.fleet.vel[self.row] = tuple(value)
+    
+    @property
+    def angle(self):
+        return float(self.game.fleet.angle[self.row])
+    
+    @angle.setter
+    def angle(self, value):
+        self.game.fleet.angle[self.row] = value
+    
+    @property
+    def steer_time(self):
+        return float(self.game.fleet.steer_time[self.row])
+    
+    @steer_time.setter
+    def steer_time(self, value):
+        self.game.fleet.steer_time[self.row] = value
+    
+    @property
+    def lastdir(self):
+        return Direction(int(self.game.fleet.lastdir[self.row]))
+    
+    @lastdir.setter
+    def lastdir(self, value):
+        self.game.fleet.lastdir[self.row] = Direction(value).value
+    
+    @property
+    def moving(self):
+        # 1 forward, -1 backwards
+        return int(self.game.fleet.moving[self.row])
+    
+    @moving.setter
+    def moving(self, value):
+        self.game.fleet.moving[self.row] = value
+        
+    
     def update(self, dt):
+        # the kart was already moved by game.fleet, only the sprite and the
+        # dust clouds are updated here
         self.time_passed += dt
-
-        keys = pg.key.get_pressed()
+        inputs = self.game.inputs
         
         if not self.game.started:
-            if keys[pg.K_w]:
+            if inputs & Input.ACCELERATE:
                 self.dust_timer += dt
                 if self.dust_timer >= 0.3:
                     # create two particles (left and right)
-                    Particle(
-                        self.game, 
+                    self.game.particles.emit(
                         self.rect.bottomright, 
-                        images=[self.game.cloud_image],
-                        colors=[pg.Color('white')],
-                        vel=vec(1, 0),
+                        self.game.cloud_image,
+                        color=pg.Color('white'),
+                        vel=(1, 0),
                         random_angle=20,
                         vanish_speed=20,
                         end_size=1.4
                         )
-                    Particle(
-                        self.game, 
+                    self.game.particles.emit(
                         self.rect.bottomleft, 
-                        images=[self.game.cloud_image],
-                        colors=[pg.Color('white')],
-                        vel=vec(-1, 0),
+                        self.game.cloud_image,
+                        color=pg.Color('white'),
+                        vel=(-1, 0),
                         random_angle=20,
                         vanish_speed=20,
                         end_size=1.4
@@ -70,74 +142,10 @@ class Player(pg.sprite.Sprite):
                     self.dust_timer = 0
             
         else:
-            if self.moving == 1:
-                turn_force = 20 # how much the angle changes when turning
-            else:
-                turn_force = 50
-            steer_anim_speed = 10 # turning animation speed
-            
+            fleet = self.game.fleet
+            self.image = self.game.player_images[fleet.frame[self.row]]
             current_speed = self.vel.length()
-            
-            # steer
-            # cap the image index at 4 (len of animation minus 2)
-            index = min(4, int(self.steer_time * steer_anim_speed))
-            
-            if keys[pg.K_a]:
-                # turning left
-                if self.lastdir == Direction.RIGHT:
-                    self.steer_time = 0
-                # increase the steering time
-                self.steer_time += dt
-                self.angle -= turn_force * dt * current_speed * self.moving
-                # add 1 to the index to get the first turning sprite and set the image
-                if self.moving == 1:
-                    self.image = self.game.player_images[LEFT[index + 1]]
-                else:
-                    self.image = self.game.player_images[RIGHT[index + 1]]
-                self.lastdir = Direction.LEFT
-            elif keys[pg.K_d]:
-                # turning right
-                if self.lastdir == Direction.LEFT:
-                    self.steer_time = 0
-                self.steer_time += dt
-                self.angle += turn_force * dt * current_speed * self.moving
-                if self.moving == 1:
-                    self.image = self.game.player_images[RIGHT[index + 1]]
-                else:
-                    self.image = self.game.player_images[LEFT[index + 1]]
-                self.lastdir = Direction.RIGHT
-            else:
-                if self.lastdir == Direction.LEFT and self.moving == 1:
-                    self.image = self.game.player_images[LEFT[index]]
-                elif self.lastdir == Direction.LEFT and self.moving == -1:
-                    self.image = self.game.player_images[RIGHT[index]]
-                elif self.lastdir == Direction.RIGHT and self.moving == 1:
-                    self.image = self.game.player_images[RIGHT[index]]
-                elif self.lastdir == Direction.RIGHT and self.moving == -1:
-                    self.image = self.game.player_images[LEFT[index]]
-                
-                self.steer_time -= dt
-            
-            # limit the steer time between 0 and the maximum image index
-            self.steer_time = max(min(self.steer_time, 0.6), 0)
-                
-            # move forward or backwards
-            if keys[pg.K_w]:
-                self.moving = 1
-                self.acc.x = self.speed
-                self.acc.y = self.speed
-            elif keys[pg.K_s]:
-                self.moving = -1
-                self.acc.x = self.speed * -0.4
-                self.acc.y = self.speed * -0.4
-    
-            self.vel.x += self.acc.x * cos(self.angle) * dt
-            self.vel.y += self.acc.y * sin(self.angle) * dt
-            self.pos += self.vel * dt
-            
-            self.acc *= 0
-            self.vel *= 0.9
-    
+            moving = self.moving
             
             # jiggle texture up and down
             if int(self.time_passed * 5) % 2 == 0 and current_speed >= 0.01:
@@ -150,40 +158,71 @@ class Player(pg.sprite.Sprite):
             self.dust_timer += dt
             if self.dust_timer >= 0.2:
                 if self.lastdir == Direction.RIGHT:
-                    v = vec(3, 0) * self.moving
+                    v = vec(3, 0) * moving
                 elif self.lastdir == Direction.LEFT:
-                    v = vec(-3, 0) * self.moving
+                    v = vec(-3, 0) * moving
                 if self.steer_time >= 0.3 and current_speed > 0.04:
-                    if self.moving == 1:
-                        p = Particle(
-                            self.game, 
+                    if moving == 1:
+                        self.game.particles.emit(
                             self.rect.midbottom, 
-                            images=[self.game.cloud_image],
-                            colors=[pg.Color('white')],
+                            self.game.cloud_image,
+                            color=pg.Color('white'),
                             vel=v,
                             random_angle=30,
                             vanish_speed=20,
-                            end_size=1.4
+                            end_size=1.4,
+                            force=(0, 1),
+                            force_angle=10
                             )
-                        p.add_force(vec(0, 1), 10)
                     else:
-                        p = Particle(
-                            self.game, 
+                        self.game.particles.emit(
                             self.rect.midbottom, 
-                            images=[self.game.cloud_image],
-                            colors=[pg.Color('white')],
+                            self.game.cloud_image,
+                            color=pg.Color('white'),
                             vel=v, 
                             random_angle=30,
                             vanish_speed=20,
-                            end_size=0.9
+                            end_size=0.9,
+                            force=(0, -2),
+                            force_angle=10
                             )
-                        p.add_force(vec(0, -2), 10)
                     
                 self.dust_timer = 0
         
+    
+    def view(self, alpha=1):
+        """
+        return the camera (x, y, angle) interpolated between the previous
+        and the current simulation step, alpha is the fraction of a step
+        that passed since the last one
+        """
+        return self.game.fleet.view(self.row, alpha)
+    
+    
+    def ground_row(self):
+        """
+        return the scanline the bottom of the kart sprite stands on
+        (without the jiggle, so it doesn't change the physics)
+        """
+        # at the layout resolution and with the default frustum, so that
+        # the physics don't depend on the render resolution or settings
+        row_fwd, _, _, horizon_offset = physics_tables(*self.game.layout_size,
+                                                       self.game.HORIZON)
+        bottom = 84 + self.image.get_height()
+        return min(max(bottom - horizon_offset, 0), len(row_fwd) - 1)
+    
+    
+    def ground_distance(self):
+        """
+        return how far ahead of the camera position the kart sprite is
+        drawn, in world units
+        """
+        row_fwd = physics_tables(*self.game.layout_size, self.game.HORIZON)[0]
+        return float(row_fwd[self.ground_row()])
+        
         
     def draw(self, screen):
-        screen.blit(self.image, self.rect)
+        return draw_scaled(self.game, screen, self.image, self.rect)
 
 
 
@@ -214,23 +253,4 @@ class TrafficLight(pg.sprite.Sprite):
         
 
     def draw(self, screen):
-        screen.blit(self.image, self.rect)
-        
-        
-
-class Bush(pg.sprite.Sprite):
-    # TODO: work in progress
-    def __init__(self, game, map_pos):
-        super().__init__(game.all_sprites)
-        self.game = game
-        self.image = game.bush_image
-        self.rect = self.image.get_rect()
-        # position on the map
-        self.map_pos = map_pos
-        
-        
-    def update(self, dt):
-        # calculate screen position and size based on relative position
-        # on game map to the player
-        dist_vec = self.map_pos - self.game.player.pos
-        distance = dist_vec.length()
\ No newline at end of file
+        return draw_scaled(self.game, screen, self.image, self.rect)
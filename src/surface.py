@@ -0,0 +1,67 @@
+"""
+Surface types of the map, for kart physics
+
+The tiles of the .tsx tilesets have a 'surface' property (road, dirt, grass,
+boost or wall). When a map is loaded, the property of the topmost tile of
+every map cell is looked up once and stored in a uint8 grid, so a surface
+query is a single array lookup instead of a walk through pytmx objects.
+Cells without any tile with a surface property are out of bounds.
+"""
+import numpy as np
+
+
+ROAD, DIRT, GRASS, BOOST, WALL, OUT_OF_BOUNDS = range(6)
+SURFACES = ('road', 'dirt', 'grass', 'boost', 'wall', 'out_of_bounds')
+
+# physics per surface class, indexed by the values of the grid:
+# velocity kept per frame, acceleration factor and whether karts can enter
+DRAG = np.array([0.9, 0.86, 0.82, 0.9, 0.9, 0.9])
+ACCELERATION = np.array([1.0, 0.8, 0.6, 2.5, 1.0, 1.0])
+BLOCKING = np.array([False, False, False, False, True, True])
+
+
+def load_surfaces(tiled_map):
+    """
+    return the surface class grid (rows, columns) of a map loaded with
+    pytmx, from the 'surface' properties of its tiles
+    """
+    layers = np.array([layer.data for layer in tiled_map.layers
+                       if hasattr(layer, 'data')], dtype=np.int64)
+    grid = np.full((tiled_map.height, tiled_map.width), OUT_OF_BOUNDS, np.uint8)
+    if len(layers) == 0:
+        return grid
+    # surface class of every tile id, 255 for tiles without the property
+    lookup = np.full(layers.max() + 1, 255, np.uint8)
+    for gid in np.unique(layers):
+        properties = tiled_map.get_tile_properties_by_gid(int(gid)) or {}
+        surface = properties.get('surface')
+        if surface in SURFACES:
+            lookup[gid] = SURFACES.index(surface)
+        elif surface is not None:
+            print(f'Warning: unknown surface {surface!r} of tile {gid}')
+    # upper layers cover the lower ones
+    for layer in layers:
+        classes = lookup[layer]
+        grid = np.where(classes != 255, classes, grid)
+    return grid
+
+
+def surface_at(grid, x, y):
+    """
+    return the surface classes of grid at arrays of world coordinates,
+    the grid repeats every 1.0 world units like the Mode7 texture
+    """
+    rows, cols = grid.shape
+    return grid[(np.mod(y, 1) * rows).astype(np.intp) % rows,
+                (np.mod(x, 1) * cols).astype(np.intp) % cols]
+
+
+
+class SurfaceGrid:
+    """
+    the surface class grid of a map, which the kart physics kernels look
+    up the ground under the karts in (see surface_at)
+    """
+    def __init__(self, grid):
+        self.grid = np.ascontiguousarray(grid, dtype=np.uint8)
+        self.rows, self.cols = self.grid.shape